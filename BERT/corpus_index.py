@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# Inverted index of the Elsevier and Reddit corpora, for the word searches of the notebooks.
+#
+# The corpus is a sequence of groups (an Elsevier article, a Reddit post) with
+# their labels (subject areas, subreddit) and their texts (the sentences of the
+# article, the body of the post). Every text is a unit. The index is built once
+# and saved in a folder of numpy arrays:
+#   tokens.txt      the distinct tokens (runs of word characters of the lowercased text)
+#   offsets.npy     start of the postings of every token
+#   postings.npy    sorted units where every token appears
+#   unit_group.npy  group of every unit
+#   group_labels.npy, label_groups.npy  (group, label) pairs
+#   labels.txt      the labels
+#
+# search_for_words() of the notebooks counts the units whose lowercased text
+# contains one of the target words, per label, and divides by the number of
+# groups of the label. A word made of word characters is inside a text if and
+# only if it is inside one of its tokens, so a query expands the words to the
+# tokens that contain them (one scan of tokens.txt) and joins their postings,
+# with the same result. Other patterns (with spaces or punctuation) are matched
+# by scan_corpus in one batched pass over the texts.
+
+import argparse
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+TOKEN = re.compile(r"\w+")
+WORD = re.compile(r"^\w+$")
+# Separator of the texts of a batch of the scan, never part of a pattern
+SEPARATOR = "\x00"
+
+parser = argparse.ArgumentParser(description="Script to build an index of a corpus of the notebooks and count the texts with target words per label.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-d", "--dataset", default="orieg/elsevier-oa-cc-by", help="dataset of the Hugging Face hub (webis/tldr-17 for Reddit)")
+parser.add_argument("--split", default="train+test+validation", help="split of the dataset (train for Reddit)")
+parser.add_argument("--text_column", default="body_text", help="column of the texts, a list of sentences or a string (normalizedBody for Reddit)")
+parser.add_argument("--label_column", default="subjareas", help="column of the labels, a list or a string (subreddit for Reddit)")
+parser.add_argument("-i", "--index", default="elsevier_index", help="folder of the index, built if it does not exist")
+parser.add_argument("-q", "--query", action="append", default=[], help="target words, comma separated. Repeat it for several queries")
+parser.add_argument("--scan", action="store_true", help="match the queries by scanning the texts instead of the index")
+parser.add_argument("--lower_labels", action="store_true", help="lowercase the labels, like the subreddits of the Reddit notebook")
+parser.add_argument("--min_total", default=0, help="only show labels with more groups than this")
+
+
+# Function to read the groups of a dataset of the hub, by batches of rows. Labels are kept as they are
+# (the subject areas of the Elsevier notebook), or lowercased if lower_labels is set (the subreddits of
+# the Reddit notebook)
+def dataset_groups(dataset, text_column, label_column, batch_size=1000, lower_labels=False):
+    for batch in dataset.iter(batch_size=batch_size):
+        for texts, labels in zip(batch[text_column], batch[label_column]):
+            labels = [labels] if isinstance(labels, str) else labels
+            texts = [texts] if isinstance(texts, str) else texts
+            yield [label.lower() for label in labels] if lower_labels else labels, texts
+
+
+class CorpusIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "tokens.txt"), "r", encoding="utf-8") as f:
+            self.tokens_text = f.read()
+        tokens = self.tokens_text.split("\n") if self.tokens_text else []
+        with open(os.path.join(path, "labels.txt"), "r", encoding="utf-8") as f:
+            self.labels = f.read().split("\n") if os.path.getsize(os.path.join(path, "labels.txt")) else []
+        # Start of every token in tokens.txt, to find the token of a match
+        self.token_starts = np.cumsum([0] + [len(token) + 1 for token in tokens[:-1]], dtype=np.int64)
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+                  for name in ["offsets", "postings", "unit_group", "group_labels", "label_groups"]}
+        self.offsets, self.postings, self.unit_group = arrays["offsets"], arrays["postings"], arrays["unit_group"]
+        self.group_labels, self.label_groups = np.asarray(arrays["group_labels"]), np.asarray(arrays["label_groups"])
+        # Number of groups of every label, the denominator of the rates
+        self.label_totals = np.bincount(self.label_groups, minlength=len(self.labels))
+        self.n_groups = int(max(self.group_labels.max(initial=-1), np.max(self.unit_group, initial=-1))) + 1
+
+    @classmethod
+    def build(cls, groups, path, chunk_size=1000000):
+        token_ids, label_ids = {}, {}
+        unit_group, group_labels, label_groups = [], [], []
+        chunks, chunk_tokens, chunk_units_ids = [], [], []
+        n_units = 0
+        for num_group, (labels, texts) in enumerate(groups):
+            for label in dict.fromkeys(labels):
+                group_labels.append(num_group)
+                label_groups.append(label_ids.setdefault(label, len(label_ids)))
+            for text in texts:
+                for token in set(TOKEN.findall(text.lower())):
+                    chunk_tokens.append(token_ids.setdefault(token, len(token_ids)))
+                    chunk_units_ids.append(n_units)
+                unit_group.append(num_group)
+                n_units += 1
+            if len(chunk_tokens) >= chunk_size:
+                chunks.append((np.array(chunk_tokens, dtype=np.int32), np.array(chunk_units_ids, dtype=np.int32)))
+                chunk_tokens, chunk_units_ids = [], []
+        chunks.append((np.array(chunk_tokens, dtype=np.int32), np.array(chunk_units_ids, dtype=np.int32)))
+
+        # Postings sorted by token, and by unit inside a token (the units grow with the chunks and the sort is stable)
+        tokens = np.concatenate([chunk_tokens for chunk_tokens, _ in chunks])
+        units = np.concatenate([chunk_units_ids for _, chunk_units_ids in chunks])
+        del chunks
+        order = np.argsort(tokens, kind="stable")
+        postings = units[order]
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(tokens, minlength=len(token_ids))))).astype(np.int64)
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "postings.npy"), postings)
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        np.save(os.path.join(path, "unit_group.npy"), np.array(unit_group, dtype=np.int32))
+        np.save(os.path.join(path, "group_labels.npy"), np.array(group_labels, dtype=np.int32))
+        np.save(os.path.join(path, "label_groups.npy"), np.array(label_groups, dtype=np.int32))
+        with open(os.path.join(path, "tokens.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(token_ids))
+        with open(os.path.join(path, "labels.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(label_ids))
+        return cls(path)
+
+    # Function to find the ids of the tokens that contain one of the words
+    def expand(self, words):
+        if not words or not self.tokens_text:
+            return np.empty(0, dtype=np.int64)
+        pattern = re.compile("|".join(re.escape(word) for word in sorted(set(words), key=len, reverse=True)))
+        positions = np.array([match.start() for match in pattern.finditer(self.tokens_text)], dtype=np.int64)
+        return np.unique(np.searchsorted(self.token_starts, positions, side="right") - 1)
+
+    # Function to find the units whose text contains one of the words
+    def units(self, words):
+        words = [word.lower() for word in words]
+        if not all(WORD.match(word) for word in words):
+            raise Exception("Only words of letters, digits and _ can be searched in the index, use scan_corpus")
+        token_ids = self.expand(words)
+        if len(token_ids) == 0:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate([self.postings[self.offsets[token]:self.offsets[token + 1]] for token in token_ids]))
+
+    # Function to count the units with one of the words per label, like search_for_words of the notebooks
+    def search(self, words):
+        return self.label_counts(self.units(words))
+
+    # Function to count matching units per label: a unit counts once for every label of its group.
+    # Returns {label: {"n", "n_total", "prop"}}, for the labels with some match
+    def label_counts(self, units):
+        group_matches = np.bincount(np.asarray(self.unit_group)[units], minlength=self.n_groups)
+        counts = np.bincount(self.label_groups, weights=group_matches[self.group_labels], minlength=len(self.labels)).astype(np.int64)
+        return {self.labels[label]: {"n": int(counts[label]), "n_total": int(self.label_totals[label]),
+                                     "prop": counts[label] / self.label_totals[label]}
+                for label in np.flatnonzero(counts)}
+
+
+# Function to match several queries in one pass over the texts of the groups: the lowercased texts of a
+# batch are joined and every query is one regular expression over them. A query is a list of substrings.
+# Returns, for every query, the counts per label like CorpusIndex.search
+def scan_corpus(groups, queries, batch_units=10000):
+    patterns = [re.compile("|".join(re.escape(word.lower()) for word in sorted(set(words), key=len, reverse=True))) for words in queries]
+    label_ids, label_totals = {}, []
+    counts = [[] for _ in queries]
+
+    def scan(batch_texts, batch_labels):
+        text = SEPARATOR.join(batch_texts)
+        starts = np.cumsum([0] + [len(unit_text) + 1 for unit_text in batch_texts[:-1]])
+        for num_query, pattern in enumerate(patterns):
+            positions = [match.start() for match in pattern.finditer(text)]
+            matched = np.unique(np.searchsorted(starts, positions, side="right") - 1)
+            for unit in matched:
+                for label in batch_labels[unit]:
+                    counts[num_query][label] += 1
+
+    batch_texts, batch_labels = [], []
+    for labels, texts in groups:
+        labels = [label_ids.setdefault(label, len(label_ids)) for label in dict.fromkeys(labels)]
+        for label in labels:
+            if label == len(label_totals):
+                label_totals.append(0)
+                for query_counts in counts:
+                    query_counts.append(0)
+            label_totals[label] += 1
+        for text in texts:
+            # Lowercased before the join: lower can change the length of a text
+            batch_texts.append(text.lower().replace(SEPARATOR, " "))
+            batch_labels.append(labels)
+        if len(batch_texts) >= batch_units:
+            scan(batch_texts, batch_labels)
+            batch_texts, batch_labels = [], []
+    if batch_texts:
+        scan(batch_texts, batch_labels)
+
+    labels = list(label_ids)
+    return [{labels[label]: {"n": n, "n_total": label_totals[label], "prop": n / label_totals[label]}
+             for label, n in enumerate(query_counts) if n} for query_counts in counts]
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+    queries = [query.split(",") for query in config["query"]]
+
+    def groups():
+        from datasets import load_dataset
+
+        dataset = load_dataset(config["dataset"], split=config["split"])
+        return dataset_groups(dataset, config["text_column"], config["label_column"], lower_labels=config["lower_labels"])
+
+    if config["scan"]:
+        start_time = time.perf_counter()
+        results = scan_corpus(groups(), queries)
+        print("Scanned the corpus in {:.1f}s".format(time.perf_counter() - start_time))
+    else:
+        if not os.path.exists(os.path.join(config["index"], "postings.npy")):
+            start_time = time.perf_counter()
+            CorpusIndex.build(groups(), config["index"])
+            print("Index built in {:.1f}s".format(time.perf_counter() - start_time))
+        index = CorpusIndex(config["index"])
+        results = []
+        for words in queries:
+            start_time = time.perf_counter()
+            results.append(index.search(words))
+            print("Query", ",".join(words), "in {:.1f}ms".format((time.perf_counter() - start_time) * 1000))
+
+    for words, result in zip(queries, results):
+        result = {label: counts for label, counts in result.items() if counts["n_total"] > int(config["min_total"])}
+        print(",".join(words) + ":")
+        print(json.dumps(dict(sorted(result.items(), key=lambda item: item[1]["prop"], reverse=True)), indent=1))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Data preparation of the fine-tuning notebooks with Arrow compute kernels.
+#
+# The statistics and filters of elsevier_model.ipynb and reddit_model.ipynb,
+# without a Python loop over the rows:
+#   - words per subject area: sentence.split(" ") has one word more than spaces,
+#     so the words of every article are counted with count_substring in batched
+#     (and multi-process) map calls, and summed per label with a group_by
+#   - posts per subreddit: value_counts of the lowercased column
+#   - filters by label: is_in with the set of labels over the whole column, and
+#     a select of the matching rows
+#   - sentences of the articles: list_flatten of the body_text column
+# The results are the same as the loops of the notebooks.
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import Dataset, load_dataset
+
+CORPORA = {
+    "elsevier": {"name": "orieg/elsevier-oa-cc-by", "split": "train+test+validation", "text_column": "body_text",
+                 "label_column": "subjareas", "labels": "PSYC,ECON", "sample": 400000},
+    "reddit": {"name": "webis/tldr-17", "split": "train", "text_column": "normalizedBody",
+               "label_column": "subreddit", "labels": "", "sample": 500000},
+}
+
+parser = argparse.ArgumentParser(description="Script to compute the statistics of a corpus of the notebooks and write its filtered train and test splits.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-c", "--corpus", default="elsevier", choices=list(CORPORA), help="corpus of the notebooks")
+parser.add_argument("-l", "--labels", default=None, help="labels to keep, comma separated (by default PSYC,ECON for Elsevier, and the subreddits with more than --min_posts posts for Reddit)")
+parser.add_argument("--min_posts", default=1500, help="minimum number of posts of the subreddits kept")
+parser.add_argument("-s", "--sample", default=None, help="number of texts sampled (by default 400000 for Elsevier and 500000 for Reddit)")
+parser.add_argument("--seed", default=23, help="seed of the sample")
+parser.add_argument("--test_size", default=0.2, help="fraction of the sample in the test split")
+parser.add_argument("-n", "--num_proc", default=os.cpu_count(), help="number of processes of the map calls")
+parser.add_argument("-o", "--output", default=None, help="folder where the splits are saved (save_to_disk)")
+
+
+# Function to get a column of a dataset as a single Arrow array (with the rows selected by shuffles or selects)
+def column(dataset, name):
+    values = dataset.with_format("arrow")[name]
+    return values.combine_chunks() if isinstance(values, pa.ChunkedArray) else values
+
+
+# Function to count the words of every row of a column of sentences like the notebooks:
+# the sum of len(sentence.split(" ")), that is, the spaces of a sentence plus one
+def count_words(batch, text_column):
+    texts = batch.column(text_column).combine_chunks()
+    if pa.types.is_list(texts.type) or pa.types.is_large_list(texts.type):
+        sentence_words = pc.add(pc.count_substring(pc.list_flatten(texts), " "), 1).to_numpy(zero_copy_only=False)
+        offsets = texts.offsets.to_numpy() - texts.offsets[0].as_py()
+        # Words of the sentences of every row, from the cumulative sum at the list offsets
+        cumulative = np.concatenate(([0], np.cumsum(sentence_words, dtype=np.int64)))
+        n_words = cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+    else:
+        n_words = pc.add(pc.count_substring(texts, " "), 1).to_numpy(zero_copy_only=False)
+    return pa.table({"n_words": n_words})
+
+
+# Function to get the label of every element of a label column and the row it belongs to
+def explode_labels(labels):
+    if pa.types.is_list(labels.type) or pa.types.is_large_list(labels.type):
+        return pc.list_flatten(labels), pc.list_parent_indices(labels)
+    return labels, pa.array(np.arange(len(labels)))
+
+
+# Function to count the words per label. Returns {label: {"value": words, "n": rows}} like update_dict of the notebook
+def label_word_counts(dataset, text_column="body_text", label_column="subjareas", num_proc=None):
+    n_words = dataset.with_format("arrow").map(count_words, batched=True, batch_size=10000, num_proc=num_proc,
+                                                fn_kwargs={"text_column": text_column}, remove_columns=dataset.column_names)
+    n_words = column(n_words, "n_words")
+    labels, rows = explode_labels(column(dataset, label_column))
+    table = pa.table({"label": labels, "n_words": pc.take(n_words, rows)})
+    grouped = table.group_by("label").aggregate([("n_words", "sum"), ("n_words", "count")])
+    return {label: {"value": value, "n": n} for label, value, n in
+            zip(grouped["label"].to_pylist(), grouped["n_words_sum"].to_pylist(), grouped["n_words_count"].to_pylist())}
+
+
+# Function to count the rows per lowercased label, sorted by count like sorted_counter of the notebook
+def label_counts(dataset, label_column="subreddit"):
+    labels, _ = explode_labels(column(dataset, label_column))
+    counts = pc.value_counts(pc.utf8_lower(labels))
+    counter = dict(zip(counts.field("values").to_pylist(), counts.field("counts").to_pylist()))
+    return dict(sorted(counter.items(), key=lambda x: x[1], reverse=True))
+
+
+# Function to keep the rows with one of the labels. Labels are compared lowercased if lower is set
+def filter_labels(dataset, labels, label_column, lower=False):
+    values, rows = explode_labels(column(dataset, label_column))
+    if lower:
+        values = pc.utf8_lower(values)
+    matches = pc.fill_null(pc.is_in(values, value_set=pa.array(sorted(set(labels)), type=values.type)), False)
+    indices = np.unique(pc.filter(rows, matches).to_numpy(zero_copy_only=False))
+    return dataset.select(indices)
+
+
+# Function to make a dataset of the sentences of the articles, one row each
+def split_sentences(dataset, text_column="body_text"):
+    return Dataset(pa.table({text_column: pc.list_flatten(column(dataset, text_column))}))
+
+
+# Function to sample the texts and split them like the notebooks: shuffle(seed).select(range(sample)),
+# then train_test_split
+def sample_splits(dataset, sample, seed=23, test_size=0.2, split_seed=None):
+    sample = min(sample, len(dataset))
+    return dataset.shuffle(seed=seed).select(range(sample)).train_test_split(test_size=test_size, seed=split_seed)
+
+
+# Function to load a corpus of the notebooks and compute its statistics, labels filter and splits.
+# Returns the splits and the statistics
+def prepare(corpus, labels=None, min_posts=1500, sample=None, seed=23, test_size=0.2, num_proc=None, split_seed=None):
+    settings = CORPORA[corpus]
+    dataset = load_dataset(settings["name"], split=settings["split"])
+    stats = {}
+    if corpus == "elsevier":
+        stats["counter"] = label_word_counts(dataset, settings["text_column"], settings["label_column"], num_proc)
+        stats["word_counter"] = {label: round(counts["value"] / counts["n"], 2) for label, counts in stats["counter"].items()}
+        labels = labels or settings["labels"].split(",")
+        dataset = split_sentences(filter_labels(dataset, labels, settings["label_column"]), settings["text_column"])
+    else:
+        stats["counter"] = label_counts(dataset, settings["label_column"])
+        labels = labels or [label for label, n in stats["counter"].items() if n > min_posts]
+        dataset = filter_labels(dataset, labels, settings["label_column"], lower=True)
+    stats["rows"] = len(dataset)
+    splits = sample_splits(dataset, sample or settings["sample"], seed, test_size, split_seed)
+    return splits, stats
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+
+    start_time = time.perf_counter()
+    splits, stats = prepare(config["corpus"], config["labels"].split(",") if config["labels"] else None,
+                            int(config["min_posts"]), int(config["sample"]) if config["sample"] else None,
+                            int(config["seed"]), float(config["test_size"]), int(config["num_proc"]))
+    print(json.dumps({key: value for key, value in stats.items() if key != "counter"}, indent=1))
+    print("Labels:", len(stats["counter"]), "- top 10:", list(stats["counter"].items())[:10])
+    print(splits)
+    print("Prepared in {:.1f}s".format(time.perf_counter() - start_time))
+
+    if config["output"]:
+        splits.save_to_disk(config["output"])
+        print("Splits saved to", config["output"])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Cache of the tokenized training splits of the fine-tuning runs.
+#
+# Every run repeats load_dataset, the filters, shuffle(seed).select(range(n)),
+# train_test_split and the tokenization. The final splits depend only on a few
+# settings (the corpus, the labels kept, the sample size, the seeds, the
+# tokenizer and its configuration, and the tokenization mode), so they are
+# saved with save_to_disk in a folder named by the fingerprint (sha256) of the
+# settings. load_from_disk memory-maps the Arrow files, so a run with the same
+# settings starts training in seconds.
+#
+# The entries have a meta.json with their settings, size and last use. The
+# hits and misses are counted in stats.json, and when the cache is above its
+# size limit the least recently used entries are removed.
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from datasets import load_from_disk
+
+STATS_FILE = "stats.json"
+META_FILE = "meta.json"
+# Changes of the format of the entries invalidate them
+CACHE_VERSION = 1
+
+parser = argparse.ArgumentParser(description="Script to prepare and tokenize the training splits of a corpus of the notebooks, reusing the cache.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-c", "--corpus", default="elsevier", choices=["elsevier", "reddit"], help="corpus of the notebooks (see data_prep.py)")
+parser.add_argument("-l", "--labels", default=None, help="labels to keep, comma separated (see data_prep.py)")
+parser.add_argument("--min_posts", default=1500, help="minimum number of posts of the subreddits kept")
+parser.add_argument("-s", "--sample", default=None, help="number of texts sampled")
+parser.add_argument("--seed", default=23, help="seed of the sample and of the train/test split")
+parser.add_argument("--test_size", default=0.2, help="fraction of the sample in the test split")
+parser.add_argument("-m", "--mode", default="packed", choices=["packed", "grouped", "padded"], help="tokenization mode (see mlm_data.py)")
+parser.add_argument("--block_size", default=128, help="tokens of every block of the packed mode")
+parser.add_argument("--max_length", default=512, help="texts are truncated to this number of tokens")
+parser.add_argument("--tokenizer", default="distilbert-base-uncased", help="tokenizer of the model")
+parser.add_argument("-n", "--num_proc", default=os.cpu_count(), help="number of processes of the preparation")
+parser.add_argument("--cache_dir", default="dataset_cache", help="folder of the cache")
+parser.add_argument("--max_gb", default=50, help="maximum size of the cache in GB, the least recently used entries are removed above it")
+parser.add_argument("--stats", action="store_true", help="only print the statistics of the cache")
+
+
+# Function to get the folder size in bytes
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+# Function to describe a tokenizer by its class and its whole configuration (the serialized
+# tokenizer of a fast tokenizer: vocabulary, normalizer, special tokens...)
+def tokenizer_fingerprint(tokenizer):
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    description = backend.to_str() if backend is not None else json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    description += json.dumps(tokenizer.special_tokens_map, sort_keys=True) + str(tokenizer.model_max_length)
+    return type(tokenizer).__name__ + ":" + hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+class DatasetCache:
+    def __init__(self, cache_dir="dataset_cache", max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Function to get the fingerprint of the settings
+    def key(self, settings):
+        return hashlib.sha256(json.dumps([CACHE_VERSION, settings], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def read_json(self, file_path, default):
+        if not os.path.exists(file_path):
+            return default
+        with open(file_path) as f:
+            return json.load(f)
+
+    # Function to write a json file, to a temporary file that is then renamed
+    def write_json(self, file_path, data):
+        with open(file_path + ".tmp", "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(file_path + ".tmp", file_path)
+
+    def count(self, name):
+        stats_file = os.path.join(self.cache_dir, STATS_FILE)
+        stats = self.read_json(stats_file, {"hits": 0, "misses": 0})
+        stats[name] += 1
+        self.write_json(stats_file, stats)
+
+    # Function to load the splits of the settings, or None if they are not in the cache
+    def get(self, settings):
+        path = self.entry_path(self.key(settings))
+        meta_file = os.path.join(path, META_FILE)
+        # The meta file is written last, an entry without it is incomplete
+        if not os.path.exists(meta_file):
+            self.count("misses")
+            return None
+        meta = self.read_json(meta_file, {})
+        meta["last_used"] = str(datetime.datetime.now())
+        self.write_json(meta_file, meta)
+        self.count("hits")
+        return load_from_disk(os.path.join(path, "splits"))
+
+    # Function to save the splits of the settings. They are written in a temporary folder that is renamed
+    def put(self, settings, splits):
+        key = self.key(settings)
+        path = self.entry_path(key)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        splits.save_to_disk(os.path.join(tmp_path, "splits"))
+        now = str(datetime.datetime.now())
+        self.write_json(os.path.join(tmp_path, META_FILE), {"settings": settings, "bytes": folder_size(tmp_path),
+                                                            "created": now, "last_used": now})
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes, keep=key)
+        return path
+
+    # Function to get the splits of the settings, building and saving them with build() if they are not cached
+    def get_or_build(self, settings, build):
+        splits = self.get(settings)
+        if splits is None:
+            self.put(settings, build())
+            splits = load_from_disk(os.path.join(self.entry_path(self.key(settings)), "splits"))
+        return splits
+
+    # Function to list the complete entries as (key, meta)
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            meta_file = os.path.join(self.cache_dir, name, META_FILE)
+            if not name.endswith(".tmp") and os.path.exists(meta_file):
+                entries.append((name, self.read_json(meta_file, {})))
+        return entries
+
+    # Function to remove the least recently used entries until the cache takes at most max_bytes.
+    # Returns the keys removed
+    def evict(self, max_bytes, keep=None):
+        entries = sorted(self.entries(), key=lambda entry: entry[1]["last_used"])
+        total = sum(meta["bytes"] for _, meta in entries)
+        removed = []
+        for key, meta in entries:
+            if total <= max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= meta["bytes"]
+            removed.append(key)
+        return removed
+
+    def stats(self):
+        stats = self.read_json(os.path.join(self.cache_dir, STATS_FILE), {"hits": 0, "misses": 0})
+        entries = self.entries()
+        stats["entries"] = len(entries)
+        stats["bytes"] = sum(meta["bytes"] for _, meta in entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+# Function to get the tokenized splits of a corpus: prepared with data_prep.py and tokenized with
+# mlm_data.py, or loaded from the cache. The train/test split uses the seed too, so that the
+# splits of the same settings are always the same
+def cached_splits(cache, corpus, tokenizer, labels=None, min_posts=1500, sample=None, seed=23, test_size=0.2,
+                  mode="packed", block_size=128, max_length=512, num_proc=None):
+    settings = {"corpus": corpus, "labels": sorted(labels) if labels else None, "min_posts": min_posts,
+                "sample": sample, "seed": seed, "test_size": test_size, "tokenizer": tokenizer_fingerprint(tokenizer),
+                "mode": mode, "block_size": block_size if mode == "packed" else None, "max_length": max_length}
+
+    def build():
+        from data_prep import CORPORA, prepare
+        from mlm_data import tokenize_splits
+
+        splits, _ = prepare(corpus, labels, min_posts, sample, seed, test_size, num_proc, split_seed=seed)
+        return tokenize_splits(splits, tokenizer, mode, CORPORA[corpus]["text_column"], block_size, max_length, num_proc)
+
+    return cache.get_or_build(settings, build)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+
+    cache = DatasetCache(config["cache_dir"], int(float(config["max_gb"]) * 1024 ** 3))
+    if not config["stats"]:
+        from transformers import DistilBertTokenizerFast
+
+        tokenizer = DistilBertTokenizerFast.from_pretrained(config["tokenizer"])
+        start_time = time.perf_counter()
+        splits = cached_splits(cache, config["corpus"], tokenizer, config["labels"].split(",") if config["labels"] else None,
+                               int(config["min_posts"]), int(config["sample"]) if config["sample"] else None,
+                               int(config["seed"]), float(config["test_size"]), config["mode"], int(config["block_size"]),
+                               int(config["max_length"]), int(config["num_proc"]))
+        print(splits)
+        print("Splits ready in {:.1f}s".format(time.perf_counter() - start_time))
+    print("Cache:", json.dumps(cache.stats()))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# Training data of the masked language model fine-tuning, without [PAD] tokens.
+#
+# The notebooks tokenize with padding="longest" inside batches of 1000 texts of
+# map, so a short post or sentence is padded to the longest text of its batch
+# and most of the compute goes to [PAD] tokens. Two modes avoid it:
+#   - packed: the tokenized texts (with their [CLS] and [SEP]) are concatenated
+#     and cut in blocks of block_size tokens, so every sequence is full
+#   - grouped: the texts are tokenized without padding, the Trainer samples
+#     batches of texts of similar length (group_by_length) and the collator pads
+#     each batch only to its longest text
+# "padded" keeps the tokenization of the notebooks, to compare.
+#
+# TokenCountingCollator counts the real and [PAD] tokens of the batches built
+# by the collator, and ThroughputCallback adds the tokens/second and the
+# padding ratio to the logs of the Trainer.
+
+import argparse
+import dataclasses
+import math
+import os
+import time
+
+import numpy as np
+from transformers import (AutoModelForMaskedLM, DataCollatorForLanguageModeling, DistilBertConfig,
+                          DistilBertTokenizerFast, Trainer, TrainerCallback, TrainingArguments)
+
+MODES = ["packed", "grouped", "padded"]
+
+parser = argparse.ArgumentParser(description="Script to prepare the MLM training data of a corpus of the notebooks without padding, and fine-tune DistilBERT on it.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-c", "--corpus", default="elsevier", choices=["elsevier", "reddit"], help="corpus of the notebooks (see data_prep.py)")
+parser.add_argument("-i", "--input", default=None, help="folder with the splits saved by data_prep.py, instead of preparing them")
+parser.add_argument("-m", "--mode", default="packed", choices=MODES, help="packed blocks, length-grouped batches or the padding of the notebooks")
+parser.add_argument("--block_size", default=128, help="tokens of every block of the packed mode")
+parser.add_argument("--max_length", default=512, help="texts are truncated to this number of tokens (grouped and padded modes)")
+parser.add_argument("-b", "--batch_size", default=8, help="batch size of the training")
+parser.add_argument("-n", "--num_proc", default=os.cpu_count(), help="number of processes of the tokenization")
+parser.add_argument("--epochs", default=4, help="number of epochs")
+parser.add_argument("--output_dir", default="my_awesome_model", help="output folder of the Trainer")
+parser.add_argument("--fp16", action="store_true", help="train with mixed precision, like the notebooks (it needs a GPU)")
+parser.add_argument("--train", action="store_true", help="fine-tune the model (otherwise only the data and its padding ratio are computed)")
+
+
+# Function to tokenize texts without padding
+def tokenize_texts(examples, tokenizer, text_column, max_length):
+    return tokenizer(examples[text_column], truncation=True, max_length=max_length, return_special_tokens_mask=True)
+
+
+# Function to tokenize like the notebooks: padding to the longest text of every batch of map
+def tokenize_padded(examples, tokenizer, text_column, max_length):
+    return tokenizer(examples[text_column], padding="longest", truncation=True, max_length=max_length,
+                     return_special_tokens_mask=True)
+
+
+# Function to concatenate tokenized texts and cut them in blocks of block_size tokens. The tokens
+# left at the end of a batch of map that do not fill a block are dropped, like run_mlm.py
+def pack_blocks(examples, block_size):
+    columns = ["input_ids", "special_tokens_mask"]
+    concatenated = {name: np.concatenate([np.asarray(ids, dtype=np.int32) for ids in examples[name]])
+                    if len(examples[name]) else np.empty(0, dtype=np.int32) for name in columns}
+    total = (len(concatenated["input_ids"]) // block_size) * block_size
+    blocks = {name: concatenated[name][:total].reshape(-1, block_size) for name in columns}
+    blocks["attention_mask"] = np.ones_like(blocks["input_ids"])
+    return blocks
+
+
+# Function to tokenize the splits for the mode. The packed and grouped modes have no [PAD] tokens
+def tokenize_splits(splits, tokenizer, mode="packed", text_column="body_text", block_size=128, max_length=512, num_proc=None):
+    columns = splits["train"].column_names
+    if mode == "padded":
+        return splits.map(tokenize_padded, batched=True, num_proc=num_proc, remove_columns=columns,
+                          fn_kwargs={"tokenizer": tokenizer, "text_column": text_column, "max_length": max_length})
+    tokenized = splits.map(tokenize_texts, batched=True, num_proc=num_proc, remove_columns=columns,
+                           fn_kwargs={"tokenizer": tokenizer, "text_column": text_column, "max_length": max_length})
+    if mode == "packed":
+        return tokenized.map(pack_blocks, batched=True, batch_size=1000, num_proc=num_proc,
+                             remove_columns=tokenized["train"].column_names, fn_kwargs={"block_size": block_size})
+    # Lengths for the group_by_length sampler of the Trainer
+    return tokenized.map(lambda examples: {"length": [len(ids) for ids in examples["input_ids"]]}, batched=True, num_proc=num_proc)
+
+
+# Function to compute the fraction of [PAD] tokens of the batches of a tokenized split. The grouped mode
+# is measured with the length-grouped sampler of the Trainer
+def padding_ratio(dataset, mode, batch_size, seed=23):
+    if mode == "packed":
+        return 0.0
+    if mode == "padded":
+        attention = dataset.with_format("numpy", columns=["attention_mask"])["attention_mask"]
+        real = sum(int(np.sum(mask)) for mask in attention)
+        total = sum(len(mask) for mask in attention)
+        return 1 - real / total if total else 0.0
+
+    import torch
+    from transformers.trainer_pt_utils import get_length_grouped_indices
+
+    lengths = np.asarray(dataset["length"])
+    indices = np.asarray(get_length_grouped_indices(lengths.tolist(), batch_size, generator=torch.Generator().manual_seed(seed)))
+    batches = lengths[indices[:len(indices) // batch_size * batch_size]].reshape(-1, batch_size)
+    total = batches.max(axis=1).sum() * batch_size
+    return float(1 - batches.sum() / total) if total else 0.0
+
+
+class TokenCountingCollator:
+    def __init__(self, collator, pad_token_id=0):
+        self.collator = collator
+        self.pad_token_id = pad_token_id
+        self.real_tokens = 0
+        self.total_tokens = 0
+
+    def __call__(self, examples):
+        batch = self.collator(examples)
+        if "attention_mask" in batch:
+            self.real_tokens += int(batch["attention_mask"].sum())
+        else:
+            self.real_tokens += int((batch["input_ids"] != self.pad_token_id).sum())
+        self.total_tokens += batch["input_ids"].numel()
+        return batch
+
+
+class ThroughputCallback(TrainerCallback):
+    def __init__(self, counter):
+        self.counter = counter
+        self.start_time = None
+        self.start_tokens = 0
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.start_time = time.perf_counter()
+        self.start_tokens = self.counter.total_tokens
+
+    # The tokens counted by the collator since the start of the training. The Trainer saves the logs
+    # in log_history before the callbacks see them, so the entry is updated too
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is None or self.start_time is None:
+            return
+        elapsed = time.perf_counter() - self.start_time
+        total = self.counter.total_tokens - self.start_tokens
+        logs["tokens_per_second"] = round(total / elapsed, 1) if elapsed > 0 else 0.0
+        logs["padding_ratio"] = round(1 - self.counter.real_tokens / self.counter.total_tokens, 4) if self.counter.total_tokens else 0.0
+        if state.log_history:
+            state.log_history[-1].update(tokens_per_second=logs["tokens_per_second"], padding_ratio=logs["padding_ratio"])
+
+
+# Function to build the Trainer of the notebooks for the tokenized splits, with the collator that
+# counts the tokens and the callback that logs the throughput
+def build_trainer(tokenized, tokenizer, mode="packed", batch_size=8, epochs=4, output_dir="my_awesome_model", fp16=False):
+    config = DistilBertConfig(dropout=0.2, attention_dropout=0.2, output_hidden_states=True)
+    model = AutoModelForMaskedLM.from_pretrained("distilbert-base-uncased", config=config)
+    collator = TokenCountingCollator(DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm_probability=0.15),
+                                     tokenizer.pad_token_id)
+    # The length-grouped sampler is train_sampling_strategy since transformers 5 (group_by_length before)
+    grouping = {}
+    if mode == "grouped":
+        if "train_sampling_strategy" in {field.name for field in dataclasses.fields(TrainingArguments)}:
+            grouping["train_sampling_strategy"] = "group_by_length"
+        else:
+            grouping["group_by_length"] = True
+    training_args = TrainingArguments(
+        output_dir=output_dir,
+        eval_strategy="epoch",
+        num_train_epochs=epochs,
+        learning_rate=5e-5,
+        weight_decay=0.01,
+        per_device_train_batch_size=batch_size,
+        per_device_eval_batch_size=batch_size,
+        fp16=fp16,
+        logging_steps=max(len(tokenized["train"]) // batch_size, 1),
+        save_total_limit=5,
+        length_column_name="length",
+        **grouping,
+    )
+    trainer = Trainer(model=model, args=training_args, train_dataset=tokenized["train"], eval_dataset=tokenized["test"],
+                      data_collator=collator, processing_class=tokenizer)
+    # First, so the printer and the reporters of the Trainer get the throughput in the logs
+    trainer.callback_handler.callbacks.insert(0, ThroughputCallback(collator))
+    return trainer
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+    batch_size = int(config["batch_size"])
+    text_column = "body_text" if config["corpus"] == "elsevier" else "normalizedBody"
+
+    if config["input"]:
+        from datasets import load_from_disk
+
+        splits = load_from_disk(config["input"])
+    else:
+        from data_prep import prepare
+
+        splits, _ = prepare(config["corpus"], num_proc=int(config["num_proc"]))
+
+    tokenizer = DistilBertTokenizerFast.from_pretrained("distilbert-base-uncased")
+    start_time = time.perf_counter()
+    tokenized = tokenize_splits(splits, tokenizer, config["mode"], text_column, int(config["block_size"]),
+                                int(config["max_length"]), int(config["num_proc"]))
+    print(tokenized)
+    print("Tokenized in {:.1f}s - padding ratio of the training batches: {:.3f}".format(
+        time.perf_counter() - start_time, padding_ratio(tokenized["train"], config["mode"], batch_size)))
+
+    if config["train"]:
+        trainer = build_trainer(tokenized, tokenizer, config["mode"], batch_size, int(config["epochs"]), config["output_dir"],
+                                config["fp16"])
+        trainer.train()
+        eval_results = trainer.evaluate()
+        print(f">>> Perplexity: {math.exp(eval_results['eval_loss']):.2f}")
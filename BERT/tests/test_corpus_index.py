@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip("datasets")
+
+from datasets import Dataset
+
+from corpus_index import CorpusIndex, dataset_groups, scan_corpus
+
+ARTICLES = {
+    "body_text": [["We lost the data.", "No Loss here"], ["Nothing"], ["Losses grew", "and grew"], ["LOSE it"]],
+    "subjareas": [["PSYC", "ECON"], ["ECON"], ["MATH"], ["PSYC"]],
+}
+POSTS = {
+    "normalizedBody": ["a big loss", "nothing", "they lost", "fine"],
+    "subreddit": ["AskReddit", "askreddit", "Funny", "pics"],
+}
+TARGET_WORDS = ["loss", "losses", "lose", "lost"]
+
+
+# search_for_words of elsevier_model.ipynb, with the number of articles of every label
+def notebook_search(dataset, target_words):
+    matching, totals = {}, {}
+    for article in dataset:
+        n = sum(any(word in sentence.lower() for word in target_words) for sentence in article["body_text"])
+        for label in article["subjareas"]:
+            matching[label] = matching.get(label, 0) + n
+            totals[label] = totals.get(label, 0) + 1
+    return {label: {"n": n, "n_total": totals[label], "prop": n / totals[label]} for label, n in matching.items() if n}
+
+
+def test_index_keeps_the_labels():
+    dataset = Dataset.from_dict(ARTICLES)
+    expected = notebook_search(dataset, TARGET_WORDS)
+    assert set(expected) == {"PSYC", "ECON", "MATH"}
+    assert list(dataset_groups(dataset, "body_text", "subjareas", batch_size=3))[0] == (["PSYC", "ECON"], ["We lost the data.", "No Loss here"])
+
+
+def test_index_search_matches_the_notebook(tmp_path):
+    dataset = Dataset.from_dict(ARTICLES)
+    index = CorpusIndex.build(dataset_groups(dataset, "body_text", "subjareas", batch_size=3), str(tmp_path / "index"))
+    assert index.labels == ["PSYC", "ECON", "MATH"]
+    assert index.search(TARGET_WORDS) == notebook_search(dataset, TARGET_WORDS)
+
+
+def test_scan_matches_the_notebook():
+    dataset = Dataset.from_dict(ARTICLES)
+    results = scan_corpus(dataset_groups(dataset, "body_text", "subjareas"), [TARGET_WORDS], batch_units=2)
+    assert results == [notebook_search(dataset, TARGET_WORDS)]
+
+
+def test_lower_labels_merges_the_subreddits():
+    dataset = Dataset.from_dict(POSTS)
+    groups = list(dataset_groups(dataset, "normalizedBody", "subreddit", lower_labels=True))
+    assert [labels for labels, _ in groups] == [["askreddit"], ["askreddit"], ["funny"], ["pics"]]
+    result = scan_corpus(groups, [TARGET_WORDS])[0]
+    assert result == {"askreddit": {"n": 1, "n_total": 2, "prop": 0.5}, "funny": {"n": 1, "n_total": 1, "prop": 1.0}}
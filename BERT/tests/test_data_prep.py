@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip("datasets")
+pytest.importorskip("pyarrow")
+
+from datasets import Dataset
+
+from data_prep import filter_labels, label_counts, label_word_counts, sample_splits, split_sentences
+
+ARTICLES = {
+    "body_text": [["A short one.", "Two  spaces here"], [], ["One"], ["The last sentence of it", "and more"]],
+    "subjareas": [["PSYC", "ECON"], ["ECON"], ["MATH"], ["PSYC"]],
+}
+POSTS = {
+    "normalizedBody": ["first post", "second", "third post here", "fourth", "fifth"],
+    "subreddit": ["AskReddit", "askreddit", "Funny", "AskReddit", "pics"],
+}
+
+
+# The loop of elsevier_model.ipynb (update_dict)
+def notebook_word_counts(dataset):
+    counter = {}
+    for article in dataset:
+        words = sum(len(sentence.split(" ")) for sentence in article["body_text"])
+        for label in article["subjareas"]:
+            counts = counter.setdefault(label, {"value": 0, "n": 0})
+            counts["value"] += words
+            counts["n"] += 1
+    return counter
+
+
+def test_label_word_counts_match_the_notebook():
+    dataset = Dataset.from_dict(ARTICLES)
+    assert label_word_counts(dataset) == notebook_word_counts(dataset)
+    # Rows selected by a shuffle are read through the indices mapping
+    shuffled = dataset.shuffle(seed=1).select(range(3))
+    assert label_word_counts(shuffled) == notebook_word_counts(shuffled)
+
+
+def test_word_counts_of_plain_texts():
+    dataset = Dataset.from_dict({"text": ["a b c", "d", "e f"], "label": ["x", "y", "x"]})
+    assert label_word_counts(dataset, "text", "label") == {"x": {"value": 5, "n": 2}, "y": {"value": 1, "n": 1}}
+
+
+def test_label_counts_are_lowercased_and_sorted():
+    counts = label_counts(Dataset.from_dict(POSTS))
+    assert list(counts.items())[0] == ("askreddit", 3)
+    assert counts == {"askreddit": 3, "funny": 1, "pics": 1}
+
+
+def test_filter_labels():
+    articles = Dataset.from_dict(ARTICLES)
+    assert list(filter_labels(articles, ["PSYC", "ECON"], "subjareas")["subjareas"]) == [["PSYC", "ECON"], ["ECON"], ["PSYC"]]
+    posts = Dataset.from_dict(POSTS)
+    assert list(filter_labels(posts, ["askreddit"], "subreddit", lower=True)["normalizedBody"]) == ["first post", "second", "fourth"]
+    assert list(filter_labels(posts, ["askreddit"], "subreddit")["normalizedBody"]) == ["second"]
+
+
+def test_sentences_and_splits():
+    sentences = split_sentences(Dataset.from_dict(ARTICLES))
+    assert list(sentences["body_text"]) == ["A short one.", "Two  spaces here", "One", "The last sentence of it", "and more"]
+    splits = sample_splits(sentences, 4, seed=23, test_size=0.25, split_seed=23)
+    assert len(splits["train"]) == 3 and len(splits["test"]) == 1
+    assert set(list(splits["train"]["body_text"]) + list(splits["test"]["body_text"])) <= set(sentences["body_text"])
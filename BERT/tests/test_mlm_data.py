@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("datasets")
+pytest.importorskip("transformers")
+
+from datasets import Dataset, DatasetDict
+from transformers import BertTokenizerFast
+
+import mlm_data
+from mlm_data import TokenCountingCollator, pack_blocks, padding_ratio, tokenize_splits
+
+WORDS = ["the", "cell", "model", "energy", "data", "water", "heat", "rate", "of", "and"]
+TEXTS = ["the cell", "the model of energy and water", "heat rate", "data " * 20, "water and heat and the rate of data"]
+
+
+# A tokenizer with a small vocabulary, without downloading one
+@pytest.fixture
+def tokenizer(tmp_path):
+    vocab_file = tmp_path / "vocab.txt"
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS) + "\n")
+    return BertTokenizerFast(vocab_file=str(vocab_file), do_lower_case=True)
+
+
+@pytest.fixture
+def splits():
+    return DatasetDict({"train": Dataset.from_dict({"body_text": TEXTS, "label": list(range(len(TEXTS)))}),
+                        "test": Dataset.from_dict({"body_text": TEXTS[:2], "label": [0, 1]})})
+
+
+def test_pack_blocks_drops_the_tail():
+    blocks = pack_blocks({"input_ids": [[2, 5, 3], [2, 6, 7, 3]], "special_tokens_mask": [[1, 0, 1], [1, 0, 0, 1]]}, 3)
+    assert blocks["input_ids"].tolist() == [[2, 5, 3], [2, 6, 7]]
+    assert blocks["special_tokens_mask"].tolist() == [[1, 0, 1], [1, 0, 0]]
+    assert blocks["attention_mask"].tolist() == [[1, 1, 1], [1, 1, 1]]
+
+
+def test_packed_blocks_are_the_concatenated_texts(tokenizer, splits):
+    tokenized = tokenize_splits(splits, tokenizer, "packed", block_size=8, num_proc=None)
+    assert sorted(tokenized["train"].column_names) == ["attention_mask", "input_ids", "special_tokens_mask"]
+    ids = np.array(tokenized["train"]["input_ids"])
+    assert ids.shape[1] == 8 and not (ids == tokenizer.pad_token_id).any()
+    concatenated = [token for text in TEXTS for token in tokenizer(text)["input_ids"]]
+    assert ids.ravel().tolist() == concatenated[:len(ids.ravel())]
+    assert padding_ratio(tokenized["train"], "packed", 2) == 0.0
+
+
+def test_grouped_texts_are_not_padded(tokenizer, splits):
+    tokenized = tokenize_splits(splits, tokenizer, "grouped", max_length=16, num_proc=None)
+    train = tokenized["train"]
+    assert train["length"] == [len(ids) for ids in train["input_ids"]]
+    assert max(train["length"]) == 16
+    assert all(tokenizer.pad_token_id not in ids for ids in train["input_ids"])
+
+
+def test_padded_ratio_counts_the_pad_tokens(tokenizer, splits):
+    tokenized = tokenize_splits(splits, tokenizer, "padded", max_length=16, num_proc=None)
+    ids = np.array(tokenized["train"]["input_ids"])
+    expected = float((ids == tokenizer.pad_token_id).mean())
+    assert padding_ratio(tokenized["train"], "padded", 2) == pytest.approx(expected)
+    assert expected > 0
+
+
+def test_grouped_ratio_and_collator_counts(tokenizer, splits):
+    pytest.importorskip("torch")
+    from transformers import DataCollatorForLanguageModeling
+
+    tokenized = tokenize_splits(splits, tokenizer, "grouped", max_length=16, num_proc=None)
+    assert 0.0 <= padding_ratio(tokenized["train"], "grouped", 2) < 1.0
+
+    collator = TokenCountingCollator(DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm_probability=0.15),
+                                     tokenizer.pad_token_id)
+    examples = [{"input_ids": ids} for ids in tokenized["train"]["input_ids"][:2]]
+    batch = collator(examples)
+    assert collator.real_tokens == sum(len(example["input_ids"]) for example in examples)
+    assert collator.total_tokens == batch["input_ids"].numel() == 2 * max(len(example["input_ids"]) for example in examples)
+
+
+# The Trainer is built with the arguments of the current transformers, on a tiny model
+def test_build_trainer_trains_and_logs_throughput(tokenizer, splits, tmp_path, monkeypatch):
+    pytest.importorskip("torch")
+    from transformers import DistilBertConfig, DistilBertForMaskedLM
+
+    def tiny_model(name, config):
+        return DistilBertForMaskedLM(DistilBertConfig(vocab_size=len(tokenizer), dim=16, hidden_dim=32, n_layers=1,
+                                                      n_heads=2, max_position_embeddings=64))
+    monkeypatch.setattr(mlm_data.AutoModelForMaskedLM, "from_pretrained", tiny_model)
+
+    tokenized = tokenize_splits(splits, tokenizer, "packed", block_size=8, num_proc=None)
+    trainer = mlm_data.build_trainer(tokenized, tokenizer, "packed", batch_size=2, epochs=1, output_dir=str(tmp_path / "model"))
+    assert trainer.args.eval_strategy == "epoch" and not trainer.args.fp16
+    trainer.train()
+    logs = [log for log in trainer.state.log_history if "tokens_per_second" in log]
+    assert logs and logs[-1]["padding_ratio"] == 0.0
+
+
+def test_build_trainer_groups_by_length(tokenizer, splits, tmp_path, monkeypatch):
+    pytest.importorskip("torch")
+    from transformers import DistilBertConfig, DistilBertForMaskedLM
+
+    monkeypatch.setattr(mlm_data.AutoModelForMaskedLM, "from_pretrained", lambda name, config: DistilBertForMaskedLM(
+        DistilBertConfig(vocab_size=len(tokenizer), dim=16, hidden_dim=32, n_layers=1, n_heads=2, max_position_embeddings=64)))
+    tokenized = tokenize_splits(splits, tokenizer, "grouped", max_length=16, num_proc=None)
+    trainer = mlm_data.build_trainer(tokenized, tokenizer, "grouped", batch_size=2, epochs=1, output_dir=str(tmp_path / "model"))
+    assert getattr(trainer.args, "train_sampling_strategy", None) == "group_by_length" or trainer.args.group_by_length
+    trainer.train()
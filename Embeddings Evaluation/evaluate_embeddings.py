@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# Evaluation of word vectors: GloVe vectors (vectors.txt, or vectors.bin with its
+# vocab.txt) or the embeddings of the words by a DistilBERT checkpoint.
+#
+# The vectors are loaded once as a matrix of unit rows (float32, or float16 to
+# halve the memory). Word similarity benchmarks ("word1 word2 score" lines) are
+# scored with the Spearman correlation of the cosines, and analogy benchmarks
+# (the questions-words.txt format, ": section" lines and "a b c d" questions) are
+# answered for blocks of questions at once: a matrix product of the queries with
+# the vocabulary, the words of the question masked, and argpartition for the
+# top-k answers.
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+parser = argparse.ArgumentParser(description="Script to evaluate word vectors on word similarity and analogy benchmarks.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-v", "--vectors", default="../Google Books Ngrams/glove_model/vectors.txt",
+                    help="GloVe vectors (.txt, or .bin with --vocab_file), or the folder of a DistilBERT checkpoint")
+parser.add_argument("--vocab_file", default="../Google Books Ngrams/glove_model/vocab.txt", help="vocabulary of a .bin file of GloVe, or the words embedded by a checkpoint")
+parser.add_argument("--store", default="embeddings", help="store of the embeddings of a checkpoint (see extract_embeddings.py)")
+parser.add_argument("-s", "--similarity", default="", help="word similarity files, comma separated")
+parser.add_argument("-a", "--analogy", default="", help="analogy files, comma separated")
+parser.add_argument("--method", default="add", choices=["add", "mul"], help="3CosAdd or 3CosMul for the analogies")
+parser.add_argument("-k", "--top_k", default=1, help="an analogy is right if the answer is in the top k words")
+parser.add_argument("--restrict_vocab", default=0, help="search the answers of the analogies only in the first words of the vocabulary (0 for all)")
+parser.add_argument("-b", "--block_size", default=256, help="analogy questions scored at once")
+parser.add_argument("--float16", action="store_true", help="keep the matrix in float16")
+
+
+# Function to give unit norm to the rows of a matrix (zero rows stay zero)
+def normalize(matrix, dtype=np.float32):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.where(norms == 0, 1, norms)).astype(dtype)
+
+
+# Function to read the words of vocab.txt ("word count" lines)
+def read_vocab(file_path):
+    with open(file_path, 'r', encoding="utf-8") as f:
+        return [line.rstrip("\n").rsplit(" ", 1)[0] for line in f]
+
+
+# Function to read the vectors of GloVe: a text file with "word v1 v2 ..." lines, or the binary file
+# with every parameter, whose word and context vectors are summed like the text file of GloVe
+def load_glove(file_path, vocab_file=None):
+    if file_path.endswith(".bin"):
+        words = read_vocab(vocab_file)
+        params = np.fromfile(file_path, dtype="<f8").reshape(2 * len(words), -1)
+        return words, params[:len(words), :-1] + params[len(words):, :-1]
+    words, rows = [], []
+    with open(file_path, 'r', encoding="utf-8") as f:
+        for line in f:
+            word, *values = line.rstrip("\n").split(" ")
+            words.append(word)
+            rows.append(np.array(values, dtype=np.float32))
+    return words, np.vstack(rows)
+
+
+# Function to embed the words with a DistilBERT checkpoint, reusing the store of embeddings
+def load_bert(model_dir, vocab_file, store_prefix):
+    from extract_embeddings import EmbeddingExtractor, EmbeddingStore
+
+    words = read_vocab(vocab_file)
+    extractor = EmbeddingExtractor(model_dir)
+    store = EmbeddingStore(store_prefix, extractor.dim)
+    return words, extractor.embed(words, store, verbose=print)
+
+
+class WordVectors:
+    def __init__(self, words, matrix, dtype=np.float32):
+        self.words = words
+        self.index = {word: i for i, word in enumerate(words)}
+        self.matrix = normalize(matrix, dtype)
+
+    @classmethod
+    def load(cls, source, vocab_file=None, store="embeddings", dtype=np.float32):
+        if os.path.isdir(source):
+            words, matrix = load_bert(source, vocab_file, store)
+        else:
+            words, matrix = load_glove(source, vocab_file)
+        return cls(words, matrix, dtype)
+
+    # Function to get the ids of the words, -1 for the words out of the vocabulary
+    def ids(self, words):
+        return np.array([self.index.get(word, -1) for word in words], dtype=np.int64)
+
+    # Function to compute the cosines of queries with the first n words. A float16 matrix is
+    # converted to float32 by blocks of the vocabulary (the product of float16 matrices is slow on CPU)
+    def scores(self, queries, n, block=65536):
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.matrix.dtype == np.float32:
+            return queries @ self.matrix[:n].T
+        scores = np.empty((len(queries), n), dtype=np.float32)
+        for start in range(0, n, block):
+            end = min(start + block, n)
+            scores[:, start:end] = queries @ self.matrix[start:end].astype(np.float32, copy=False).T
+        return scores
+
+
+# Function to rank with the mean rank of the ties, like scipy.stats.rankdata
+def rank(values):
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_values[1:] != sorted_values[:-1])))
+    ends = np.append(starts[1:], len(values))
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat((starts + ends + 1) / 2, ends - starts)
+    return ranks
+
+
+def spearman(x, y):
+    return float(np.corrcoef(rank(x), rank(y))[0, 1])
+
+
+# Function to read a word similarity file: "word1 word2 score" lines separated by tabs, spaces or commas.
+# Lines that do not end in a number (headers, comments) are skipped
+def read_similarity(file_path):
+    pairs, scores = [], []
+    with open(file_path, 'r', encoding="utf-8") as f:
+        for line in f:
+            fields = line.replace(",", " ").split()
+            if len(fields) < 3 or line.startswith("#"):
+                continue
+            try:
+                score = float(fields[2])
+            except ValueError:
+                continue
+            pairs.append((fields[0].lower(), fields[1].lower()))
+            scores.append(score)
+    return pairs, np.array(scores)
+
+
+def evaluate_similarity(vectors, file_path):
+    pairs, gold = read_similarity(file_path)
+    ids1 = vectors.ids([word1 for word1, _ in pairs])
+    ids2 = vectors.ids([word2 for _, word2 in pairs])
+    found = (ids1 >= 0) & (ids2 >= 0)
+    # Cosine of every pair at once, the rows have unit norm
+    m1 = vectors.matrix[ids1[found]].astype(np.float32)
+    m2 = vectors.matrix[ids2[found]].astype(np.float32)
+    cosines = np.einsum("ij,ij->i", m1, m2)
+    correlation = spearman(cosines, gold[found]) if found.sum() > 1 else float("nan")
+    return {"pairs": len(pairs), "found": int(found.sum()), "spearman": correlation}
+
+
+# Function to read an analogy file: ": section" lines, and "a b c d" questions (a is to b as c is to d)
+def read_analogies(file_path):
+    sections, questions = [], []
+    section = ""
+    with open(file_path, 'r', encoding="utf-8") as f:
+        for line in f:
+            fields = line.lower().split()
+            if not fields:
+                continue
+            if fields[0] == ":":
+                section = " ".join(fields[1:])
+            elif len(fields) == 4:
+                sections.append(section)
+                questions.append(fields)
+    return np.array(sections), questions
+
+
+# Function to answer blocks of analogy questions. 3CosAdd looks for the word closest to b - a + c,
+# 3CosMul for the one with the highest cos(d, b) * cos(d, c) / (cos(d, a) + epsilon), with the
+# cosines shifted to [0, 1]. Returns if each question was right
+def answer_analogies(vectors, ids, n, method="add", top_k=1, block_size=256):
+    right = np.zeros(len(ids), dtype=bool)
+    rows = np.arange(min(block_size, len(ids)))[:, None]
+    for start in range(0, len(ids), block_size):
+        block = ids[start:start + block_size]
+        a, b, c = (vectors.matrix[block[:, i]].astype(np.float32) for i in range(3))
+        if method == "add":
+            scores = vectors.scores(normalize(b - a + c), n)
+        else:
+            scores = (vectors.scores(b, n) + 1) / 2
+            scores *= (vectors.scores(c, n) + 1) / 2
+            scores /= (vectors.scores(a, n) + 1) / 2 + 1e-3
+        # The words of the question are not answers
+        block_rows = rows[:len(block)]
+        for i in range(3):
+            inside = block[:, i] < n
+            scores[block_rows[inside, 0], block[inside, i]] = -np.inf
+        if top_k == 1:
+            right[start:start + len(block)] = np.argmax(scores, axis=1) == block[:, 3]
+        else:
+            top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            right[start:start + len(block)] = (top == block[:, 3:4]).any(axis=1)
+    return right
+
+
+def evaluate_analogy(vectors, file_path, method="add", top_k=1, restrict_vocab=0, block_size=256):
+    sections, questions = read_analogies(file_path)
+    n = min(restrict_vocab, len(vectors.words)) if restrict_vocab else len(vectors.words)
+    ids = vectors.ids([word for question in questions for word in question]).reshape(-1, 4)
+    # Questions with a word out of the vocabulary, or an answer outside the searched words, are skipped
+    found = (ids >= 0).all(axis=1) & (ids[:, 3] < n)
+    right = answer_analogies(vectors, ids[found], n, method, top_k, block_size)
+
+    results = {"questions": len(questions), "found": int(found.sum()),
+               "accuracy": float(right.mean()) if len(right) else float("nan"), "sections": {}}
+    found_sections = sections[found] if len(sections) else sections
+    for section in dict.fromkeys(sections):
+        in_section = found_sections == section
+        results["sections"][str(section)] = (int(right[in_section].sum()), int(in_section.sum()))
+    return results
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+
+    start_time = time.perf_counter()
+    vectors = WordVectors.load(config["vectors"], config["vocab_file"], config["store"],
+                               np.float16 if config["float16"] else np.float32)
+    print("Loaded", vectors.matrix.shape[0], "vectors of dimension", vectors.matrix.shape[1],
+          "({}) in {:.1f}s".format(vectors.matrix.dtype, time.perf_counter() - start_time))
+
+    for file_path in filter(None, config["similarity"].split(",")):
+        start_time = time.perf_counter()
+        results = evaluate_similarity(vectors, file_path)
+        print("{}: spearman {:.4f} ({}/{} pairs) in {:.2f}s".format(
+            os.path.basename(file_path), results["spearman"], results["found"], results["pairs"], time.perf_counter() - start_time))
+
+    for file_path in filter(None, config["analogy"].split(",")):
+        start_time = time.perf_counter()
+        results = evaluate_analogy(vectors, file_path, config["method"], int(config["top_k"]),
+                                   int(config["restrict_vocab"]), int(config["block_size"]))
+        elapsed = time.perf_counter() - start_time
+        for section, (right, total) in results["sections"].items():
+            if total:
+                print("    {}: {:.4f} ({}/{})".format(section, right / total, right, total))
+        print("{}: accuracy {:.4f} ({}/{} questions) in {:.2f}s, {:,.0f} questions/s".format(
+            os.path.basename(file_path), results["accuracy"], results["found"], results["questions"], elapsed,
+            results["found"] / elapsed))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Extraction of sentence embeddings from the fine-tuned DistilBERT checkpoints, on CPU.
+#
+# The texts are tokenized once without padding and sorted by length, and every
+# batch takes texts of similar length up to a budget of tokens, padded only to
+# the longest text of the batch. The model runs under torch.inference_mode with
+# the number of threads given, and the embedding of a text is the pooling
+# (mean, cls or max) of the mean of the selected hidden layers.
+#
+# The embeddings are appended to a store of two files: "<store>.f16", the
+# float16 vectors, and "<store>.keys", the hash of the text and the extraction
+# settings of every row. A vector is written before its key, so every key has
+# its complete vector, and texts already in the store are never computed again.
+
+import argparse
+import hashlib
+import os
+import time
+
+import numpy as np
+
+KEY_SIZE = 16
+POOLINGS = ["mean", "cls", "max"]
+
+parser = argparse.ArgumentParser(description="Script to extract the embeddings of the texts of a file (one per line) with a DistilBERT checkpoint.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-m", "--model", default="model-elsevier (lr 5e-5)", help="folder of the checkpoint (model.safetensors, config.json and tokenizer)")
+parser.add_argument("-i", "--input_file", default="texts.txt", help="file with a text per line")
+parser.add_argument("-s", "--store", default="embeddings", help="prefix of the store of embeddings (<store>.f16 and <store>.keys)")
+parser.add_argument("-o", "--output", default=None, help="optional .npy file with the embeddings of the input, in its order")
+parser.add_argument("-l", "--layers", default="-1", help="hidden layers averaged, comma separated (0 is the embedding layer, -1 the last one)")
+parser.add_argument("-p", "--pooling", default="mean", choices=POOLINGS, help="pooling of the tokens of a text")
+parser.add_argument("-b", "--batch_tokens", default=8192, help="maximum number of tokens (padding included) of a batch")
+parser.add_argument("--max_length", default=512, help="texts are truncated to this number of tokens")
+parser.add_argument("-t", "--threads", default=os.cpu_count(), help="number of threads of torch")
+parser.add_argument("--quantize", action="store_true", help="run the linear layers with dynamic int8 quantization (faster on CPU, slightly different vectors)")
+
+
+# Function to hash a text with the settings that change its embedding
+def text_key(text, settings):
+    return hashlib.blake2b((settings + "\0" + text).encode("utf-8"), digest_size=KEY_SIZE).digest()
+
+
+class EmbeddingStore:
+    def __init__(self, prefix, dim):
+        self.vectors_file = prefix + ".f16"
+        self.keys_file = prefix + ".keys"
+        self.dim = dim
+        keys = b""
+        if os.path.exists(self.keys_file):
+            with open(self.keys_file, "rb") as f:
+                keys = f.read()
+        # A key being written when the run stopped is incomplete
+        n_rows = len(keys) // KEY_SIZE
+        self.rows = {keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]: i for i in range(n_rows)}
+        # Vectors written after the last key have no key, they are dropped
+        for file_path, size in ((self.keys_file, n_rows * KEY_SIZE), (self.vectors_file, n_rows * dim * 2)):
+            with open(file_path, "ab") as f:
+                f.truncate(size)
+        self.vectors = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    # Function to add the vectors of keys, at the end of both files
+    def append(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype="<f2")
+        with open(self.vectors_file, "ab") as f:
+            vectors.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.keys_file, "ab") as f:
+            f.write(b"".join(keys))
+        for key in keys:
+            self.rows[key] = len(self.rows)
+        self.vectors = None
+
+    # Function to read the vectors of keys, memory-mapping the store
+    def get(self, keys):
+        if self.vectors is None:
+            self.vectors = np.memmap(self.vectors_file, dtype="<f2", mode="r", shape=(len(self.rows), self.dim)) \
+                if self.rows else np.empty((0, self.dim), dtype="<f2")
+        return self.vectors[[self.rows[key] for key in keys]]
+
+
+# Function to split the texts in batches of similar length: sorted by length, a batch ends when
+# its padded size (number of texts x longest text) would exceed the budget of tokens
+def length_batches(lengths, batch_tokens):
+    order = np.argsort(lengths, kind="stable")
+    batches, batch = [], []
+    for i in order:
+        # The longest text of a sorted batch is the last one
+        if batch and (len(batch) + 1) * lengths[i] > batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class EmbeddingExtractor:
+    def __init__(self, model_dir, layers=(-1,), pooling="mean", max_length=512, threads=None, quantize=False):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        self.torch = torch
+        if threads:
+            torch.set_num_threads(int(threads))
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        # The weights of the masked LM checkpoint without its head
+        self.model = AutoModel.from_pretrained(model_dir, output_hidden_states=True)
+        self.model.eval()
+        if quantize:
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.layers = list(layers)
+        self.pooling = pooling
+        self.max_length = max_length
+        self.dim = self.model.config.dim
+        # Everything that changes the vectors is part of the key of a text
+        self.settings = "|".join([os.path.abspath(model_dir), ",".join(map(str, self.layers)), pooling,
+                                  str(max_length), "int8" if quantize else "fp32"])
+
+    def keys(self, texts):
+        return [text_key(text, self.settings) for text in texts]
+
+    # Function to compute the embeddings of a batch of tokenized texts
+    def embed_batch(self, encodings):
+        torch = self.torch
+        batch = self.tokenizer.pad({"input_ids": encodings}, padding="longest", return_tensors="pt")
+        with torch.inference_mode():
+            hidden_states = self.model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"]).hidden_states
+            hidden = torch.stack([hidden_states[layer] for layer in self.layers]).mean(0) if len(self.layers) > 1 \
+                else hidden_states[self.layers[0]]
+            mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            if self.pooling == "cls":
+                pooled = hidden[:, 0]
+            elif self.pooling == "max":
+                pooled = hidden.masked_fill(mask == 0, float("-inf")).max(1).values
+            else:
+                pooled = (hidden * mask).sum(1) / mask.sum(1)
+        return pooled.float().numpy()
+
+    # Function to compute the embeddings of the texts not in the store, adding them to it.
+    # Returns the number of texts computed
+    def extract(self, texts, store, batch_tokens=8192, verbose=print):
+        keys = self.keys(texts)
+        # Repeated texts are computed once
+        missing = {}
+        for text, key in zip(texts, keys):
+            if key not in store and key not in missing:
+                missing[key] = text
+        if not missing:
+            return 0
+
+        start_time = time.perf_counter()
+        encodings = self.tokenizer(list(missing.values()), truncation=True, max_length=self.max_length)["input_ids"]
+        lengths = np.array([len(ids) for ids in encodings])
+        missing_keys = list(missing.keys())
+        done, tokens = 0, 0
+        for batch in length_batches(lengths, batch_tokens):
+            vectors = self.embed_batch([encodings[i] for i in batch])
+            store.append([missing_keys[i] for i in batch], vectors)
+            done += len(batch)
+            tokens += int(lengths[batch].sum())
+            if verbose:
+                elapsed = time.perf_counter() - start_time
+                verbose("{:,}/{:,} texts, {:,.0f} texts/s, {:,.0f} tokens/s".format(
+                    done, len(missing), done / elapsed, tokens / elapsed), end="\r")
+        if verbose:
+            verbose()
+        return len(missing)
+
+    # Function to get the embeddings of the texts, in their order, computing the missing ones
+    def embed(self, texts, store, batch_tokens=8192, verbose=None):
+        self.extract(texts, store, batch_tokens, verbose)
+        return store.get(self.keys(texts))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+
+    with open(config["input_file"], "r", encoding="utf-8") as f:
+        texts = [line.rstrip("\n") for line in f]
+
+    extractor = EmbeddingExtractor(config["model"], layers=[int(layer) for layer in config["layers"].split(",")],
+                                   pooling=config["pooling"], max_length=int(config["max_length"]),
+                                   threads=config["threads"], quantize=config["quantize"])
+    store = EmbeddingStore(config["store"], extractor.dim)
+    print("Texts:", len(texts), "- already in the store:", sum(key in store for key in extractor.keys(texts)))
+
+    start_time = time.perf_counter()
+    computed = extractor.extract(texts, store, int(config["batch_tokens"]))
+    print("Computed", computed, "embeddings in {:.1f}s".format(time.perf_counter() - start_time))
+
+    if config["output"]:
+        np.save(config["output"], store.get(extractor.keys(texts)))
+        print("Embeddings saved to", config["output"])
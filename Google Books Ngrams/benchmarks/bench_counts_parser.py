@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Micro-benchmark of the year counts parser against the get_value function of the
+# download scripts. Lines are synthetic but follow the real "year,count,volumes" format.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from counts_parser import CountsParser
+
+parser = argparse.ArgumentParser(description="Benchmark of get_value against CountsParser (lines/second).",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-l", "--lines", default=200000, help="number of lines to parse")
+parser.add_argument("-b", "--batch_size", default=10000, help="lines parsed by each CountsParser call")
+parser.add_argument("-y", "--range_years", default="1900-2000", help="years range used by the range variant")
+args = parser.parse_args()
+config = vars(args)
+
+
+# get_value as it is in the download scripts
+def get_value_all(line):
+    occurrencies = 0
+    for entry in line:
+        value = int(entry.split(',')[1])
+        occurrencies += value
+    return occurrencies
+
+
+def make_get_value_range(range_years):
+    years = [int(year) for year in range_years.split("-")]
+
+    def get_value(line):
+        occurrencies = 0
+        for entry in line:
+            year = int(entry.split(',')[0])
+            if year >= min(years) and year <= max(years):
+                value = int(entry.split(',')[1])
+                occurrencies += value
+        return occurrencies
+    return get_value
+
+
+# Function to create lines with a realistic number of years per gram
+def synthetic_fields(n_lines, seed=23):
+    rng = random.Random(seed)
+    fields = []
+    for _ in range(n_lines):
+        years = sorted(rng.sample(range(1800, 2020), rng.randint(1, 60)))
+        fields.append("\t".join(str(year) + "," + str(rng.randint(1, 5000)) + "," + str(rng.randint(1, 50))
+                                for year in years).encode() + b"\n")
+    return fields
+
+
+def bench(name, function, n_lines):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {n_lines / elapsed:>14,.0f} lines/s")
+    return result
+
+
+n_lines = int(config["lines"])
+batch_size = int(config["batch_size"])
+fields = synthetic_fields(n_lines)
+
+for range_years, get_value in [(None, get_value_all), (config["range_years"], make_get_value_range(config["range_years"]))]:
+    label = "all years" if range_years is None else range_years
+    counts_parser = CountsParser(range_years)
+    print("Years:", label)
+    expected = bench("get_value", lambda: [get_value(field.decode('utf-8').split('\t')) for field in fields], n_lines)
+    result = bench("CountsParser.parse", lambda: [value for start in range(0, n_lines, batch_size)
+                                                   for value in counts_parser.parse(fields[start:start + batch_size]).tolist()], n_lines)
+    if result != expected:
+        raise SystemExit("CountsParser and get_value give different results")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Benchmark of glove_train.py against the glove tool of the GloVe submodule, on a
+# synthetic co-occurrence matrix with Zipf distributed words. The C tool is skipped
+# if it has not been built (glove_model/GloVe/build/glove).
+#
+# The records per second are not enough to compare them: glove_train.py averages the
+# steps of a word inside a minibatch, so a larger -b is faster but learns less per
+# iteration. The cost after every iteration is printed next to the speed, for every
+# batch size of -b.
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+from glove_io import write_records
+
+parser = argparse.ArgumentParser(description="Benchmark of the GloVe trainers (records/second and cost after every iteration).",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-k", "--vocab_size", default=20000, help="number of words of the synthetic vocabulary")
+parser.add_argument("-n", "--records", default=2000000, help="number of co-occurrence records")
+parser.add_argument("-d", "--vector_size", default=100, help="dimension of the vectors")
+parser.add_argument("--iter", default=3, help="number of iterations")
+parser.add_argument("-t", "--threads", default="1,4", help="numbers of processes/threads to compare")
+parser.add_argument("-b", "--batch_size", default="64,1024", help="records of every update of glove_train.py, comma separated to compare several")
+parser.add_argument("--glove_bin", default=os.path.join(root, "glove_model", "GloVe", "build", "glove"), help="glove tool built from the submodule")
+args = parser.parse_args()
+config = vars(args)
+
+
+# Function to write vocab.txt and a shuffled file of records with counts like a real matrix
+def synthetic_matrix(folder, vocab_size, n_records, seed=23):
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(folder, "vocab.txt"), "w") as f:
+        f.writelines("w" + str(word) + " " + str(vocab_size - word) + "\n" for word in range(vocab_size))
+    word1 = np.minimum(rng.zipf(1.3, n_records), vocab_size).astype(np.int32)
+    word2 = np.minimum(rng.zipf(1.3, n_records), vocab_size).astype(np.int32)
+    val = np.floor(rng.pareto(1.0, n_records) * 10) + 1
+    order = rng.permutation(n_records)
+    with open(os.path.join(folder, "cooccurrence.shuf.bin"), "wb") as f:
+        write_records(f, word1[order], word2[order], val[order])
+
+
+def run(name, command, folder, n_records, n_iter):
+    start = time.perf_counter()
+    output = subprocess.run(command, cwd=folder, capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - start
+    costs = re.findall(r"cost: ([0-9.]+)", output.stdout + output.stderr)
+    print(f"{name:<40} {n_records * n_iter / elapsed:>12,.0f} records/s   cost per iteration {' '.join(costs) if costs else '?'}")
+
+
+vocab_size, n_records = int(config["vocab_size"]), int(config["records"])
+vector_size, n_iter = int(config["vector_size"]), int(config["iter"])
+with tempfile.TemporaryDirectory() as folder:
+    synthetic_matrix(folder, vocab_size, n_records)
+    print("Vocab size:", vocab_size, "- records:", n_records, "- vector size:", vector_size, "- iterations:", n_iter)
+    for threads in config["threads"].split(","):
+        for batch_size in config["batch_size"].split(","):
+            run("glove_train.py, " + threads + " processes, -b " + batch_size,
+                [sys.executable, os.path.join(root, "glove_train.py"), "-i", "cooccurrence.shuf.bin", "--vocab_file", "vocab.txt",
+                 "-d", str(vector_size), "--iter", str(n_iter), "-t", threads, "-b", batch_size, "--binary", "1"],
+                folder, n_records, n_iter)
+        if os.path.exists(config["glove_bin"]):
+            run("glove (C), " + threads + " threads",
+                [config["glove_bin"], "-input-file", "cooccurrence.shuf.bin", "-vocab-file", "vocab.txt", "-save-file", "c_vectors",
+                 "-vector-size", str(vector_size), "-iter", str(n_iter), "-threads", threads, "-binary", "1", "-verbose", "2"],
+                folder, n_records, n_iter)
+    if not os.path.exists(config["glove_bin"]):
+        print("glove (C) skipped:", config["glove_bin"], "not found. Build it in glove_model/GloVe with make")
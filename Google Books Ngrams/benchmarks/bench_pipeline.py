@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# Benchmarks of the hot paths of the n-gram pipeline on synthetic shards (see
+# synthetic_shards.py), without downloading the real ones:
+#   get_value                    CountsParser.parse of the year counts of the lines
+#   update_occurrences           the counter updates with the batches of pairs of the shards
+#   process_file                 whole shards: decompression, tokens, pairs and counts
+#   merge_dicts                  the counters of the shards merged in memory
+#   merge_snapshots              the snapshots of the shards merged by streaming
+#   calculate_PMI                the PMI of the merged pairs, by chunks
+#   convert_cooccurrence_to_bin  the script, with the merged snapshot (and with a CSV, _csv)
+#   end_to_end                   download_and_process_n-grams.py (and the parallelized version,
+#                                _parallelized, or with 2 files prefetched, _prefetch) reading the
+#                                shards from a local HTTP server
+#
+# Every benchmark runs in a new process, so the peak memory is its own: the
+# maximum RSS of the process (VmHWM), or for the scripts the maximum RSS of the
+# script and its workers together, sampled every few milliseconds. The results
+# can be saved as JSON and compared with a baseline: a benchmark slower or with
+# more memory than the tolerance makes the script exit with an error.
+
+import argparse
+import functools
+import http.server
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psutil
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+import cooccurrence_engine as engine
+from checkpoint import DeltaCheckpoint
+from cooccurrence import CooccurrenceCounter, load_snapshot, load_snapshot_arrays, merge_snapshots, save_snapshot, unpack_keys
+from counts_parser import CountsParser
+from pmi import calculate_PMI, load_frequencies
+from shard_stream import ShardStream, shard_name
+from synthetic_shards import FIRST_FILES, TOTAL_FILES, SyntheticCorpus, write_corpus
+from token_resolver import TokenResolver
+
+parser = argparse.ArgumentParser(description="Benchmarks of the n-gram pipeline on synthetic shards (lines/second and peak memory).",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-n", "--n_gram", default=2, help="n-gram of the shards")
+parser.add_argument("-f", "--files", default=2, help="number of shards")
+parser.add_argument("-l", "--lines", default=200000, help="lines of every shard")
+parser.add_argument("-k", "--vocab_size", default=10000, help="words of the vocabulary")
+parser.add_argument("--universe", default=50000, help="number of distinct words of the shards")
+parser.add_argument("--skew", default=1.1, help="exponent of the Zipf distribution of the words")
+parser.add_argument("--invalid_ratio", default=0.05, help="fraction of invalid tokens")
+parser.add_argument("-y", "--range_years", default=None, help="years range of the counts (all the years if not specified)")
+parser.add_argument("-t", "--threads", default=2, help="worker processes of the parallelized script")
+parser.add_argument("-d", "--data", default=None, help="folder of the synthetic shards, kept between runs (a temporary folder if not specified)")
+parser.add_argument("-b", "--benchmarks", default=None, help="benchmarks to run, comma separated (all if not specified)")
+parser.add_argument("-r", "--repeat", default=1, help="runs of every benchmark, the fastest one is reported")
+parser.add_argument("-o", "--output", default=None, help="JSON file where the results are saved")
+parser.add_argument("--baseline", default=None, help="JSON file of an earlier run to compare with")
+parser.add_argument("--tolerance", default=0.2, help="fraction slower (or more memory) than the baseline reported as a regression")
+
+# Number of pairs of every chunk of calculate_PMI, like merge_and_PMI.py
+PMI_CHUNK = 1000000
+# Seconds between two samples of the memory of a script
+SAMPLE_INTERVAL = 0.01
+
+
+# Function to get the peak RSS of this process in bytes. ru_maxrss is not used because a new
+# process keeps the maximum of the process that started it, VmHWM starts again with the program
+def peak_rss():
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Function to set the state of the worker of cooccurrence_engine.py, like init_worker
+def configure_engine(data, work_dir):
+    vocab_dict = engine.read_dict_csv(data["vocab"])
+    engine.worker_config.update({
+        "n_gram": str(data["n"]),
+        "resolver": TokenResolver({key: idx + 1 for idx, key in enumerate(vocab_dict)}),
+        "counts_parser": CountsParser(data["range_years"]),
+        "progress_queue": None,
+        "year_buckets": None,
+        "checkpoint": DeltaCheckpoint(os.path.join(work_dir, "cooccurrence_info.cooc")),
+    })
+
+
+# Function to count the pairs of a shard with process_file. Returns the counter and the stats
+def count_shard(shard, num_file):
+    counter = CooccurrenceCounter()
+    with ShardStream(shard) as decompressed_file:
+        stats = engine.process_file(decompressed_file, counter, 0, num_file)
+    return counter, stats
+
+
+def bench_get_value(data, work_dir):
+    fields = []
+    for shard in data["shards"]:
+        with ShardStream(shard) as decompressed_file:
+            fields.extend(line.split(b"\t", 1)[1] for line in decompressed_file)
+    counts_parser = CountsParser(data["range_years"])
+    start_time = time.perf_counter()
+    for start in range(0, len(fields), engine.BATCH_SIZE):
+        counts_parser.parse(fields[start:start + engine.BATCH_SIZE])
+    return len(fields), "lines", time.perf_counter() - start_time
+
+
+def bench_update_occurrences(data, work_dir):
+    configure_engine(data, work_dir)
+    # The batches of process_file are kept instead of counted
+    batches = []
+    update_occurrences = engine.update_occurrences
+    engine.update_occurrences = lambda local_counter, pairs, fields, num_file=None: batches.append((pairs, fields))
+    try:
+        for num_file, shard in enumerate(data["shards"]):
+            count_shard(shard, num_file)
+    finally:
+        engine.update_occurrences = update_occurrences
+    counter = CooccurrenceCounter()
+    start_time = time.perf_counter()
+    for pairs, fields in batches:
+        engine.update_occurrences(counter, pairs, fields)
+    len(counter)
+    return sum(len(fields) for _, fields in batches), "lines", time.perf_counter() - start_time
+
+
+def bench_process_file(data, work_dir):
+    configure_engine(data, work_dir)
+    lines = 0
+    start_time = time.perf_counter()
+    for num_file, shard in enumerate(data["shards"]):
+        _, stats = count_shard(shard, num_file)
+        lines += stats["lines"]
+    return lines, "lines", time.perf_counter() - start_time
+
+
+def bench_merge_dicts(data, work_dir):
+    counters = [load_snapshot(snapshot) for snapshot in data["snapshots"]]
+    entries = sum(len(counter) for counter in counters)
+    start_time = time.perf_counter()
+    merged = CooccurrenceCounter()
+    for counter in counters:
+        merged.merge(counter)
+    len(merged)
+    return entries, "pairs", time.perf_counter() - start_time
+
+
+def bench_merge_snapshots(data, work_dir):
+    entries = sum(len(load_snapshot_arrays(snapshot)[0]) for snapshot in data["snapshots"])
+    start_time = time.perf_counter()
+    merge_snapshots(data["snapshots"], os.path.join(work_dir, "merged.cooc"))
+    return entries, "pairs", time.perf_counter() - start_time
+
+
+def bench_calculate_PMI(data, work_dir):
+    keys, counts = load_snapshot_arrays(data["merged"])
+    freq, total_words = load_frequencies(data["vocab"])
+    total_pairs = float(np.sum(counts, dtype=np.float64))
+    start_time = time.perf_counter()
+    for start in range(0, len(keys), PMI_CHUNK):
+        id_words1, id_words2 = unpack_keys(np.asarray(keys[start:start + PMI_CHUNK]))
+        calculate_PMI(id_words1, id_words2, np.asarray(counts[start:start + PMI_CHUNK]), freq, total_pairs, total_words)
+    return len(keys), "pairs", time.perf_counter() - start_time
+
+
+# Function to run a script of the repository, sampling the RSS of the script and of its workers.
+# Returns the seconds and the peak RSS
+def run_script(command, work_dir):
+    start_time = time.perf_counter()
+    script = subprocess.Popen([sys.executable] + command, cwd=work_dir, stdout=subprocess.DEVNULL)
+    process = psutil.Process(script.pid)
+    peak = 0
+    while script.poll() is None:
+        rss = 0
+        try:
+            for child in [process] + process.children(recursive=True):
+                rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+        peak = max(peak, rss)
+        time.sleep(SAMPLE_INTERVAL)
+    seconds = time.perf_counter() - start_time
+    if script.returncode:
+        raise Exception(os.path.basename(command[0]) + " exited with code " + str(script.returncode))
+    return seconds, peak
+
+
+def bench_convert_snapshot(data, work_dir):
+    seconds, peak = run_script([os.path.join(root, "convert_cooccurrence_to_bin.py"), "-i", data["merged"], "-o", "out.bin"], work_dir)
+    return data["pairs"], "pairs", seconds, peak
+
+
+def bench_convert_csv(data, work_dir):
+    seconds, peak = run_script([os.path.join(root, "convert_cooccurrence_to_bin.py"), "-i", data["csv"], "-o", "out.bin"], work_dir)
+    return data["pairs"], "pairs", seconds, peak
+
+
+# Function to run a download script in a new folder with the vocabulary, reading the shards from the server
+def run_end_to_end(data, work_dir, script, extra):
+    dir_years = data["range_years"] or "all_years"
+    os.makedirs(os.path.join(work_dir, dir_years))
+    shutil.copy(data["vocab"], os.path.join(work_dir, dir_years, "vocab_info.csv"))
+    command = [os.path.join(root, script), str(data["n"])] + extra + ["-v", "-s", str(data["first_file"]),
+               "-e", str(data["first_file"] + len(data["shards"])), "-u", data["url"]]
+    if data["range_years"]:
+        command += ["-y", data["range_years"]]
+    seconds, peak = run_script(command, work_dir)
+    if not os.path.exists(os.path.join(work_dir, dir_years, str(data["n"]) + "-gram", "cooccurrence_info.cooc")):
+        raise Exception(script + " did not write the co-occurrences")
+    return data["lines"], "lines", seconds, peak
+
+
+def bench_end_to_end(data, work_dir):
+    return run_end_to_end(data, work_dir, "download_and_process_n-grams.py", [])
+
+
+def bench_end_to_end_parallelized(data, work_dir):
+    return run_end_to_end(data, work_dir, "download_and_process_n-grams_parallelized.py", [str(data["threads"])])
+
+
+def bench_end_to_end_prefetch(data, work_dir):
+    return run_end_to_end(data, work_dir, "download_and_process_n-grams.py", ["-k", "2"])
+
+
+BENCHMARKS = {
+    "get_value": bench_get_value,
+    "update_occurrences": bench_update_occurrences,
+    "process_file": bench_process_file,
+    "merge_dicts": bench_merge_dicts,
+    "merge_snapshots": bench_merge_snapshots,
+    "calculate_PMI": bench_calculate_PMI,
+    "convert_cooccurrence_to_bin": bench_convert_snapshot,
+    "convert_cooccurrence_to_bin_csv": bench_convert_csv,
+    "end_to_end": bench_end_to_end,
+    "end_to_end_parallelized": bench_end_to_end_parallelized,
+    "end_to_end_prefetch": bench_end_to_end_prefetch,
+}
+
+
+# Function to run a benchmark in its own process, with its own folder. Benchmarks return the items
+# processed, their unit and the seconds, and the peak RSS if they run a script
+def run_benchmark(name, data, queue):
+    work_dir = tempfile.mkdtemp(dir=data["folder"])
+    try:
+        items, unit, seconds, *peak = BENCHMARKS[name](data, work_dir)
+        peak = peak[0] if peak else peak_rss()
+        queue.put({"items": items, "unit": unit, "seconds": seconds, "rate": items / seconds, "peak_rss_mb": peak / 1024 ** 2})
+    except Exception as e:
+        queue.put({"error": repr(e)})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def measure(name, data, repeat):
+    context = multiprocessing.get_context("spawn")
+    best = None
+    for _ in range(repeat):
+        queue = context.Queue()
+        process = context.Process(target=run_benchmark, args=(name, data, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        if "error" in result:
+            raise Exception(name + " failed: " + result["error"])
+        if best is None or result["seconds"] < best["seconds"]:
+            result["peak_rss_mb"] = max(result["peak_rss_mb"], best["peak_rss_mb"]) if best else result["peak_rss_mb"]
+            best = result
+        else:
+            best["peak_rss_mb"] = max(best["peak_rss_mb"], result["peak_rss_mb"])
+    return best
+
+
+# Function to write the synthetic shards (unless they are in the folder already), and the counts of every
+# shard, their merge and a CSV of the merged pairs used by the benchmarks of the later stages
+def prepare_data(config, folder):
+    n, files, n_lines = int(config["n_gram"]), int(config["files"]), int(config["lines"])
+    settings = {key: config[key] for key in ["n_gram", "files", "lines", "vocab_size", "universe", "skew", "invalid_ratio", "range_years"]}
+    settings_file = os.path.join(folder, "settings.json")
+    vocab = os.path.join(folder, "vocab_info.csv")
+    saved = None
+    if os.path.exists(settings_file):
+        with open(settings_file) as f:
+            saved = json.load(f)
+    if saved != settings:
+        corpus = SyntheticCorpus(int(config["universe"]), float(config["skew"]), float(config["invalid_ratio"]))
+        shards = write_corpus(corpus, folder, [n], files, n_lines, vocab, int(config["vocab_size"]))
+
+        configure_engine({"n": n, "vocab": vocab, "range_years": config["range_years"]}, folder)
+        snapshots = []
+        for num_file, shard in enumerate(shards):
+            counter, _ = count_shard(shard, num_file)
+            snapshots.append(os.path.join(folder, "shard" + str(num_file) + ".cooc"))
+            save_snapshot(snapshots[-1], counter)
+        merge_snapshots(snapshots, os.path.join(folder, "merged.cooc"))
+        keys, counts = load_snapshot_arrays(os.path.join(folder, "merged.cooc"))
+        id_words1, id_words2 = unpack_keys(np.asarray(keys))
+        np.savetxt(os.path.join(folder, "final_cooccurrence.csv"), np.column_stack((id_words1, id_words2, counts)),
+                   fmt=["%d", "%d", "%.6f"], delimiter=",")
+        with open(settings_file, "w") as f:
+            json.dump(settings, f)
+    first_file = FIRST_FILES[n]
+    return {"folder": folder, "n": n, "first_file": first_file, "range_years": config["range_years"], "vocab": vocab,
+            "shards": [os.path.join(folder, shard_name(str(n), num_file, TOTAL_FILES[n])) for num_file in range(first_file, first_file + files)],
+            "snapshots": [os.path.join(folder, "shard" + str(num_file) + ".cooc") for num_file in range(files)],
+            "merged": os.path.join(folder, "merged.cooc"), "csv": os.path.join(folder, "final_cooccurrence.csv"),
+            "pairs": len(load_snapshot_arrays(os.path.join(folder, "merged.cooc"))[0]),
+            "lines": files * n_lines, "threads": int(config["threads"])}
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# Function to serve the shards of a folder like storage.googleapis.com. Returns the server and its url
+def start_server(folder):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=folder))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:" + str(server.server_address[1]) + "/"
+
+
+# Function to compare the results with a baseline. Returns the regressions
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if result["rate"] < baseline[name]["rate"] * (1 - tolerance):
+            found.append("{}: {:,.0f} {}/s, baseline {:,.0f}".format(name, result["rate"], result["unit"], baseline[name]["rate"]))
+        if result["peak_rss_mb"] > baseline[name]["peak_rss_mb"] * (1 + tolerance):
+            found.append("{}: peak {:,.1f} MB, baseline {:,.1f} MB".format(name, result["peak_rss_mb"], baseline[name]["peak_rss_mb"]))
+    return found
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+    names = config["benchmarks"].split(",") if config["benchmarks"] else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise SystemExit("Unknown benchmark " + name + ". Options are " + str(list(BENCHMARKS)))
+
+    folder = config["data"] or tempfile.mkdtemp()
+    os.makedirs(folder, exist_ok=True)
+    try:
+        start_time = time.perf_counter()
+        data = prepare_data(config, folder)
+        server, data["url"] = start_server(folder)
+        print("{} shards of {}-grams, {} lines each ({:.1f}s to prepare) - {} merged pairs".format(
+            len(data["shards"]), data["n"], config["lines"], time.perf_counter() - start_time, data["pairs"]))
+
+        results = {}
+        for name in names:
+            result = measure(name, data, int(config["repeat"]))
+            results[name] = result
+            print(f"{name:<32} {result['rate']:>14,.0f} {result['unit']}/s {result['seconds']:>9.3f}s   peak {result['peak_rss_mb']:>8.1f} MB")
+        server.shutdown()
+    finally:
+        if not config["data"]:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    if config["output"]:
+        with open(config["output"], "w") as f:
+            json.dump(results, f, indent=1)
+    if config["baseline"]:
+        with open(config["baseline"]) as f:
+            found = regressions(results, json.load(f), float(config["tolerance"]))
+        for regression in found:
+            print("Regression:", regression)
+        if found:
+            raise SystemExit(1)
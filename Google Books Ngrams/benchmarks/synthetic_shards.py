@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# Synthetic shards of Google Books Ngrams, to run the scripts and the benchmarks
+# without downloading the real ones.
+#
+# The shards are gzip files named like the real ones (2-00085-of-00589.gz), with
+# the lines in the same format: the gram, a tab and tab separated
+# "year,match_count,volume_count" entries in ascending years. The tokens are
+# drawn from a Zipf distribution (the skew is the exponent) over a universe of
+# words, tagged words (house_NOUN) and standalone tags (_NOUN_). Some tokens are
+# capitalized or end with punctuation (Cat, cat,), and a ratio of them are
+# invalid (numbers, symbols) so their lines are rejected by the scripts.
+#
+# vocab_info.csv has the most frequent words of the universe, normalized and in
+# the format of download_and_process_vocab.py, so the rest of the universe is
+# out of the vocabulary.
+
+import argparse
+import csv
+import gzip
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from shard_stream import shard_name
+
+# Number of shards of every n-gram, and the first one without punctuation or numbers (like the scripts)
+TOTAL_FILES = {1: 24, 2: 589, 3: 6881, 4: 6668, 5: 19423}
+FIRST_FILES = {1: 6, 2: 85, 3: 671, 4: 515, 5: 1312}
+
+TAGS = ["NOUN", "VERB", "ADJ", "ADV", "PRON", "DET", "ADP", "NUM", "CONJ", "PRT"]
+# Tokens rejected by the pattern of token_resolver.py
+INVALID_TOKENS = [b"1984", b"--", b"'s", b"n't", b"%", b"3.5", b"abc123", b"&amp;", b"(", b"\xc2\xa3"]
+# Surface forms of every word: as it is, capitalized, and with punctuation at the end
+VARIANTS = 4
+VARIANT_PROBABILITIES = [0.85, 0.09, 0.04, 0.02]
+LETTERS = np.frombuffer(b"abcdefghijklmnopqrstuvwxyz", dtype=np.uint8)
+
+parser = argparse.ArgumentParser(description="Script to write synthetic shards and a vocab_info.csv in the format of Google Books Ngrams.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-o", "--output", default="synthetic_shards", help="folder of the shards")
+parser.add_argument("-n", "--n_grams", default="1,2", help="n-grams to write, comma separated")
+parser.add_argument("-f", "--files", default=2, help="number of shards of every n-gram, from the first one used by the scripts")
+parser.add_argument("-s", "--start_files", default=None, help="number of the first shard (by default the first one used by the scripts)")
+parser.add_argument("-l", "--lines", default=100000, help="lines of every shard")
+parser.add_argument("-k", "--vocab_size", default=10000, help="words of vocab_info.csv")
+parser.add_argument("--vocab", default=None, help="path of vocab_info.csv (by default in the output folder)")
+parser.add_argument("--universe", default=50000, help="number of distinct words the tokens are drawn from")
+parser.add_argument("--skew", default=1.1, help="exponent of the Zipf distribution of the words")
+parser.add_argument("--invalid_ratio", default=0.05, help="fraction of invalid tokens")
+parser.add_argument("--max_years", default=60, help="maximum number of year entries of a line")
+parser.add_argument("--seed", default=23, help="seed of the words and of the shards")
+parser.add_argument("--compresslevel", default=1, help="gzip compression level of the shards")
+
+
+# Function to make distinct lowercase words of 2 to 10 letters
+def random_words(rng, size):
+    words = {}
+    while len(words) < size:
+        lengths = rng.integers(2, 11, size)
+        letters = LETTERS[rng.integers(0, len(LETTERS), int(lengths.sum()))].tobytes()
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+            words.setdefault(letters[start:end], None)
+            if len(words) == size:
+                break
+    return list(words)
+
+
+class SyntheticCorpus:
+    def __init__(self, universe=50000, skew=1.1, invalid_ratio=0.05, max_years=60, seed=23):
+        self.invalid_ratio = invalid_ratio
+        self.max_years = max_years
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # A tenth of the universe are tagged forms of the words, and every tag is a token too
+        n_tagged = universe // 10
+        words = random_words(rng, universe - n_tagged - len(TAGS))
+        tagged = [words[i] + b"_" + TAGS[i % len(TAGS)].encode() for i in rng.choice(len(words), n_tagged, replace=False).tolist()]
+        tokens = words + tagged + [b"_" + tag.encode() + b"_" for tag in TAGS]
+        # The rank of every token (its position) is random, so tagged forms and tags are spread among the words
+        self.tokens = [tokens[i] for i in rng.permutation(len(tokens)).tolist()]
+        weights = 1.0 / np.arange(1, len(self.tokens) + 1) ** skew
+        self.probabilities = weights / weights.sum()
+        self.cdf = np.cumsum(self.probabilities)
+        surfaces = []
+        for token in self.tokens:
+            word, _, tag = token.partition(b"_")
+            capitalized = word.capitalize() + (b"_" + tag if tag else b"") if word else token
+            surfaces.extend([token, capitalized, token + b",", token + b"."])
+        self.surfaces = np.array(surfaces, dtype=object)
+
+    # Function to draw the ids of count tokens
+    def sample(self, rng, count):
+        return np.minimum(np.searchsorted(self.cdf, rng.random(count)), len(self.tokens) - 1)
+
+    # Function to make a pool of year fields ("year,count,volumes" entries joined by tabs)
+    def year_fields(self, rng, size):
+        fields = []
+        for n_years in rng.integers(1, self.max_years + 1, size).tolist():
+            years = np.sort(rng.choice(np.arange(1800, 2020), n_years, replace=False))
+            volumes = rng.integers(1, 50, n_years)
+            counts = volumes + np.floor(rng.pareto(1.2, n_years) * 10).astype(np.int64)
+            fields.append(b"\t".join(b"%d,%d,%d" % entry for entry in zip(years.tolist(), counts.tolist(), volumes.tolist())))
+        return fields
+
+    # Function to make the lines of a shard of n-grams
+    def lines(self, rng, n, n_lines):
+        ids = self.sample(rng, n_lines * n)
+        variants = rng.choice(VARIANTS, n_lines * n, p=VARIANT_PROBABILITIES)
+        tokens = self.surfaces[ids * VARIANTS + variants]
+        invalid = rng.random(n_lines * n) < self.invalid_ratio
+        tokens[invalid] = np.array(INVALID_TOKENS, dtype=object)[rng.integers(0, len(INVALID_TOKENS), int(invalid.sum()))]
+        grams = tokens.reshape(n_lines, n).tolist()
+        fields = self.year_fields(rng, min(n_lines, 4096))
+        field_ids = rng.integers(0, len(fields), n_lines).tolist()
+        return [b" ".join(gram) + b"\t" + fields[field_id] + b"\n" for gram, field_id in zip(grams, field_ids)]
+
+    # Function to write a shard named like the real ones. Every shard has its own seed, so it is
+    # the same whatever other shards are written. Most of the time goes to the compression, and
+    # the level does not change the speed of the decompression much. Returns its path
+    def write_shard(self, folder, n, num_file, n_lines, total_files=None, compresslevel=1):
+        rng = np.random.default_rng([self.seed, n, num_file])
+        file_path = os.path.join(folder, shard_name(str(n), num_file, total_files or TOTAL_FILES[n]))
+        with gzip.open(file_path, "wb", compresslevel=compresslevel) as f:
+            for start in range(0, n_lines, 100000):
+                f.write(b"".join(self.lines(rng, n, min(100000, n_lines - start))))
+        return file_path
+
+    # Function to write the vocab_size most frequent words like download_and_process_vocab.py: normalized
+    # (lowercase), sorted by frequency, after a first ",0" row. Frequencies are those of a corpus of total words
+    def write_vocab(self, file_path, vocab_size, total=10 ** 9):
+        vocab_size = min(vocab_size, len(self.tokens))
+        frequencies = np.floor(self.probabilities[:vocab_size] * total).astype(np.int64)
+        with open(file_path, "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(["", 0])
+            writer.writerows((token.lower().decode("ascii"), frequency)
+                             for token, frequency in zip(self.tokens[:vocab_size], frequencies.tolist()))
+        return file_path
+
+
+# Function to write the shards of every n-gram and the vocabulary. Returns the paths of the shards
+def write_corpus(corpus, folder, n_grams, files, n_lines, vocab_path, vocab_size, start_files=None, compresslevel=1):
+    os.makedirs(folder, exist_ok=True)
+    corpus.write_vocab(vocab_path, vocab_size)
+    paths = []
+    for n in n_grams:
+        first = FIRST_FILES[n] if start_files is None else start_files
+        for num_file in range(first, first + files):
+            paths.append(corpus.write_shard(folder, n, num_file, n_lines, compresslevel=compresslevel))
+    return paths
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+
+    corpus = SyntheticCorpus(int(config["universe"]), float(config["skew"]), float(config["invalid_ratio"]),
+                             int(config["max_years"]), int(config["seed"]))
+    vocab_path = config["vocab"] or os.path.join(config["output"], "vocab_info.csv")
+    paths = write_corpus(corpus, config["output"], [int(n) for n in config["n_grams"].split(",")], int(config["files"]),
+                         int(config["lines"]), vocab_path, int(config["vocab_size"]),
+                         int(config["start_files"]) if config["start_files"] else None, int(config["compresslevel"]))
+    print(len(paths), "shards written to", config["output"], "- vocabulary:", vocab_path)
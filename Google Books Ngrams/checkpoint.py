@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# Incremental checkpoints of the co-occurrence counter of a run.
+#
+# Instead of saving the whole counter after every shard, each shard appends its
+# own counts as a delta segment (a small snapshot, or a folder of bucket
+# snapshots) in the "<base>.deltas" folder, named by the number of the shard.
+# Writing a shard twice overwrites its segment, so a retried shard is never
+# counted twice. Compaction folds the segments into the base snapshot, in the
+# background or at the end of the run.
+#
+# Compaction first writes the list of segments it folds, then every part of
+# the base (the snapshot, or each bucket) with the number of the compaction as
+# its generation, and then removes the segments and the list. If it is
+# interrupted, the list is completed on the next compaction, skipping the
+# parts that already have that generation.
+#
+# With a memory budget, the counter of a shard that reaches it is spilled: saved
+# as a sorted run ("<segment>.run<n>") and cleared. The segment of the shard is
+# then the streaming merge of its runs. Compaction always merges by streaming,
+# reading a chunk of the base and of every segment at a time.
+
+import os
+import shutil
+import threading
+import time
+
+from cooccurrence import merge_chunk_size, merge_snapshots, snapshot_generation
+from year_buckets import YearBucketedCounter, new_counter, read_counter, remove_counter, save_counter
+
+FOLDING_FILE = "folding.txt"
+
+
+# Function to list the snapshots of a counter saved with save_counter, by part name
+# ("" for a single snapshot, the bucket file name for a folder of buckets)
+def counter_parts(path):
+    if os.path.isdir(path):
+        return {name: os.path.join(path, name) for name in os.listdir(path) if name.endswith(".cooc")}
+    if os.path.exists(path):
+        return {"": path}
+    return {}
+
+
+class DeltaCheckpoint:
+    def __init__(self, path, year_buckets=None, memory_budget=None):
+        self.path = path
+        self.deltas = path + ".deltas"
+        self.year_buckets = year_buckets
+        self.extension = ".buckets" if year_buckets else ".cooc"
+        # Bytes a counter can take before it is spilled, and the runs spilled of every tag
+        self.memory_budget = memory_budget
+        self.runs = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.error = None
+        # Called with the number of segments folded and the seconds of every compaction
+        self.on_compact = None
+
+    def segment_path(self, tag):
+        return os.path.join(self.deltas, str(tag).zfill(5) + self.extension)
+
+    # Function to spill the counter of a shard as a sorted run if it takes more than the budget.
+    # Returns True if it was spilled (and cleared)
+    def spill_if_full(self, tag, counter):
+        if self.memory_budget and counter.nbytes >= self.memory_budget:
+            self.spill(tag, counter)
+            return True
+        return False
+
+    def spill(self, tag, counter):
+        if not os.path.isdir(self.deltas):
+            os.makedirs(self.deltas, exist_ok=True)
+        runs = self.runs.setdefault(tag, [])
+        run = self.segment_path(tag) + ".run" + str(len(runs))
+        remove_counter(run)
+        save_counter(run, counter)
+        runs.append(run)
+        counter.clear()
+        return run
+
+    # Function to remove the runs spilled of a tag (a shard that failed)
+    def drop_runs(self, tag):
+        for run in self.runs.pop(tag, []):
+            remove_counter(run)
+
+    # Function to save the counts of a shard as its segment. The segment appears at once
+    # (a renamed file or folder), so it is either complete or missing. If the shard was
+    # spilled, the rest of the counter is one more run and the segment is the merge of the runs
+    def append(self, tag, counter):
+        if not os.path.isdir(self.deltas):
+            os.makedirs(self.deltas, exist_ok=True)
+        segment = self.segment_path(tag)
+        if tag in self.runs:
+            if len(counter):
+                self.spill(tag, counter)
+            runs = self.runs.pop(tag)
+            parts = {}
+            for run in runs:
+                for name, file_path in counter_parts(run).items():
+                    parts.setdefault(name, []).append(file_path)
+            if self.year_buckets:
+                tmp_path = segment + ".tmp"
+                remove_counter(tmp_path)
+                os.mkdir(tmp_path)
+                for name, files in parts.items():
+                    merge_snapshots(files, os.path.join(tmp_path, name), merge_chunk_size(self.memory_budget, len(files)))
+                remove_counter(segment)
+                os.rename(tmp_path, segment)
+            else:
+                merge_snapshots(parts.get("", []), segment, merge_chunk_size(self.memory_budget, len(runs)))
+            for run in runs:
+                remove_counter(run)
+        elif isinstance(counter, YearBucketedCounter):
+            tmp_path = segment + ".tmp"
+            remove_counter(tmp_path)
+            save_counter(tmp_path, counter)
+            remove_counter(segment)
+            os.rename(tmp_path, segment)
+        else:
+            save_counter(segment, counter)
+        return segment
+
+    # Function to list the (tag, path) of the segments not folded yet
+    def segments(self):
+        if not os.path.isdir(self.deltas):
+            return []
+        return sorted((int(name[:-len(self.extension)]), os.path.join(self.deltas, name))
+                      for name in os.listdir(self.deltas) if name.endswith(self.extension))
+
+    # Function to remove the segments whose tag is not in keep (like shards not marked as done),
+    # and the temporary files and runs of segments that were being written
+    def discard(self, keep):
+        with self.lock:
+            for tag, segment in self.segments():
+                if tag not in keep:
+                    remove_counter(segment)
+            if os.path.isdir(self.deltas):
+                for name in os.listdir(self.deltas):
+                    if name.endswith(".tmp") or ".run" in name:
+                        remove_counter(os.path.join(self.deltas, name))
+
+    def part_path(self, name):
+        return os.path.join(self.path, name) if name else self.path
+
+    # Highest generation of the parts of the base
+    def generation(self):
+        return max((snapshot_generation(file_path) for file_path in counter_parts(self.path).values()), default=0)
+
+    # Function to fold the segments into the base, saving the parts with this generation.
+    # Every part is the streaming merge of the base part and the segments
+    def fold(self, generation, segments):
+        parts = {}
+        for segment in segments:
+            for name, file_path in counter_parts(segment).items():
+                parts.setdefault(name, []).append(file_path)
+        if self.year_buckets and not os.path.isdir(self.path):
+            os.mkdir(self.path)
+
+        for name, files in parts.items():
+            target = self.part_path(name)
+            if os.path.exists(target):
+                if snapshot_generation(target) == generation:
+                    # Already folded by an interrupted compaction
+                    continue
+                files = [target] + files
+            merge_snapshots(files, target, merge_chunk_size(self.memory_budget, len(files)), generation)
+
+        for segment in segments:
+            remove_counter(segment)
+        os.remove(os.path.join(self.deltas, FOLDING_FILE))
+
+    # Function to complete a compaction that was interrupted
+    def recover(self):
+        folding_file = os.path.join(self.deltas, FOLDING_FILE)
+        if os.path.exists(folding_file):
+            with open(folding_file) as f:
+                generation, *segments = f.read().split("\n")
+            self.fold(int(generation), [segment for segment in segments if os.path.exists(segment)])
+
+    # Function to fold the segments into the base. Only the segments of tags are folded if given.
+    # Returns the number of segments folded
+    def compact(self, tags=None):
+        with self.lock:
+            self.recover()
+            segments = [segment for tag, segment in self.segments() if tags is None or tag in tags]
+            if not segments:
+                return 0
+            start_time = time.perf_counter()
+            generation = self.generation() + 1
+            folding_file = os.path.join(self.deltas, FOLDING_FILE)
+            with open(folding_file + ".tmp", "w") as f:
+                f.write("\n".join([str(generation)] + segments))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(folding_file + ".tmp", folding_file)
+            self.fold(generation, segments)
+            if self.on_compact is not None:
+                self.on_compact(len(segments), time.perf_counter() - start_time)
+            return len(segments)
+
+    # Function to run compact in a background thread, unless one is still running
+    def compact_async(self, tags=None):
+        if self.thread is not None and self.thread.is_alive():
+            return False
+        self.raise_error()
+        self.thread = threading.Thread(target=self.compact_background, args=(tags,))
+        self.thread.start()
+        return True
+
+    def compact_background(self, tags):
+        try:
+            self.compact(tags)
+        except Exception as e:
+            self.error = e
+
+    # Function to wait for the background compaction, raising its error if it failed
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    # Function to read the whole counter, after folding every segment
+    def load(self):
+        self.wait()
+        self.compact()
+        if os.path.exists(self.path):
+            return read_counter(self.path)
+        return new_counter(self.year_buckets)
+
+    # Function to remove the base and every segment
+    def reset(self):
+        self.wait()
+        remove_counter(self.path)
+        if os.path.isdir(self.deltas):
+            shutil.rmtree(self.deltas)
@@ -1,20 +1,61 @@
-import struct
+#!/usr/bin/env python3
+import argparse
+import numpy as np
 import pandas as pd
+from cooccurrence import is_snapshot, load_snapshot_arrays, unpack_keys
+from glove_io import is_columnar, open_columnar, write_records
+from pipeline_metrics import PipelineMetrics
 
+parser = argparse.ArgumentParser(description="Script to convert co-occurrences (CSV, columnar folder or binary snapshot) into the binary format used by GloVe.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-i", "--input", default="final_cooccurrence.csv", help="CSV file with id1,id2,value rows, a columnar folder written by merge_and_PMI.py or a .cooc snapshot")
+parser.add_argument("-o", "--output", default="new_cooccurrence.bin", help="path to the binary file")
+parser.add_argument("-c", "--chunk_size", default=1000000, help="number of records converted at once. It bounds the memory used")
+parser.add_argument("--metrics", default=None, help="file where the metrics of the stages are written as JSON lines (or a Prometheus textfile if it ends in .prom)")
+args = parser.parse_args()
+config = vars(args)
+metrics = PipelineMetrics("convert_cooccurrence_to_bin", config["metrics"])
 
-data = pd.read_csv("final_cooccurrence.csv", header=None, names=["col1", "col2", "col3"])
+chunk_size = int(config["chunk_size"])
 
-data = list(data.itertuples(index=False, name=None))
 
-# Path to the binary file
-binary_file_path = "new_cooccurrence.bin"
+# Function to read the CSV in bounded chunks
+def csv_chunks(file_path):
+    reader = pd.read_csv(file_path, header=None, names=["col1", "col2", "col3"],
+                         dtype={"col1": np.int32, "col2": np.int32, "col3": np.float64}, chunksize=chunk_size)
+    for chunk in reader:
+        yield chunk["col1"].to_numpy(), chunk["col2"].to_numpy(), chunk["col3"].to_numpy()
 
-# Open the binary file in write mode
-with open(binary_file_path, "wb") as bin_file:
-    # Iterate over each tuple of human-readable data
-    for data_tuple in data:
-        # Pack the data into binary format
-        binary_data = struct.pack('iid', *data_tuple)
-        
-        # Write the binary data to the file
-        bin_file.write(binary_data)
\ No newline at end of file
+
+# Function to read a snapshot (memory-mapped) in bounded chunks, the counts are the values
+def snapshot_chunks(file_path):
+    keys, counts = load_snapshot_arrays(file_path)
+    for start in range(0, len(keys), chunk_size):
+        word1, word2 = unpack_keys(np.asarray(keys[start:start + chunk_size]))
+        yield word1, word2, np.asarray(counts[start:start + chunk_size], dtype=np.float64)
+
+
+# Function to read the columnar output of merge_and_PMI.py (memory-mapped) in bounded chunks
+def columnar_chunks(path):
+    word1, word2, val = open_columnar(path)
+    for start in range(0, len(val), chunk_size):
+        yield word1[start:start + chunk_size], word2[start:start + chunk_size], val[start:start + chunk_size]
+
+
+if is_columnar(config["input"]):
+    chunks = columnar_chunks(config["input"])
+elif is_snapshot(config["input"]):
+    chunks = snapshot_chunks(config["input"])
+else:
+    chunks = csv_chunks(config["input"])
+
+# Open the binary file in write mode and write every chunk as it is read
+total = 0
+with metrics.stage("convert"), open(config["output"], "wb") as bin_file:
+    for word1, word2, val in chunks:
+        written = write_records(bin_file, word1, word2, val)
+        metrics.add(records=written)
+        total += written
+
+print(total, "records written to", config["output"])
+metrics.close()
@@ -1,10 +1,20 @@
+import argparse
 import csv
+from pipeline_metrics import PipelineMetrics
+
+parser = argparse.ArgumentParser(description="Script to convert vocab_info.csv into the vocab.txt used by GloVe.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--metrics", default=None, help="file where the metrics of the stages are written as JSON lines (or a Prometheus textfile if it ends in .prom)")
+config = vars(parser.parse_args())
+metrics = PipelineMetrics("convert_vocab_to_txt", config["metrics"])
 
 with open("vocab_info.csv", 'r') as csv_file:
     csv_reader = csv.reader(csv_file)
     vocab = list(csv_reader)
 
 # Replace commas with spaces and write to a new text file
-with open("vocab.txt", 'w') as txt_file:
+with metrics.stage("convert"), open("vocab.txt", 'w') as txt_file:
     for row in vocab[:100000]:
-        txt_file.write(" ".join(row) + "\n")
\ No newline at end of file
+        txt_file.write(" ".join(row) + "\n")
+metrics.add(words=min(len(vocab), 100000))
+metrics.close()
\ No newline at end of file
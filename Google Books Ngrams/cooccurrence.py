@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# Compact co-occurrence accumulator.
+#
+# A dict of tuples takes well over 100 bytes per pair. Here every (id1, id2) pair,
+# with id1 <= id2, is packed in a single 64-bit key and the counts live in an
+# open-addressing hash table made of two NumPy arrays (16 bytes per slot).
+# Single pairs are buffered and inserted in bulk, already aggregated.
+#
+# Counters are saved as binary snapshots: a 32-byte header followed by the sorted
+# keys (uint64) and their counts (int64), little endian. They can be memory-mapped
+# and loaded without any per-row Python work.
+#
+# Sorted snapshots are merged by streaming: merge_snapshots reads a chunk of every
+# input at a time (a k-way merge), so merging runs of counts spilled to disk, or
+# the delta segments of a checkpoint, takes memory for the chunks only.
+#
+# A merged folder keeps the fingerprint of its inputs (names, sizes and
+# modification times) in "<merged>.inputs", so it is merged again only when
+# they change.
+
+import csv
+import hashlib
+import json
+import os
+import shutil
+import struct
+from array import array
+
+import numpy as np
+
+# Key 0 marks an empty slot: word ids start at 1, so no real pair is packed as 0
+EMPTY = np.uint64(0)
+SHIFT = np.uint64(32)
+LOW_MASK = np.uint64(0xFFFFFFFF)
+# Fibonacci hashing constant (2^64 / golden ratio)
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+MAX_LOAD = 0.7
+
+# Snapshot header: magic, version, flags, number of entries, generation (the last
+# compaction of delta segments folded into it, see checkpoint.py)
+SNAPSHOT_MAGIC = b"COOCSNAP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sIIQQ")
+
+# Entries of every input read at once by merge_snapshots, and the bytes a merge takes per
+# entry read (the chunks, their concatenation, the argsort and the sorted copies)
+MERGE_CHUNK = 1 << 20
+MERGE_BYTES_PER_ENTRY = 48
+
+
+# Function to pack id pairs in ordered 64-bit keys (smaller id in the high half)
+def pack_pairs(id_words1, id_words2):
+    id_words1 = np.asarray(id_words1, dtype=np.uint64)
+    id_words2 = np.asarray(id_words2, dtype=np.uint64)
+    return (np.minimum(id_words1, id_words2) << SHIFT) | np.maximum(id_words1, id_words2)
+
+
+def unpack_keys(keys):
+    return (keys >> SHIFT).astype(np.int64), (keys & LOW_MASK).astype(np.int64)
+
+
+# Function to sum the counts of repeated keys with a single sort. Returns sorted unique keys
+def aggregate(keys, counts):
+    if len(keys) == 0:
+        return np.asarray(keys, dtype=np.uint64), np.asarray(counts, dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    keys, counts = keys[order], counts[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+class CooccurrenceCounter:
+    def __init__(self, capacity=1 << 16, buffer_size=1 << 18):
+        bits = max(int(np.ceil(np.log2(max(capacity, 2)))), 4)
+        self._allocate(bits)
+        self.buffer_size = buffer_size
+        self._buffer_keys = array("Q")
+        self._buffer_counts = array("q")
+
+    def _allocate(self, bits):
+        self._bits = bits
+        self._mask = np.uint64((1 << bits) - 1)
+        self._keys = np.zeros(1 << bits, dtype=np.uint64)
+        self._counts = np.zeros(1 << bits, dtype=np.int64)
+        self._size = 0
+
+    def _slots(self, keys):
+        return (keys * HASH_MULTIPLIER) >> np.uint64(64 - self._bits)
+
+    def _grow(self, needed):
+        bits = self._bits
+        while needed > MAX_LOAD * (1 << bits):
+            bits += 1
+        if bits != self._bits:
+            old_keys, old_counts = self._occupied()
+            self._allocate(bits)
+            self._insert(old_keys, old_counts)
+
+    def _occupied(self):
+        used = self._keys != EMPTY
+        return self._keys[used], self._counts[used]
+
+    # Insert unique keys with linear probing, all of them at once
+    def _insert(self, keys, counts):
+        slots = self._slots(keys)
+        pending = np.arange(len(keys))
+        while len(pending):
+            pending_slots = slots[pending]
+            table_keys = self._keys[pending_slots]
+            found = table_keys == keys[pending]
+            self._counts[pending_slots[found]] += counts[pending[found]]
+
+            # Several keys may want the same empty slot: the first one gets it, the rest retry
+            empty = np.flatnonzero(table_keys == EMPTY)
+            _, first = np.unique(pending_slots[empty], return_index=True)
+            winners = empty[first]
+            self._keys[pending_slots[winners]] = keys[pending[winners]]
+            self._counts[pending_slots[winners]] = counts[pending[winners]]
+            self._size += len(winners)
+
+            done = found.copy()
+            done[winners] = True
+            collided = ~found & (table_keys != EMPTY)
+            slots[pending[collided]] = (pending_slots[collided] + np.uint64(1)) & self._mask
+            pending = pending[~done]
+
+    # Bulk add of packed keys (repeated keys are allowed)
+    def add_keys(self, keys, counts):
+        keys, counts = aggregate(np.asarray(keys, dtype=np.uint64), np.asarray(counts, dtype=np.int64))
+        if len(keys) == 0:
+            return
+        self._grow(self._size + len(keys))
+        self._insert(keys, counts)
+
+    def add_pairs(self, id_words1, id_words2, counts):
+        self.add_keys(pack_pairs(id_words1, id_words2), counts)
+
+    # Add the pairs of a batch of lines. pairs is an array("q") of (id_word1, id_word2, line)
+    # triplets and fields the counts part of every line, summed by counts_parser
+    def add_lines(self, pairs, fields, counts_parser):
+        occurrencies = counts_parser.parse(fields)
+        pairs = np.frombuffer(pairs, dtype=np.int64).reshape(-1, 3)
+        self.add_pairs(pairs[:, 0], pairs[:, 1], occurrencies[pairs[:, 2]])
+
+    # Add a single pair. It is buffered and inserted together with the next ones
+    def add(self, id_word1, id_word2, value):
+        if id_word1 <= id_word2:
+            self._buffer_keys.append((id_word1 << 32) | id_word2)
+        else:
+            self._buffer_keys.append((id_word2 << 32) | id_word1)
+        self._buffer_counts.append(value)
+        if len(self._buffer_keys) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer_keys):
+            keys = np.frombuffer(self._buffer_keys, dtype=np.uint64).copy()
+            counts = np.frombuffer(self._buffer_counts, dtype=np.int64).copy()
+            self._buffer_keys = array("Q")
+            self._buffer_counts = array("q")
+            self.add_keys(keys, counts)
+
+    def merge(self, other):
+        keys, counts = other.to_arrays()
+        self.add_keys(keys, counts)
+        return self
+
+    def get(self, id_word1, id_word2, default=0):
+        self.flush()
+        key = pack_pairs([id_word1], [id_word2])
+        slot = self._slots(key)[0]
+        while self._keys[slot] != EMPTY:
+            if self._keys[slot] == key[0]:
+                return int(self._counts[slot])
+            slot = (slot + np.uint64(1)) & self._mask
+        return default
+
+    # Sorted keys and their counts
+    def to_arrays(self):
+        self.flush()
+        keys, counts = self._occupied()
+        order = np.argsort(keys)
+        return keys[order], counts[order]
+
+    @classmethod
+    def from_arrays(cls, keys, counts):
+        counter = cls(capacity=int(len(keys) / MAX_LOAD) + 1)
+        counter.add_keys(keys, counts)
+        return counter
+
+    # Iterate over (id_word1, id_word2, count) in key order
+    def items(self):
+        keys, counts = self.to_arrays()
+        id_words1, id_words2 = unpack_keys(keys)
+        return zip(id_words1.tolist(), id_words2.tolist(), counts.tolist())
+
+    def clear(self):
+        self._allocate(4)
+        self._buffer_keys = array("Q")
+        self._buffer_counts = array("q")
+
+    def __len__(self):
+        self.flush()
+        return self._size
+
+    @property
+    def nbytes(self):
+        return self._keys.nbytes + self._counts.nbytes + self._buffer_keys.itemsize * len(self._buffer_keys) * 2
+
+    # Pickle only the occupied entries, as two flat arrays
+    def __getstate__(self):
+        keys, counts = self.to_arrays()
+        return {"keys": keys, "counts": counts, "buffer_size": self.buffer_size}
+
+    def __setstate__(self, state):
+        self.__init__(capacity=int(len(state["keys"]) / MAX_LOAD) + 1, buffer_size=state["buffer_size"])
+        self.add_keys(state["keys"], state["counts"])
+
+
+# Function to read a co-occurrence CSV ("(id1, id2)",count rows) without eval
+def read_cooccurrence_csv(file_path):
+    id_words1, id_words2, counts = array("q"), array("q"), array("q")
+    with open(file_path, 'r') as file:
+        reader = csv.reader(file)
+        for row in reader:
+            id_word1, id_word2 = row[0].strip("()").split(",")
+            id_words1.append(int(id_word1))
+            id_words2.append(int(id_word2))
+            counts.append(int(row[1]))
+    counter = CooccurrenceCounter(capacity=int(len(counts) / MAX_LOAD) + 1)
+    counter.add_pairs(np.frombuffer(id_words1, dtype=np.int64), np.frombuffer(id_words2, dtype=np.int64),
+                      np.frombuffer(counts, dtype=np.int64))
+    return counter
+
+
+def write_cooccurrence_csv(file_path, counter):
+    with open(file_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerows(("(%d, %d)" % (id_word1, id_word2), count) for id_word1, id_word2, count in counter.items())
+
+
+# Function to save a counter as a binary snapshot. It is written to a temporary file and
+# renamed, so a crash while saving never leaves a half written snapshot behind
+def save_snapshot(file_path, counter, generation=0):
+    if isinstance(counter, CooccurrenceCounter):
+        keys, counts = counter.to_arrays()
+    else:
+        keys, counts = counter
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(keys), generation))
+        np.ascontiguousarray(keys, dtype="<u8").tofile(f)
+        np.ascontiguousarray(counts, dtype="<i8").tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def is_snapshot(file_path):
+    with open(file_path, "rb") as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def snapshot_generation(file_path):
+    with open(file_path, "rb") as f:
+        return SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))[4]
+
+
+# Function to read the sorted (keys, counts) arrays of a snapshot, memory-mapped by default
+def load_snapshot_arrays(file_path, mmap=True):
+    with open(file_path, "rb") as f:
+        magic, version, _, size, _ = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(file_path + " is not a co-occurrence snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version " + str(version) + " in " + file_path)
+    if size == 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    offset = SNAPSHOT_HEADER.size
+    if mmap:
+        keys = np.memmap(file_path, dtype="<u8", mode="r", offset=offset, shape=(size,))
+        counts = np.memmap(file_path, dtype="<i8", mode="r", offset=offset + 8 * size, shape=(size,))
+    else:
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            keys = np.fromfile(f, dtype="<u8", count=size)
+            counts = np.fromfile(f, dtype="<i8", count=size)
+    return keys, counts
+
+
+def load_snapshot(file_path):
+    keys, counts = load_snapshot_arrays(file_path)
+    return CooccurrenceCounter.from_arrays(np.asarray(keys), np.asarray(counts))
+
+
+# Function to read co-occurrences either from a snapshot or from a legacy CSV file
+def read_cooccurrence(file_path):
+    if is_snapshot(file_path):
+        return load_snapshot(file_path)
+    return read_cooccurrence_csv(file_path)
+
+
+# Function to get the entries read from every input of a merge that fit in a memory budget (bytes)
+def merge_chunk_size(memory_budget, inputs):
+    if not memory_budget:
+        return MERGE_CHUNK
+    return max(int(memory_budget) // (MERGE_BYTES_PER_ENTRY * max(inputs, 1)), 1024)
+
+
+# Function to merge sorted snapshots into one, reading chunk_size entries of every input at a time.
+# All the keys up to the smallest last key of the chunks are complete, so they are summed and
+# written, and every input advances past them. The keys are written after the header and the
+# counts to a temporary file appended at the end, then the header gets the number of entries
+def merge_snapshots(file_paths, output_path, chunk_size=MERGE_CHUNK, generation=0):
+    sources = [load_snapshot_arrays(file_path) for file_path in file_paths]
+    positions = [0] * len(sources)
+    tmp_path = output_path + ".tmp"
+    counts_path = output_path + ".counts.tmp"
+    size = 0
+    with open(tmp_path, "wb") as f, open(counts_path, "wb+") as counts_file:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, 0, generation))
+        while True:
+            chunks = []
+            bound = None
+            for num_source, (keys, counts) in enumerate(sources):
+                position = positions[num_source]
+                if position >= len(keys):
+                    continue
+                chunk_keys = np.asarray(keys[position:position + chunk_size])
+                chunks.append((num_source, chunk_keys, np.asarray(counts[position:position + chunk_size])))
+                # The keys of an input after its chunk are all above its last key
+                if position + chunk_size < len(keys) and (bound is None or chunk_keys[-1] < bound):
+                    bound = chunk_keys[-1]
+            if not chunks:
+                break
+            selected_keys, selected_counts = [], []
+            for num_source, chunk_keys, chunk_counts in chunks:
+                end = len(chunk_keys) if bound is None else int(np.searchsorted(chunk_keys, bound, side="right"))
+                selected_keys.append(chunk_keys[:end])
+                selected_counts.append(chunk_counts[:end])
+                positions[num_source] += end
+            keys, counts = aggregate(np.concatenate(selected_keys), np.concatenate(selected_counts))
+            del chunks, selected_keys, selected_counts
+            np.ascontiguousarray(keys, dtype="<u8").tofile(f)
+            np.ascontiguousarray(counts, dtype="<i8").tofile(counts_file)
+            size += len(keys)
+        counts_file.seek(0)
+        shutil.copyfileobj(counts_file, f, 1 << 24)
+        f.seek(0)
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, size, generation))
+        f.flush()
+        os.fsync(f.fileno())
+    del sources
+    os.remove(counts_path)
+    os.replace(tmp_path, output_path)
+    return size
+
+
+# Function to merge the co-occurrence files of a folder into a single snapshot. Snapshots are merged
+# by streaming, CSV files (the old format) are loaded and saved as one more snapshot first
+def merge_folder(input_dir, output_path, verbose=print, memory_budget=None):
+    files = sorted(os.listdir(input_dir))
+    verbose(files)
+    snapshots = []
+    legacy = CooccurrenceCounter()
+    for file in files:
+        file_path = os.path.join(input_dir, file)
+        if is_snapshot(file_path):
+            snapshots.append(file_path)
+        else:
+            counter = read_cooccurrence_csv(file_path)
+            legacy.merge(counter)
+            counter.clear()
+            verbose("Dict loaded:", file)
+    legacy_path = output_path + ".csv.cooc"
+    if len(legacy):
+        save_snapshot(legacy_path, legacy)
+        snapshots.append(legacy_path)
+    del legacy
+    verbose("Merging", len(snapshots), "snapshots")
+    merge_snapshots(snapshots, output_path, merge_chunk_size(memory_budget, len(snapshots)))
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+
+# Function to get the fingerprint of the files of a folder to merge: their names, sizes and modification times
+def folder_fingerprint(input_dir):
+    files = []
+    for file in sorted(os.listdir(input_dir)):
+        stat = os.stat(os.path.join(input_dir, file))
+        files.append([file, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps([os.path.abspath(input_dir), files]).encode("utf-8")).hexdigest()
+
+
+# Function to merge a folder unless output_path was merged from the same files (or reuse is given
+# and it exists). Returns True if the folder was merged
+def merge_folder_if_changed(input_dir, output_path, verbose=print, memory_budget=None, reuse=False):
+    fingerprint_path = output_path + ".inputs"
+    if os.path.exists(output_path):
+        if reuse:
+            verbose("Reusing merged counts from", output_path)
+            return False
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path) as f:
+                if f.read() == folder_fingerprint(input_dir):
+                    verbose("Reusing merged counts from", output_path, "(same files in", input_dir + ")")
+                    return False
+        verbose("Merged counts in", output_path, "do not match the files in", input_dir + ", merging again")
+    if os.path.exists(fingerprint_path):
+        os.remove(fingerprint_path)
+    merge_folder(input_dir, output_path, verbose, memory_budget)
+    with open(fingerprint_path, "w") as f:
+        f.write(folder_fingerprint(input_dir))
+    return True
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Worker side of download_and_process_n-grams_parallelized.py.
+#
+# Parsing the shards is pure Python, so it runs in a pool of processes instead of
+# threads. Each job claims shards one by one from the manifest, so an idle worker
+# takes the next shard instead of waiting for a fixed range. The counts of every
+# shard are appended as a delta segment of the checkpoint, and the parent folds
+# the segments into the co-occurrence snapshot.
+
+import csv
+import datetime
+import time
+import traceback
+from array import array
+
+from checkpoint import DeltaCheckpoint
+from counts_parser import CountsParser
+from manifest import ShardManifest
+from pipeline_metrics import PipelineMetrics
+from year_buckets import new_counter
+from shard_fetcher import ShardFetcher
+from shard_stream import STREAM_ERRORS, shard_source
+from token_resolver import TokenResolver
+
+# State of each worker process, filled by init_worker
+worker_config = {}
+
+# Number of valid lines whose counts are parsed together
+BATCH_SIZE = 10000
+
+
+# Function to read a CSV file containing key-value pairs and convert it to a dictionary
+def read_dict_csv(file_path):
+    result_dict = {}
+    with open(file_path, 'r') as file:
+        reader = csv.reader(file)
+        for row in reader:
+            result_dict[row[0]] = row[1]
+    return result_dict
+
+
+# Function to load everything a worker needs once per process. Every process takes
+# a number from worker_slots, used for its progress bar (and for the file of its profile)
+def init_worker(n_gram, range_years, year_buckets, dir_years, url_base, local_dir, progress_queue,
+                start_files, end_files, max_attempts, worker_slots, cooccurrence_file, profile_path=None,
+                memory_budget=None, fetcher_options=None):
+    vocab_dict = read_dict_csv("./" + dir_years + "/vocab_info.csv")
+    worker = worker_slots.get()
+    # The metrics of the files go back to the parent with the results, a worker only profiles
+    metrics = PipelineMetrics("worker", profile_path=profile_path + "." + str(worker) if profile_path else None)
+    worker_config.update({
+        "worker": worker,
+        "metrics": metrics,
+        "process_file": metrics.profiled(process_file),
+        "manifest": ShardManifest(n_gram, dir_years, start_files, end_files, max_attempts=max_attempts),
+        "checkpoint": DeltaCheckpoint(cooccurrence_file, year_buckets, memory_budget),
+        "n_gram": n_gram,
+        "dir_years": dir_years,
+        "url_base": url_base,
+        "local_dir": local_dir,
+        "fetcher": ShardFetcher(**(fetcher_options or {})),
+        "progress_queue": progress_queue,
+        "counts_parser": CountsParser(range_years),
+        "year_buckets": year_buckets,
+        "resolver": TokenResolver({key: idx + 1 for idx, key in enumerate(vocab_dict)}),
+    })
+
+
+# Function to send progress events to the parent process
+def report(worker, event, value=None):
+    queue = worker_config["progress_queue"]
+    if queue is not None:
+        queue.put((worker, event, value))
+
+
+# Function to sum the occurrences of a batch of lines and add their pairs to the counter.
+# pairs holds (id_word1, id_word2, line in the batch) triplets. With a memory budget, a
+# counter that reaches it is spilled to disk as a run of the file
+def update_occurrences(local_counter, pairs, fields, num_file=None):
+    local_counter.add_lines(pairs, fields, worker_config["counts_parser"])
+    worker_config["checkpoint"].spill_if_full(num_file, local_counter)
+
+
+# Returns the lines, valid lines and pairs of the file
+def process_file(decompressed_file, local_counter, worker, num_file=None):
+    n = int(worker_config["n_gram"])
+    resolve_gram = worker_config["resolver"].resolve_gram
+    pairs, fields = array("q"), []
+    num_line, valid_lines, total_pairs = -1, 0, 0
+    report(worker, "total", decompressed_file.size or None)
+    for num_line, line in enumerate(decompressed_file):
+        # Split line in gram (first position) and years (following positions)
+        gram, _, years = line.partition(b'\t')
+        # Get the ids of the words (0 if out of the vocabulary), or None if it is not a valid gram
+        ids = resolve_gram(gram)
+        if ids is not None:
+            valid_lines += 1
+            n_pairs = len(pairs)
+            for i in range(n):
+                if ids[i]:
+                    for j in range(i + 1, n):
+                        if ids[j]:
+                            pairs.extend((ids[i], ids[j], len(fields)))
+            # The occurrences among years are summed later, for the whole batch at once
+            if len(pairs) > n_pairs:
+                fields.append(years)
+                if len(fields) >= BATCH_SIZE:
+                    total_pairs += len(pairs) // 3
+                    update_occurrences(local_counter, pairs, fields, num_file)
+                    pairs, fields = array("q"), []
+        # Progress is measured in compressed bytes read from the stream
+        if num_line % 10000 == 0:
+            report(worker, "completed", decompressed_file.tell())
+    if fields:
+        total_pairs += len(pairs) // 3
+        update_occurrences(local_counter, pairs, fields, num_file)
+    return {"lines": num_line + 1, "valid_lines": valid_lines, "pairs": total_pairs}
+
+
+# Parse the whole shard into its own counter, so a connection lost in the middle of the
+# stream does not leave half a file counted in the job counter. Returns the counter and the stats of the file
+def stream_file(num_file, total_files, worker):
+    start_time = time.perf_counter()
+    source = shard_source(worker_config["url_base"], worker_config["local_dir"],
+                          worker_config["n_gram"], num_file, total_files)
+    file_counter = new_counter(worker_config["year_buckets"])
+    with worker_config["fetcher"].open(source) as decompressed_file:
+        stats = worker_config["process_file"](decompressed_file, file_counter, worker, num_file)
+        stats["compressed_bytes"] = decompressed_file.tell()
+        stats["decompressed_bytes"] = decompressed_file.decompressed_tell()
+    stats["seconds"] = time.perf_counter() - start_time
+    return file_counter, stats
+
+
+def log_file(num_file, worker, failed=False):
+    row = [datetime.datetime.now(), worker_config["n_gram"], num_file, worker_config["dir_years"], worker]
+    if failed:
+        row.append("failed")
+    with open('file_log.csv', 'a', newline='') as f:
+        csv.writer(f).writerow(row)
+
+
+# Job of a worker: claim and parse up to max_files files. The counts of every file are saved
+# as its delta segment before it is marked done in the manifest. Returns the files done,
+# the stats of the token cache and the stats of every file done
+def process_shards(job, max_files, total_files):
+    worker, manifest, checkpoint = worker_config["worker"], worker_config["manifest"], worker_config["checkpoint"]
+    done_files, file_stats = [], []
+
+    while len(done_files) < max_files:
+        num_file = manifest.claim(worker)
+        if num_file is None:
+            break
+        try:
+            file_counter, stats = stream_file(num_file, total_files, worker)
+        except Exception as e:
+            # A shard that cannot be read (or a bug on one of its lines) fails alone, not the whole job
+            if isinstance(e, STREAM_ERRORS):
+                print(SystemExit(e))
+            else:
+                traceback.print_exc()
+            checkpoint.drop_runs(num_file)
+            # It goes back to the queue until it reaches the maximum number of attempts
+            manifest.fail(num_file, e)
+            log_file(num_file, worker, failed=True)
+            continue
+        stats["spills"] = len(checkpoint.runs.get(num_file, []))
+        start_time = time.perf_counter()
+        checkpoint.append(num_file, file_counter)
+        stats["checkpoint_seconds"] = time.perf_counter() - start_time
+        stats["accumulator_entries"], stats["accumulator_bytes"] = len(file_counter), int(file_counter.nbytes)
+        stats["worker_rss_bytes"] = worker_config["metrics"].process.memory_info().rss
+        manifest.finish(num_file)
+        log_file(num_file, worker)
+        done_files.append(num_file)
+        file_stats.append((num_file, stats))
+        report(worker, "file")
+
+    worker_config["metrics"].save_profile()
+    return job, done_files, worker_config["resolver"].stats(), file_stats
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Parser of the year counts of Google Books Ngrams lines.
+#
+# After the gram, every line has tab separated "year,match_count,volume_count"
+# entries. Instead of splitting every entry in Python, the counts of a whole batch
+# of lines are read from the raw bytes with a single NumPy call and summed per
+# line with np.add.reduceat. Years out of range_years are filtered with the
+# bounds computed once. The separators of the batch are checked first (only
+# digits, and two commas then a tab or a new line for every entry), so a
+# malformed line never shifts the values of the rest, it sends the batch to the
+# slow path.
+
+import warnings
+
+import numpy as np
+
+# Tabs, commas and new lines become spaces, so a batch is a flat list of integers
+SEPARATORS = bytes.maketrans(b"\t,\n\r", b"    ")
+DIGITS = b"0123456789"
+# Every entry is "year,match_count,volume_count" followed by a tab or the end of the line
+ENTRY_SEPARATORS = np.array([True, True, False])
+
+
+# Function to check that the bytes of a batch of fields are only entries: digits and, for every
+# entry, two commas and then a tab or the end of the line (tabs and new lines in a row are one end)
+def well_formed(buffer):
+    separators = buffer.translate(None, DIGITS)
+    if separators.translate(None, b"\t,\n\r"):
+        return False
+    commas = np.frombuffer(separators, dtype=np.uint8) == 44
+    # A tab or new line after another one ends the same entry
+    keep = commas.copy()
+    keep[1:] |= commas[:-1]
+    commas = commas[keep]
+    if not commas.any():
+        return False
+    if not commas[-1]:
+        commas = commas[:-1]
+    if len(commas) % 3 != 2:
+        return False
+    return bool((np.append(commas, False).reshape(-1, 3) == ENTRY_SEPARATORS).all())
+
+
+# Function to read the years bounds from a "1900-2000" string
+def years_bounds(range_years):
+    if not range_years:
+        return None
+    years = [int(year) for year in range_years.split("-")]
+    return min(years), max(years)
+
+
+class CountsParser:
+    def __init__(self, range_years=None):
+        self.bounds = years_bounds(range_years)
+
+    # Function to read the (year, count, volumes) entries of a batch of lines.
+    # Returns the number of entries of every line and an array with one entry per row
+    def entries(self, fields):
+        entries = np.fromiter((field.count(b"\t") + 1 for field in fields), dtype=np.int64, count=len(fields))
+        buffer = b"\t".join(fields)
+        if not well_formed(buffer):
+            # Some line is malformed, read them one by one
+            return self.entries_slow(fields)
+        buffer = buffer.translate(SEPARATORS)
+        try:
+            # Depending on the NumPy version unmatched data gives a warning or an error
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                values = np.fromstring(buffer, dtype=np.int64, sep=" ")
+        except ValueError:
+            values = None
+        if values is None or len(values) != 3 * entries.sum():
+            # Some line has an empty entry or number
+            return self.entries_slow(fields)
+        return entries, values.reshape(-1, 3)
+
+    # Slow path: malformed entries are skipped
+    def entries_slow(self, fields):
+        entries, values = [], []
+        for field in fields:
+            n_entries = 0
+            for entry in field.split(b"\t"):
+                try:
+                    year, value, volumes = (int(number) for number in entry.split(b","))
+                except ValueError:
+                    continue
+                values.append((year, value, volumes))
+                n_entries += 1
+            entries.append(n_entries)
+        return np.array(entries, dtype=np.int64), np.array(values, dtype=np.int64).reshape(-1, 3)
+
+    # Function to parse the counts part of a batch of lines (bytes after the first tab).
+    # Returns an array with the occurrences of every line
+    def parse(self, fields):
+        if not fields:
+            return np.empty(0, dtype=np.int64)
+        entries, values = self.entries(fields)
+        counts = values[:, 1]
+        if self.bounds is not None:
+            years = values[:, 0]
+            counts = np.where((years >= self.bounds[0]) & (years <= self.bounds[1]), counts, 0)
+        # Lines without entries keep 0 (reduceat would repeat the next value)
+        occurrencies = np.zeros(len(fields), dtype=np.int64)
+        with_entries = entries > 0
+        if len(counts):
+            occurrencies[with_entries] = np.add.reduceat(counts, (np.cumsum(entries) - entries)[with_entries])
+        return occurrencies
+
+    # Function to parse the counts of a batch of lines keeping them per bucket of years.
+    # Returns (line, first year of the bucket, occurrences) arrays, only for buckets with occurrences
+    def parse_buckets(self, fields, width):
+        if not fields:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        entries, values = self.entries(fields)
+        line = np.repeat(np.arange(len(fields), dtype=np.int64), entries)
+        years, counts = values[:, 0], values[:, 1]
+        keep = counts > 0
+        if self.bounds is not None:
+            keep &= (years >= self.bounds[0]) & (years <= self.bounds[1])
+        line, bucket, counts = line[keep], (years[keep] // width) * width, counts[keep]
+
+        # Sum the entries of the same line and bucket
+        order = np.lexsort((bucket, line))
+        line, bucket, counts = line[order], bucket[order], counts[order]
+        if len(line) == 0:
+            return line, bucket, counts
+        starts = np.flatnonzero(np.concatenate(([True], (line[1:] != line[:-1]) | (bucket[1:] != bucket[:-1]))))
+        return line[starts], bucket[starts], np.add.reduceat(counts, starts)
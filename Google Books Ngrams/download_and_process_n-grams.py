@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
 
-import requests
-import gzip
 import datetime
 from rich.progress import Progress
-import io
-import re
 import os
 import csv
 import pandas as pd
 import argparse
 import psutil
+import shutil
+import concurrent.futures
+import contextlib
+import time
+from array import array
+from counts_parser import CountsParser
+from shard_stream import STREAM_ERRORS, shard_source
+from shard_fetcher import ShardFetcher, fetcher_options, prefetch_shards
+from token_resolver import TokenResolver
+from checkpoint import DeltaCheckpoint
+from year_buckets import new_counter, read_counter, save_counter
+from pipeline_metrics import PipelineMetrics
 
 
  
@@ -20,12 +28,33 @@ parser.add_argument("n", help="n-gram to analyze. Options are [2,3,4,5]")
 parser.add_argument("-v", "--verbose", action="store_false", help="decrease verbosity")
 parser.add_argument("-r", "--read",  action="store_true", help="read from last file analyzed extracted from log.csv (default: overwrite)")
 parser.add_argument("-y", "--range_years", default=False, help="years range to analyze. If default, it will include all years available")
+parser.add_argument("-w", "--year_buckets", default=None, help="""keep the counts per bucket of this number of years (1 for every year, 10 for decades).
+					Any range made of whole buckets can be obtained later with query_years.py. It uses the buckets_<w> folder""")
 parser.add_argument("-s", "--start_files", default=None, help="""from which file to start analyzing. 
 					If not specified, it will start from the first file that does not include punctuation""")
 parser.add_argument("-e", "--end_files", default=None, help="in which file to stop analyzing. If not specified, it will end up in the last file")
+parser.add_argument("-l", "--local_dir", default=None, help="folder with already downloaded .gz shards. Shards found there are read from disk instead of downloaded")
+parser.add_argument("-u", "--url_base", default="http://storage.googleapis.com/books/ngrams/books/20200217/eng/", help="url of the folder with the shards (like a local mirror or a test server)")
+parser.add_argument("--cache_dir", default=None, help="folder where the downloaded shards are kept (by their checksum), so other runs read them from disk. Shards partly downloaded are resumed")
+parser.add_argument("--cache_gb", default=100, help="maximum size of the cache in GB, the least recently used shards are removed above it")
+parser.add_argument("--offline", action="store_true", help="only read the shards from the cache (and --local_dir), never download them")
+parser.add_argument("-k", "--prefetch", default=0, help="""number of files downloaded ahead in threads while one is parsed, and the file parsed before is
+					checkpointed in the background. Without --cache_dir they are spooled to a folder next to the co-occurrence file. With 0 every file is
+					streamed after the last one is saved""")
+parser.add_argument("-c", "--compact_every", default=10, help="""every file is saved as a delta segment. This number of segments are folded
+					into the co-occurrence file in the background""")
+parser.add_argument("-m", "--metrics", default=None, help="file where the metrics of every file and stage are written as JSON lines (or a Prometheus textfile if it ends in .prom)")
+parser.add_argument("--profile", default=None, help="file where the cProfile stats of process_file are saved")
+parser.add_argument("--memory_budget", default=None, help="""memory budget of the co-occurrences in GB. The counter of a file that reaches it is spilled
+					to disk as a sorted run, and the runs are merged by streaming. If not specified, the counter of a file is kept in memory""")
 args = parser.parse_args()
 config = vars(args)
 
+metrics = PipelineMetrics("download_and_process_n-grams", config["metrics"], config["profile"])
+memory_budget = int(float(config["memory_budget"]) * 1024 ** 3) if config["memory_budget"] else None
+# Connections, retries and the cache of the downloads
+fetcher = ShardFetcher(**fetcher_options(config))
+
 
 
 def verbose(*args):
@@ -56,7 +85,7 @@ if config["end_files"]:
 else:
 	end_files = number_files_x_ngram[int(n_gram_answer)][1]
 
-# Define a function to initiate the co-occurrence dict and log
+# Define a function to initiate the co-occurrence file and log
 def initialice():
 	
 	# Create log file
@@ -65,9 +94,8 @@ def initialice():
 			csvwriter = csv.writer(f)
 			csvwriter.writerow(["date", "n-gram", "last_file_processed", "years_processed"])
 
-    # Initiate co-occurrence dict
-	global word_dict
-	word_dict = {}
+	# Start the co-occurrences from scratch
+	checkpoint.reset()
 
 
 def create_folder(dir):
@@ -76,49 +104,37 @@ def create_folder(dir):
 
 
 
-def download_decompress(num_file):
+# Open the shard as a stream: it is decompressed while it is downloaded (or read from local_dir, the cache or
+# the path where it was prefetched)
+def download_decompress(num_file, source=None):
 	try:
-		completed_url= url_base + str(num_file).zfill(5) + "-of-" + str(number_files_x_ngram[int(n_gram_answer)][1]).zfill(5) + ".gz"
-		file = completed_url.split("/")[-1].replace(".gz", "")
-		verbose("\nDownloading and decompressing file", file, "at", datetime.datetime.now().strftime("%H:%M:%S"), ". This can take up to 5 min.")
-
-        # Read the corpus files
-		response = requests.get(completed_url, stream=True)
-
+		if source is None:
+			source = shard_source(url_base, config["local_dir"], n_gram_answer, num_file, number_files_x_ngram[int(n_gram_answer)][1])
+		file = source.split("/")[-1].replace(".gz", "")
+		verbose("\nStreaming file", file, "at", datetime.datetime.now().strftime("%H:%M:%S"), ".")
 
-		size = int(response.headers.get('content-length', 0))*0.0073
+		decompressed_file = fetcher.open(source)
 
-	except requests.exceptions.RequestException as e:
+	except STREAM_ERRORS as e:
 		raise SystemExit(e)
-	
-
-	decompressed_file = gzip.GzipFile(fileobj=io.BytesIO(response.content))
 
-	verbose("Decompression successful.")
+	return decompressed_file
 
-	return decompressed_file, size
 
 
+if config["range_years"] and config["year_buckets"]:
+	raise Exception("range_years and year_buckets cannot be used together. Use query_years.py to get a range from the buckets")
 
 if config["range_years"]:
 	dir_years = config["range_years"]
-	years = [int(year) for year in config["range_years"].split("-")]
-	def get_value(line):
-		occurrencies = 0
-		for entry in line:
-			year=int(entry.split(',')[0])
-			if year >= min(years) and year <= max(years):
-				value=int(entry.split(',')[1])
-				occurrencies += value
-		return occurrencies
+elif config["year_buckets"]:
+	dir_years = "buckets_" + str(config["year_buckets"])
 else:
 	dir_years = "all_years"
-	def get_value(line):
-		occurrencies = 0
-		for entry in line:
-			value=int(entry.split(',')[1])
-			occurrencies += value
-		return occurrencies
+
+# The occurrences among years (all or years specific) are summed for batches of lines
+counts_parser = CountsParser(config["range_years"])
+batch_size = 10000
 
 create_folder(dir_years)
 
@@ -134,28 +150,54 @@ def read_dict_csv(file_path):
 
 vocab_dict = read_dict_csv("./"+dir_years+"/vocab_info.csv")
 
-vocab_id = {key: idx + 1 for idx, key in enumerate(vocab_dict)}
+# Tokens are checked, normalized and looked up in the vocabulary once, and remembered
+resolver = TokenResolver({key: idx + 1 for idx, key in enumerate(vocab_dict)})
 
 del vocab_dict
 
 # Getting % usage of virtual_memory ( 3rd field)
 print('RAM memory % used:', psutil.virtual_memory()[2])
-if psutil.virtual_memory()[2] > 80:
+prefetch = int(config["prefetch"])
+if memory_budget:
+	# The counter of a file and the background compaction take up to the budget each (and the
+	# counter of the file checkpointed in the background with --prefetch)
+	budgets = 3 if prefetch else 2
+	if psutil.virtual_memory().available < budgets * memory_budget:
+		raise Exception("Less memory available than " + str(budgets) + " times the memory budget. Lower --memory_budget to execute the code.")
+elif psutil.virtual_memory()[2] > 80:
 	raise Exception("Memory usage is above 80%. More memory will be needed to execute the code.")
 
 
+# The co-occurrences are saved as a binary snapshot (cooccurrence_info.csv is the old text format),
+# or as a folder with one snapshot per bucket of years
+if config["year_buckets"]:
+	cooccurrence_file = dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.buckets"
+else:
+	cooccurrence_file = dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.cooc"
+legacy_cooccurrence_file = dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.csv"
+
+# Every file is saved as a delta segment next to the co-occurrence file, and the segments
+# are folded into it from time to time, instead of saving all the co-occurrences every time
+checkpoint = DeltaCheckpoint(cooccurrence_file, config["year_buckets"], memory_budget)
+checkpoint.on_compact = lambda segments, seconds: metrics.add_stage("compaction", seconds, segments=segments)
+compact_every = int(config["compact_every"])
+
 # Check if file already exists
-if os.path.exists(dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.csv"):
+if os.path.exists(cooccurrence_file) or os.path.exists(legacy_cooccurrence_file) or checkpoint.segments():
 	if config["read"]:
-		# TODO: Read cooccurrence_info.csv to as dict in word_dict
-		word_dict = read_dict_csv(dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.csv")
-
-		# Read which was the last file processed from the log file and save it as start
+		# Read which was the last file processed from the log file and start after it
 		log_df = pd.read_csv("file_log.csv")
 		# Read log_df and get last file modified from the specified n-gram
-		start_files = int(log_df.loc[log_df['n-gram'] == int(n_gram_answer), "last_file_processed"].iloc[-1])
+		start_files = int(log_df.loc[log_df['n-gram'] == int(n_gram_answer), "last_file_processed"].iloc[-1]) + 1
 		del log_df
 
+		# The old CSV becomes the base snapshot, before the segments are folded into it
+		if not os.path.exists(cooccurrence_file) and os.path.exists(legacy_cooccurrence_file):
+			save_counter(cooccurrence_file, read_counter(legacy_cooccurrence_file))
+		# A segment of a file that is not in the log was not finished, the rest are folded
+		checkpoint.discard(range(start_files))
+		checkpoint.compact()
+
 	else:
 		create_folder(dir_years+"/"+n_gram_answer+"-gram")
 		initialice()
@@ -167,74 +209,122 @@ else:
 
 
 # The url base for all n-gram types
-url_base = "http://storage.googleapis.com/books/ngrams/books/20200217/eng/" + n_gram_answer + "-"
-
-
-# Create validation to check desired words in grams
-pattern = re.compile(r'^_[A-Z]+_$|^[A-Za-z]+(?:_[A-Z]+)?(?:[.,!?:;)])?$')
-
-def check_valid_gram(words):
-    for word in words:
-        if not pattern.match(word):
-            return False
-    return True
-
-# Function to remove some punctuation in the ending of a word
-def remove_punctuation(text):
-    for punc in list([".", ",", "!", "?", ":", ";",")"]):
-        if punc in text:
-            text = text.replace(punc, ' ')
-    return text.strip().lower()
-
-
-# Function to update word_dict
-def update_occurrences(word1, word2, value):
-	id_word1 = vocab_id[word1]
-	id_word2 = vocab_id[word2]
-	tuple_words = tuple(sorted((id_word1, id_word2)))
-	if tuple_words not in word_dict:
-		word_dict[tuple_words] = value
-	else:
-		word_dict[tuple_words] += value
-
-def process_file(decompressed_file, size):
-	for line in decompressed_file:
-		# Read the line
-		modified_line = line.decode('utf-8')
-		# Split line in grams (first position) and years (following positions)
-		line_split = modified_line.split('\t')
-		# Get gram and check if it is a valid gram
-		gram = line_split[0].split(" ")
-		if check_valid_gram(gram):
-		
-			# Sum all occurrences among years
-			occurrencies = get_value(line_split[1:])
+url_base = config["url_base"]
+
+
+# Function to update the counter of a file with a batch of lines. pairs holds (id_word1, id_word2, line in the batch) triplets.
+# With a memory budget, a counter that reaches it is spilled to disk as a run of the file
+def update_occurrences(word_dict, pairs, fields, num_file=None):
+	word_dict.add_lines(pairs, fields, counts_parser)
+	checkpoint.spill_if_full(num_file, word_dict)
+
+# Returns the lines, valid lines and pairs of the file
+def process_file(decompressed_file, word_dict, num_file=None):
+	progress.update(task2, total=decompressed_file.size or None)
+	pairs, fields = array("q"), []
+	num_line, valid_lines, total_pairs = -1, 0, 0
+	for num_line, line in enumerate(decompressed_file):
+		# Split line in gram (first position) and years (following positions)
+		gram, _, years = line.partition(b'\t')
+		# Get the ids of the words (0 if out of the vocabulary), or None if it is not a valid gram
+		ids = resolver.resolve_gram(gram)
+		if ids is not None:
+			valid_lines += 1
+			n_pairs = len(pairs)
 			for i in range(int(n_gram_answer)):
-				for j in range(int(n_gram_answer)):
-					if i != j and j > i:
-						update_occurrences(
-							remove_punctuation(gram[i]),
-							remove_punctuation(gram[j]),
-							occurrencies)
-		progress.update(task2, advance=1000/size)
+				if ids[i]:
+					for j in range(i + 1, int(n_gram_answer)):
+						if ids[j]:
+							pairs.extend((ids[i], ids[j], len(fields)))
+			# The occurrences among years are summed later, for the whole batch at once
+			if len(pairs) > n_pairs:
+				fields.append(years)
+				if len(fields) >= batch_size:
+					total_pairs += len(pairs) // 3
+					update_occurrences(word_dict, pairs, fields, num_file)
+					pairs, fields = array("q"), []
+		# Progress is measured in compressed bytes read from the stream
+		if num_line % 10000 == 0:
+			progress.update(task2, completed=decompressed_file.tell())
+	if fields:
+		total_pairs += len(pairs) // 3
+		update_occurrences(word_dict, pairs, fields, num_file)
+	return {"lines": num_line + 1, "valid_lines": valid_lines, "pairs": total_pairs}
+
+# process_file runs under cProfile with --profile
+profiled_process_file = metrics.profiled(process_file)
+
+# Returns the counter of the file
+def download_process(num_file, source=None):
+	start_time = time.perf_counter()
+	decompressed_file = download_decompress(num_file, source)
+	word_dict = new_counter(config["year_buckets"])
 
-def download_process_write(num_file):
-	decompressed_file, size = download_decompress(num_file)
-	
-	process_file(decompressed_file, size)
-						
-	# Safe when each file is processed	
-	with open(dir_years+"/"+n_gram_answer+'-gram/cooccurrence_info.csv', 'w', newline='') as f:
-		writer = csv.writer(f)
-		for row in word_dict.items():
-			writer.writerow(row)
+	try:
+		with decompressed_file:
+			stats = profiled_process_file(decompressed_file, word_dict, num_file)
+			stats["compressed_bytes"] = decompressed_file.tell()
+			stats["decompressed_bytes"] = decompressed_file.decompressed_tell()
+	except STREAM_ERRORS as e:
+		# Nothing of this file has been saved yet (but the runs spilled), so it is safe to stop and resume later
+		checkpoint.drop_runs(num_file)
+		raise SystemExit(e)
+	stats["seconds"] = time.perf_counter() - start_time
+	stats["spills"] = len(checkpoint.runs.get(num_file, []))
+	metrics.shard(num_file, stats)
+	metrics.accumulator(word_dict)
+	print("File loaded succesfully.")
+	progress.update(task1, advance=1)
+	progress.reset(task2)
+	return word_dict
+
+# Function to save the counter of a file. With --prefetch it runs in the background while the next file is parsed
+def checkpoint_file(num_file, word_dict):
+	# Safe when each file is processed, only its own co-occurrences
+	with metrics.stage("checkpoint", num_file=num_file):
+		checkpoint.append(num_file, word_dict)
 	# Safe each file processed in log
 	with open('file_log.csv', 'a', newline='') as f:
 		csvwriter = csv.writer(f)
 		csvwriter.writerow([datetime.datetime.now(), n_gram_answer, num_file, dir_years])
-	print("File loaded succesfully.")
-	progress.update(task1, advance=1)
-	progress.reset(task2)
+	# The files in the log are folded in the background
+	if len(checkpoint.segments()) >= compact_every:
+		checkpoint.compact_async(range(num_file + 1))
+
+def download_process_write(num_file):
+	checkpoint_file(num_file, download_process(num_file))
+
+# Function to process the files as a pipeline: the next files are downloaded in threads while one is parsed,
+# and the file parsed before is checkpointed in a thread. Only one file waits to be checkpointed, so at most
+# two counters are in memory, and the parsing waits for a download only if the network is slower
+def pipeline_process_write(files):
+	sources = [shard_source(url_base, config["local_dir"], n_gram_answer, num_file, number_files_x_ngram[int(n_gram_answer)][1])
+		for num_file in files]
+	spool_dir = None
+	if fetcher.cache is None:
+		spool_dir = dir_years+"/"+n_gram_answer+"-gram/spool"
+		shutil.rmtree(spool_dir, ignore_errors=True)
+		create_folder(spool_dir)
+	saving = None
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=1) as checkpoint_writer, \
+				contextlib.closing(prefetch_shards(fetcher, sources, prefetch, spool_dir)) as shards:
+			try:
+				for num_file, (path, seconds) in zip(files, shards):
+					metrics.add_stage("download_wait", seconds, num_file=num_file)
+					word_dict = download_process(num_file, path)
+					if saving is not None:
+						saving.result()
+					saving = checkpoint_writer.submit(checkpoint_file, num_file, word_dict)
+					del word_dict
+			except STREAM_ERRORS as e:
+				# The file parsed before is still checkpointed (the executor waits for it)
+				raise SystemExit(e)
+			if saving is not None:
+				saving.result()
+	finally:
+		if spool_dir is not None:
+			shutil.rmtree(spool_dir, ignore_errors=True)
 
 
 total_files = end_files - start_files
@@ -245,8 +335,20 @@ with Progress(transient=True) as progress:
 	task1 = progress.add_task("[blue]Percentage of total files analyzed...", total=total_files, visible=config["verbose"])
 	task2 = progress.add_task("[red]Processing file...", total=1000, visible=config["verbose"])
 
-	for num_file in range(start_files, end_files):
-		download_process_write(num_file)
+	if prefetch:
+		pipeline_process_write(range(start_files, end_files))
+	else:
+		for num_file in range(start_files, end_files):
+			download_process_write(num_file)
+
+# Fold the last segments, so the co-occurrence file has every file processed
+checkpoint.wait()
+checkpoint.compact()
+
+verbose("Token cache hit rate: {:.2%}".format(resolver.stats()["hit_rate"]))
+metrics.set(token_cache_hit_rate=resolver.stats()["hit_rate"])
+fetcher.close()
+metrics.close()
 
 
 
@@ -1,35 +1,47 @@
 #!/usr/bin/env python3
 
-import requests
-import gzip
 import datetime
-import io
-import re
+import glob
 import os
 import csv
-import pandas as pd
 import argparse
 import psutil
 import concurrent.futures
+import multiprocessing
+import threading
 from rich.progress import Progress
-import sys
+from checkpoint import DeltaCheckpoint
+from year_buckets import read_counter, remove_counter, save_counter
+from cooccurrence_engine import init_worker, process_shards
+from manifest import ShardManifest
+from pipeline_metrics import PipelineMetrics
+from shard_fetcher import fetcher_options
 
  
-parser = argparse.ArgumentParser(description="Script to download and preprocess data from Google Books Ngrams and store it as a co-occurrence matrix.",
+parser = argparse.ArgumentParser(description="""Script to download and preprocess data from Google Books Ngrams and store it as a co-occurrence matrix.
+					A run always resumes from the files marked done in shard_manifest.sqlite (and file_log.csv). To start over, remove them and the n-gram folder""",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("n", help="n-gram to analyze. Options are [2,3,4,5]")
-parser.add_argument("t", default=2, help="number of threads/workers to create. Note: each thread will take 1GB memory usage.")
+parser.add_argument("t", default=2, help="number of worker processes to create. Shards are streamed, so each worker only needs memory for its co-occurrence dict.")
 parser.add_argument("-v", "--verbose", action="store_false", help="decrease verbosity")
-parser.add_argument("-r", "--read",  action="store_true", help="read from last file analyzed extracted from log.csv (default: overwrite)")
-parser.add_argument("-n", "--n_batch",  default=None, help="from which number of batch read. This will read the previous threads in the specified batch,")
 parser.add_argument("-y", "--range_years", default=False, help="years range to analyze. If default, it will include all years available")
+parser.add_argument("-w", "--year_buckets", default=None, help="""keep the counts per bucket of this number of years (1 for every year, 10 for decades).
+					Any range made of whole buckets can be obtained later with query_years.py. It uses the buckets_<w> folder""")
 parser.add_argument("-s", "--start_files", default=None, help="""from which file to start analyzing. 
 					If not specified, it will start from the first file that does not include punctuation""")
 parser.add_argument("-e", "--end_files", default=None, help="in which file to stop analyzing. If not specified, it will end up in the last file")
-
-args = parser.parse_args()
-config = vars(args)
-
+parser.add_argument("-l", "--local_dir", default=None, help="folder with already downloaded .gz shards. Shards found there are read from disk instead of downloaded")
+parser.add_argument("-u", "--url_base", default="http://storage.googleapis.com/books/ngrams/books/20200217/eng/", help="url of the folder with the shards (like a local mirror or a test server)")
+parser.add_argument("--cache_dir", default=None, help="folder where the downloaded shards are kept (by their checksum), so other runs read them from disk. Shards partly downloaded are resumed")
+parser.add_argument("--cache_gb", default=100, help="maximum size of the cache in GB, the least recently used shards are removed above it")
+parser.add_argument("--offline", action="store_true", help="only read the shards from the cache (and --local_dir), never download them")
+parser.add_argument("-b", "--batch_size", default=50, help="""number of files of a job. Workers take files one by one from a shared queue
+					and save every file as a delta segment, which are folded into the co-occurrence file in the background when a job finishes""")
+parser.add_argument("-a", "--max_attempts", default=3, help="number of times a file that fails is tried before giving up on it")
+parser.add_argument("-m", "--metrics", default=None, help="file where the metrics of every file and stage are written as JSON lines (or a Prometheus textfile if it ends in .prom)")
+parser.add_argument("--profile", default=None, help="cProfile stats of process_file are saved to this path plus the number of the worker")
+parser.add_argument("--memory_budget", default=None, help="""memory budget of the co-occurrences of every worker in GB. The counter of a file that reaches it
+					is spilled to disk as a sorted run, and the runs are merged by streaming. If not specified, the counter of a file is kept in memory""")
 
 
 def verbose(*args):
@@ -40,27 +52,7 @@ def verbose(*args):
 # (the first files have punctuation or numbers and we are not interested on that)
 number_files_x_ngram = {2: [85, 589], 3:[671, 6881], 4:[515, 6668], 5:[1312, 19423]}
 
-# Ask which type of n-grams to analyze
-n_gram_answer = config["n"]
-
-if n_gram_answer not in ["2", "3", "4", "5"]:
-    raise Exception("N-gram type provided is not valid. N-gram should be [2,3,4,5]")
-
-
-verbose(("The n-gram you selected ("+n_gram_answer+"-gram) has "+ str(number_files_x_ngram[int(n_gram_answer)][1])+" files in total."+
-      " Files that have grams without punctuation start at file number "+str(number_files_x_ngram[int(n_gram_answer)][0])))
-
-if config["start_files"]:
-	start_files = int(config["start_files"])
-else:
-	start_files = number_files_x_ngram[int(n_gram_answer)][0]
-
-if config["end_files"]:
-	end_files = int(config["end_files"])
-else:
-	end_files = number_files_x_ngram[int(n_gram_answer)][1]
-
-# Define a function to initiate the co-occurrence dict and log
+# Define a function to initiate the log
 def initialice():
 	
 	# Create log file
@@ -68,9 +60,6 @@ def initialice():
 		with open('file_log.csv', 'w') as f:
 			csvwriter = csv.writer(f)
 			csvwriter.writerow(["date", "n-gram", "last_file_processed", "years_processed"])
-	
-	global log_df
-	log_df = pd.read_csv("file_log.csv", names = ["date", "n-gram", "last_file_processed", "years_processed", "thread", "failed"], index_col=False, skiprows=[0])
 
 
 def create_folder(dir):
@@ -78,264 +67,181 @@ def create_folder(dir):
 		os.mkdir(dir)
 
 
+# Workers cannot share the progress bar, so they send events that are drawn here
+def listen_progress(progress_queue, progress, task1, worker_tasks):
+	while True:
+		event = progress_queue.get()
+		if event is None:
+			break
+		worker, kind, value = event
+		if kind == "total":
+			progress.reset(worker_tasks[worker], total=value)
+		elif kind == "completed":
+			progress.update(worker_tasks[worker], completed=value)
+		elif kind == "file":
+			progress.update(task1, advance=1)
 
-def download_decompress(num_file):
-	try:
-		completed_url= url_base + str(num_file).zfill(5) + "-of-" + str(number_files_x_ngram[int(n_gram_answer)][1]).zfill(5) + ".gz"
-		file = completed_url.split("/")[-1].replace(".gz", "")
-		verbose("\nDownloading and decompressing file", file, "at", datetime.datetime.now().strftime("%H:%M:%S"), ". This can take up to 10 min.")
-
-        # Read the corpus files
-		response = requests.get(completed_url, stream=True)
 
+# Function to record the stats of the files of a job, sent back by the worker
+def record_files(metrics, file_stats, worker_job):
+	for num_file, stats in file_stats:
+		metrics.add_stage("checkpoint", stats.pop("checkpoint_seconds"), num_file=num_file)
+		metrics.set(accumulator_entries=stats.pop("accumulator_entries"), accumulator_bytes=stats.pop("accumulator_bytes"))
+		worker_rss = stats.pop("worker_rss_bytes")
+		metrics.set(worker_rss_bytes=worker_rss)
+		metrics.shard(num_file, stats, job=worker_job, worker_rss_bytes=worker_rss)
 
-		size = int(response.headers.get('content-length', 0))*0.0073
 
-		decompressed_file = gzip.GzipFile(fileobj=io.BytesIO(response.content))
+if __name__ == "__main__":
+	args = parser.parse_args()
+	config = vars(args)
+	metrics = PipelineMetrics("download_and_process_n-grams_parallelized", config["metrics"])
+	memory_budget = int(float(config["memory_budget"]) * 1024 ** 3) if config["memory_budget"] else None
 
-		verbose("Decompression successful.")
+	# Ask which type of n-grams to analyze
+	n_gram_answer = config["n"]
 
-		return decompressed_file, size
-
-	except requests.exceptions.RequestException as e:
-		print(SystemExit(e))
-		return -1, -1
-	
+	if n_gram_answer not in ["2", "3", "4", "5"]:
+		raise Exception("N-gram type provided is not valid. N-gram should be [2,3,4,5]")
 
 
+	verbose(("The n-gram you selected ("+n_gram_answer+"-gram) has "+ str(number_files_x_ngram[int(n_gram_answer)][1])+" files in total."+
+	      " Files that have grams without punctuation start at file number "+str(number_files_x_ngram[int(n_gram_answer)][0])))
 
-if config["range_years"]:
-	dir_years = config["range_years"]
-	years = [int(year) for year in config["range_years"].split("-")]
-	def get_value(line):
-		occurrencies = 0
-		for entry in line:
-			year=int(entry.split(',')[0])
-			if year >= min(years) and year <= max(years):
-				value=int(entry.split(',')[1])
-				occurrencies += value
-		return occurrencies
-else:
-	dir_years = "all_years"
-	def get_value(line):
-		occurrencies = 0
-		for entry in line:
-			value=int(entry.split(',')[1])
-			occurrencies += value
-		return occurrencies
-
-create_folder(dir_years)
-
-def read_dict_csv(file_path):
-    result_dict = {}
-    with open(file_path, 'r') as file:
-        reader = csv.reader(file)
-        for row in reader:
-            key = row[0]
-            value = row[1]
-            result_dict[key] = value
-    return result_dict
-
-def read_dict_csv_tuple(file_path):
-    result_dict = {}
-    with open(file_path, 'r') as file:
-        reader = csv.reader(file)
-        for row in reader:
-            key = eval(row[0])
-            value = int(row[1])
-            result_dict[key] = value
-    return result_dict
-
-vocab_dict = read_dict_csv("./"+dir_years+"/vocab_info.csv")
-
-vocab_id = {key: idx + 1 for idx, key in enumerate(vocab_dict)}
-
-del vocab_dict
-
-# Getting % usage of virtual_memory ( 3rd field)
-verbose('RAM memory % used:', psutil.virtual_memory()[2])
-if psutil.virtual_memory()[2] > 80:
-	raise Exception("Memory usage is above 80%. More memory will be needed to execute the code.")
-	
-
-
-# The url base for all n-gram types
-url_base = "http://storage.googleapis.com/books/ngrams/books/20200217/eng/" + n_gram_answer + "-"
-
-
-# Create validation to check desired words in grams
-pattern = re.compile(r'^_[A-Z]+_$|^[A-Za-z]+(?:_[A-Z]+)?(?:[.,!?:;)])?$')
-
-def check_valid_gram(words):
-    for word in words:
-        if not pattern.match(word):
-            return False
-    return True
-
-# Function to remove some punctuation in the ending of a word
-def remove_punctuation(text):
-    for punc in list([".", ",", "!", "?", ":", ";",")"]):
-        if punc in text:
-            text = text.replace(punc, ' ')
-    return text.strip().lower()
-
-
-# Function to update word_dict
-def update_occurrences(local_dict, word1, word2, value):
-	id_word1 = vocab_id[word1]
-	id_word2 = vocab_id[word2]
-	tuple_words = tuple(sorted((id_word1, id_word2)))
-	if tuple_words not in local_dict:
-		local_dict[tuple_words] = value
-	else:
-		local_dict[tuple_words] += value
-
-def process_file(decompressed_file, size, local_dict, progress, thread_task):
-	for line in decompressed_file:
-		# Read the line
-		modified_line = line.decode('utf-8')
-		# Split line in grams (first position) and years (following positions)
-		line_split = modified_line.split('\t')
-		# Get gram and check if it is a valid gram
-		gram = line_split[0].split(" ")
-		if check_valid_gram(gram):
-		
-			# Sum all occurrences among years
-			occurrencies = get_value(line_split[1:])
-			for i in range(int(n_gram_answer)):
-				if gram[i] in vocab_id:
-					for j in range(int(n_gram_answer)):
-						if gram[j] in vocab_id:
-							if i != j and j > i:
-								update_occurrences(local_dict,
-									remove_punctuation(gram[i]),
-									remove_punctuation(gram[j]),
-									occurrencies)
-		progress.update(thread_task, advance=1000/size)
-	progress.reset(thread_task)
-
-def download_process_write(num_file, local_dict, progress, thread_task):
-	decompressed_file, size = download_decompress(num_file)
-
-	if decompressed_file != -1:
-		process_file(decompressed_file, size, local_dict, progress, thread_task)
-
-			# Safe when each file is processed in provisional thread files	
-		with open(dir_years+"/"+n_gram_answer+'-gram/'+str(thread_task)+'thread_provisional_cooccurrence_info.csv', 'w', newline='') as f:
-			writer = csv.writer(f)
-			for row in local_dict.items():
-				writer.writerow(row)
-		
-			# Safe each file processed in log
-		with open('file_log.csv', 'a', newline='') as f:
-			csvwriter = csv.writer(f)
-			csvwriter.writerow([datetime.datetime.now(), n_gram_answer, num_file, dir_years, thread_task])
-		verbose("File loaded succesfully.")
+	if config["start_files"]:
+		start_files = int(config["start_files"])
 	else:
-			# Safe each file processed in log
-		with open('file_log.csv', 'a', newline='') as f:
-			csvwriter = csv.writer(f)
-			csvwriter.writerow([datetime.datetime.now(), n_gram_answer, num_file, dir_years, thread_task, "failed"])
-		verbose("File loaded succesfully.")
+		start_files = number_files_x_ngram[int(n_gram_answer)][0]
 
-def main_job(start_files, end_files, progress, thread_task):
-	
-	if os.path.exists(dir_years+"/"+n_gram_answer+'-gram/'+str(thread_task)+'thread_provisional_cooccurrence_info.csv'):
-		local_dict = read_dict_csv_tuple(dir_years+"/"+n_gram_answer+'-gram/'+str(thread_task)+'thread_provisional_cooccurrence_info.csv')
+	if config["end_files"]:
+		end_files = int(config["end_files"])
 	else:
-		local_dict = {}
+		end_files = number_files_x_ngram[int(n_gram_answer)][1]
 
-	for num_file in range(start_files, end_files):
-		if num_file not in log_df.loc[log_df['n-gram'] == int(n_gram_answer), "last_file_processed"].values:
-			download_process_write(num_file, local_dict, progress, thread_task)
-		progress.update(task1, advance=1)
+	if config["range_years"] and config["year_buckets"]:
+		raise Exception("range_years and year_buckets cannot be used together. Use query_years.py to get a range from the buckets")
 
-	os.remove(dir_years+"/"+n_gram_answer+'-gram/'+str(thread_task)+'thread_provisional_cooccurrence_info.csv')
-
-	return local_dict
-
-def update_dicts(d1, d2):
-    for key in d2.keys():
-        if key not in d1:
-            d1[key] = d2[key]
-        else:
-            d1[key] = d1[key] + d2[key]
-    return d1
-
-def merge_dicts(merged_dict, dicts):
-    for d in dicts:
-        merged_dict = update_dicts(merged_dict, d)
-        d.clear()
-    return merged_dict
-
-create_folder(dir_years+"/"+n_gram_answer+"-gram")
-initialice()
-
-total_files = end_files - start_files
-batch_size = 50
-batches = total_files//batch_size
-
-for i_batch in range(batches):
-	start_files_batch = start_files + (i_batch * batch_size)
-	end_files_batch = ((i_batch + 1) * batch_size) + start_files
-
-	
+	if config["range_years"]:
+		dir_years = config["range_years"]
+	elif config["year_buckets"]:
+		dir_years = "buckets_" + str(config["year_buckets"])
+	else:
+		dir_years = "all_years"
+
+	create_folder(dir_years)
+
+	# Getting % usage of virtual_memory ( 3rd field)
+	verbose('RAM memory % used:', psutil.virtual_memory()[2])
+	if memory_budget:
+		# Every worker and the compaction of the parent take up to the budget
+		if psutil.virtual_memory().available < (int(config["t"]) + 1) * memory_budget:
+			raise Exception("Less memory available than the memory budget of every worker and the compaction. Lower --memory_budget to execute the code.")
+	elif psutil.virtual_memory()[2] > 80:
+		raise Exception("Memory usage is above 80%. More memory will be needed to execute the code.")
+
+	create_folder(dir_years+"/"+n_gram_answer+"-gram")
+	initialice()
+
+	# The co-occurrences are saved as a binary snapshot (cooccurrence_info.csv is the old text format),
+	# or as a folder with one snapshot per bucket of years
+	if config["year_buckets"]:
+		cooccurrence_file = dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.buckets"
+	else:
+		cooccurrence_file = dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.cooc"
+	legacy_cooccurrence_file = dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.csv"
+
+	# The state of every file is kept in the manifest. Files done in runs older than the
+	# manifest are read from the log, and files left running by an interrupted run are pending again
+	manifest = ShardManifest(n_gram_answer, dir_years, start_files, end_files, max_attempts=int(config["max_attempts"]))
+	manifest.add()
+	manifest.import_log()
+	manifest.recover()
+	verbose("Files by state:", manifest.counts())
+
+	# Every file is saved as a delta segment next to the co-occurrence file. The segments of files
+	# not marked done were left by an interrupted worker, the rest are folded before starting
+	checkpoint = DeltaCheckpoint(cooccurrence_file, config["year_buckets"], memory_budget)
+	checkpoint.on_compact = lambda segments, seconds: metrics.add_stage("compaction", seconds, segments=segments)
+	# The old CSV becomes the base snapshot, before the segments are folded into it
+	if not os.path.exists(cooccurrence_file) and os.path.exists(legacy_cooccurrence_file):
+		save_counter(cooccurrence_file, read_counter(legacy_cooccurrence_file))
+	checkpoint.discard(manifest.done_files())
+	checkpoint.compact()
+
+	# Provisional counters of older versions of this script hold files already marked done
+	provisional_files = [provisional_file for extension in (".buckets", ".cooc", ".csv")
+		for provisional_file in glob.glob(dir_years+"/"+n_gram_answer+"-gram/*_provisional_cooccurrence_info"+extension)]
+	if provisional_files:
+		merged_counter = checkpoint.load()
+		for provisional_file in provisional_files:
+			merged_counter.merge(read_counter(provisional_file))
+		save_counter(cooccurrence_file, merged_counter)
+		del merged_counter
+		for provisional_file in provisional_files:
+			remove_counter(provisional_file)
+		verbose("Merged", len(provisional_files), "provisional files of the last run")
+
+	batch_size = int(config["batch_size"])
 	threads = int(config["t"])
-	# Calculate the range for each thread
-	step = batch_size // threads
-	ranges = [((i * step)+start_files_batch, ((i + 1) * step)+start_files_batch) for i in range(threads)]
 
-	if ranges[-1][1] != end_files_batch:
-		ranges[-1] = (ranges[-1][0], end_files_batch)
+	# Worker processes parse the shards outside the GIL and report their progress through a queue
+	progress_queue = multiprocessing.Queue()
+	worker_slots = multiprocessing.Queue()
+	for worker in range(threads):
+		worker_slots.put(worker)
+	executor = concurrent.futures.ProcessPoolExecutor(max_workers=threads, initializer=init_worker,
+		initargs=(n_gram_answer, config["range_years"], config["year_buckets"], dir_years, config["url_base"], config["local_dir"], progress_queue,
+			start_files, end_files, int(config["max_attempts"]), worker_slots, cooccurrence_file, config["profile"], memory_budget,
+			fetcher_options(config)))
 
 	with Progress(transient=True) as progress:
-		task1 = progress.add_task("[blue]Percentage of total files analyzed...", total=batch_size, visible=True)
-
-		# Create a list to store individual thread tasks
-		thread_tasks = []
-		for thread in range(threads):
-			task_name = f"[red]Processing file (Thread {thread + 1})..."
-			thread_task = progress.add_task(task_name, total=1000, visible=True)
-			thread_tasks.append(thread_task)
-
-
-		# Using ThreadPoolExecutor to parallelize the task
-		with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-			# Submit tasks to the executor and get Future objects
-			futures  = []
-			for (start, end), thread_task in zip(ranges, thread_tasks):
-				futures.append(executor.submit(main_job, start, end, progress, thread_task))
-
-			# Wait for all tasks to complete and retrieve results
-			results = []
-			for future in concurrent.futures.as_completed(futures):
-				results.append(future.result())
-
-
-	# Read the last file created and update based on these results
-	if os.path.exists(dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.csv"):
-		merged_dict = read_dict_csv_tuple(dir_years+"/"+n_gram_answer+"-gram/cooccurrence_info.csv")
-	else:
-		merged_dict = {}
-
-	# Merge the dictionaries from different threads
-	merged_dict = merge_dicts(merged_dict, results)
-	print("Threads merged")
-
-	# Release memory usage
-	for result in results:
-		result.clear()
-	del results
-
-	
-	# Safe when each file is processed	
-	with open(dir_years+"/"+n_gram_answer+'-gram/cooccurrence_info.csv', 'w', newline='') as f:
-		writer = csv.writer(f)
-		for row in merged_dict.items():
-			writer.writerow(row)
-	
-	print("Batch", i_batch, "with range", start_files_batch, end_files_batch, "finished and saved, at",  datetime.datetime.now().strftime("%H:%M:%S"))
-
-	
-	
-	del merged_dict
\ No newline at end of file
+		counts = manifest.counts()
+		task1 = progress.add_task("[blue]Percentage of total files analyzed...", total=end_files - start_files,
+			completed=counts["done"], visible=config["verbose"])
+
+		# Create a list to store individual worker tasks
+		worker_tasks = []
+		for worker in range(threads):
+			task_name = f"[red]Processing file (Worker {worker + 1})..."
+			worker_tasks.append(progress.add_task(task_name, total=1000, visible=config["verbose"]))
+
+		listener = threading.Thread(target=listen_progress, args=(progress_queue, progress, task1, worker_tasks))
+		listener.start()
+
+		# The listener is not a daemon thread: it is stopped even if a job raises, or the script never exits
+		try:
+			# There is a job per worker while files are left. When one finishes a new job takes its place,
+			# so no worker waits for the slowest one, and the segments of the files done are folded in the background
+			futures = set()
+			job = 0
+			while futures or manifest.has_work():
+				while len(futures) < threads and manifest.has_work():
+					futures.add(executor.submit(process_shards, job, batch_size, number_files_x_ngram[int(n_gram_answer)][1]))
+					job += 1
+				finished, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+				for future in finished:
+					finished_job, done_files, cache_stats, file_stats = future.result()
+					if not done_files:
+						continue
+					record_files(metrics, file_stats, finished_job)
+					checkpoint.compact_async(manifest.done_files())
+					verbose("Job", finished_job, "with files", done_files, "finished at", datetime.datetime.now().strftime("%H:%M:%S"),
+						"- token cache hit rate: {:.2%}".format(cache_stats["hit_rate"]))
+		finally:
+			progress_queue.put(None)
+			listener.join()
+			executor.shutdown(cancel_futures=True)
+
+	# Fold the last segments, so the co-occurrence file has every file done
+	checkpoint.wait()
+	checkpoint.compact(manifest.done_files())
+	verbose("Co-occurrences saved at", datetime.datetime.now().strftime("%H:%M:%S"))
+
+	failed_files = manifest.failed_files()
+	if failed_files:
+		print(len(failed_files), "files failed", config["max_attempts"], "times:", [num_file for num_file, _ in failed_files])
+		print("Run again to retry them after raising -a/--max_attempts")
+	print("Files by state:", manifest.counts())
+	manifest.close()
+	metrics.close()
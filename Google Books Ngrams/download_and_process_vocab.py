@@ -1,144 +1,169 @@
 #!/usr/bin/env python3
 # Import necessary libraries
-import requests
-import gzip
 import datetime
-import io
-import re
+import csv
+import math
+import shutil
+import numpy as np
 import pandas as pd
 import argparse
+import concurrent.futures
+import multiprocessing
+import threading
 from rich.progress import Progress
 import os
+from vocab_engine import checkpoint_path, init_worker, merge_checkpoints, process_range, save_vocab
+from pipeline_metrics import PipelineMetrics
+from shard_fetcher import fetcher_options
 
 # Set up command-line argument parser
 parser = argparse.ArgumentParser(description="Script to download and preprocess data from Google Books 1-grams, in order to obtain the vocabulary and frequency of words.",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("-v", "--verbose", action="store_false", help="decrease verbosity")
 parser.add_argument("-y", "--range_years", default=False, help="years range to analyze. If default, it will include all years available")
-args = parser.parse_args()
-config = vars(args)
+parser.add_argument("-w", "--year_buckets", default=None, help="also keep the frequencies per bucket of this number of years (1 for every year, 10 for decades) in vocab_buckets.csv. It uses the buckets_<w> folder")
+parser.add_argument("-l", "--local_dir", default=None, help="folder with already downloaded .gz shards. Shards found there are read from disk instead of downloaded")
+parser.add_argument("-u", "--url_base", default="http://storage.googleapis.com/books/ngrams/books/20200217/eng/", help="url of the folder with the shards (like a local mirror or a test server)")
+parser.add_argument("--cache_dir", default=None, help="folder where the downloaded shards are kept (by their checksum), so other runs read them from disk. Shards partly downloaded are resumed")
+parser.add_argument("--cache_gb", default=100, help="maximum size of the cache in GB, the least recently used shards are removed above it")
+parser.add_argument("--offline", action="store_true", help="only read the shards from the cache (and --local_dir), never download them")
+parser.add_argument("-t", "--threads", default=2, help="number of worker processes. Each one streams a shard at a time and saves its counts as a checkpoint")
+parser.add_argument("-r", "--read", action="store_true", help="resume from the shards already saved in file_log.csv (default: overwrite)")
+parser.add_argument("-k", "--vocab_size", default=None, help="""number of most frequent words written to vocab_info.csv. If default, all the words are written.
+                    Note that merge_and_PMI.py takes the total of frequencies from this file""")
+parser.add_argument("-m", "--metrics", default=None, help="file where the metrics of every file and stage are written as JSON lines (or a Prometheus textfile if it ends in .prom)")
+parser.add_argument("--profile", default=None, help="cProfile stats of process_file are saved to this path plus the id of the worker process")
+
+# The shards of 1-grams, without the first ones (punctuation and numbers)
+start_files, total_files = 6, 24
+
 
 # Function to print verbose messages if verbosity is enabled
 def verbose(*args):
     if config["verbose"]:
         print(*args)
 
-# Initialize vocabulary dictionary
-vocab_dict = {}
-
-# The URL base for all n-gram types
-url_base = "http://storage.googleapis.com/books/ngrams/books/20200217/eng/1-"
-
-# Create a pattern for checking valid words in grams
-pattern = re.compile(r'^_[A-Z]+_$|^[A-Za-z]+(?:_[A-Z]+)?(?:[.,!?:;)])?$')
-
-# Function to check if a word is valid
-def check_valid_word(word):
-    if not pattern.match(word):
-        return False
-    return True
-
-# Function to remove some punctuation at the end of a word
-def remove_punctuation(text):
-    for punc in list([".", ",", "!", "?", ":", ";", ")"]):
-        if punc in text:
-            text = text.replace(punc, ' ')
-    return text.strip().lower()
-
-# Set up which occurrences get (all or years specific)
-if config["range_years"]:
-    dir_years = config["range_years"]
-    years = [int(year) for year in config["range_years"].split("-")]
-    def get_value(line):
-        occurrences = 0
-        for entry in line:
-            year = int(entry.split(',')[0])
-            if year >= min(years) and year <= max(years):
-                value = int(entry.split(',')[1])
-                occurrences += value
-        return occurrences
-else:
-    dir_years = "all_years"
-    def get_value(line):
-        occurrences = 0
-        for entry in line:
-            value = int(entry.split(',')[1])
-            occurrences += value
-        return occurrences
 
 # Function to create a folder if it doesn't exist
 def create_folder(dir):
     if not os.path.isdir(dir):
         os.mkdir(dir)
 
-# Create folder for the specified years
-create_folder(dir_years)
-
-# Function to download and decompress a file
-def download_decompress(num_file):
-    try:
-        completed_url = url_base + str(num_file).zfill(5) + "-of-00024.gz"
-        file = completed_url.split("/")[-1].replace(".gz", "")
-        verbose("\nDownloading and decompressing file", file, "at", datetime.datetime.now().strftime("%H:%M:%S"), ". This can take up to 5 min.")
-
-        # Read the corpus files
-        response = requests.get(completed_url, stream=True)
-        size = int(response.headers.get('content-length', 0)) * 0.0073
-
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-
-    decompressed_file = gzip.GzipFile(fileobj=io.BytesIO(response.content))
-    verbose("Decompression successful.")
-    return decompressed_file, size
 
-# Function to update the word dictionary
-def update_counter(word, value):
-    if word not in vocab_dict:
-        vocab_dict[word] = value
+# Function to read the shards already saved for these years
+def processed_shards(dir_years):
+    if not os.path.exists("file_log.csv"):
+        with open('file_log.csv', 'w') as f:
+            csvwriter = csv.writer(f)
+            csvwriter.writerow(["date", "n-gram", "last_file_processed", "years_processed"])
+    log_df = pd.read_csv("file_log.csv", names=["date", "n-gram", "last_file_processed", "years_processed", "thread", "failed"],
+                         index_col=False, skiprows=[0])
+    done = log_df[(log_df["n-gram"] == 1) & (log_df["years_processed"].astype(str) == dir_years) & log_df["failed"].isna()]
+    return {num_file for num_file in done["last_file_processed"].astype(int)
+            if os.path.exists(checkpoint_path(dir_years, num_file))}
+
+
+# Workers cannot share the progress bar, so they send events that are drawn here
+def listen_progress(progress_queue, progress, task1, worker_tasks):
+    while True:
+        event = progress_queue.get()
+        if event is None:
+            break
+        worker, kind, value = event
+        if kind == "total":
+            progress.reset(worker_tasks[worker], total=value)
+        elif kind == "completed":
+            progress.update(worker_tasks[worker], completed=value)
+        elif kind == "file":
+            progress.update(task1, advance=1)
+
+
+# Function to save the frequencies per bucket as word,bucket,frequency rows. The rows follow the order in which
+# the words first appeared (the order of vocab), so query_years.py sorts equal frequencies like a --range_years
+# run. A word without occurrences in any bucket gets a row with frequency 0 in the first bucket, so it is kept too
+def save_buckets(file_path, vocab, vocab_buckets):
+    seen = set().union(*vocab_buckets.values())
+    unseen = [word for word in vocab if word not in seen]
+    frames = [pd.DataFrame({"word": list(bucket), "bucket": year, "frequency": list(bucket.values())})
+              for year, bucket in sorted(vocab_buckets.items())]
+    if unseen or not frames:
+        frames.append(pd.DataFrame({"word": unseen, "bucket": min(vocab_buckets, default=0), "frequency": 0}))
+    df = pd.concat(frames)
+    order = {word: position for position, word in enumerate(vocab)}
+    df = df.iloc[np.argsort(df["word"].map(order).to_numpy(), kind="stable")]
+    df.to_csv(file_path, index=False)
+    del df
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+    metrics = PipelineMetrics("download_and_process_vocab", config["metrics"])
+
+    # Set up which occurrences get (all or years specific)
+    if config["range_years"] and config["year_buckets"]:
+        raise Exception("range_years and year_buckets cannot be used together. Use query_years.py to get a range from the buckets")
+    if config["range_years"]:
+        dir_years = config["range_years"]
+    elif config["year_buckets"]:
+        dir_years = "buckets_" + str(config["year_buckets"])
     else:
-        vocab_dict[word] += value
-
-# Function to process the decompressed file
-def process_file(decompressed_file, size):
-    for line in decompressed_file:
-        # Read the line
-        modified_line = line.decode('utf-8')
-        # Split line into grams (first position) and years (following positions)
-        line_split = modified_line.split('\t')
-
-        # Get word and check if it is a valid gram
-        word = line_split[0]
-        if check_valid_word(word):
-            # Sum all occurrences among years
-            occurrences = get_value(line_split[1:])
-            update_counter(remove_punctuation(word), occurrences)
-
-        progress.update(task2, advance=1000/size)
-
-# Function to download, process, and write the data
-def download_process_write(num_file):
-    decompressed_file, size = download_decompress(num_file)
-    process_file(decompressed_file, size)
-    print("File loaded successfully.")
-    progress.update(task1, advance=1)
-    progress.reset(task2)
-    
-    # Save data after every 2 files are processed
-    if num_file % 2 == 0:
-        df = pd.DataFrame.from_dict(vocab_dict, orient="index")
-        df.to_csv('./'+dir_years+'/vocab_info.csv')
-        del df
-
-# Iterate through the files to download and process
-with Progress(transient=True) as progress:
-    task1 = progress.add_task("[blue]Percentage of total files analyzed...", total=18, visible=config["verbose"])
-    task2 = progress.add_task("[red]Processing file...", total=1000, visible=config["verbose"])
-
-    for num_file in range(6, 24):
-        download_process_write(num_file)
-
-    print("Saving data into a CSV file. This can take some minutes.")
-    vocab_dict = dict(sorted(vocab_dict.items(), key=lambda item: item[1], reverse=True))
-    df = pd.DataFrame.from_dict(vocab_dict, orient="index")
-    df.to_csv('./'+dir_years+'/vocab_info.csv')
\ No newline at end of file
+        dir_years = "all_years"
+
+    # Create folder for the specified years, and for the checkpoints of every shard
+    create_folder(dir_years)
+    if not config["read"] and os.path.isdir(dir_years + "/vocab_shards"):
+        shutil.rmtree(dir_years + "/vocab_shards")
+    create_folder(dir_years + "/vocab_shards")
+
+    all_files = range(start_files, total_files)
+    processed_files = processed_shards(dir_years) if config["read"] else set()
+    files = [num_file for num_file in all_files if num_file not in processed_files]
+    verbose(len(all_files) - len(files), "files already processed,", len(files), "to go.")
+
+    # Worker processes parse the shards outside the GIL and report their progress through a queue
+    threads = int(config["threads"])
+    progress_queue = multiprocessing.Queue()
+    step = math.ceil(len(files) / threads)
+    ranges = [files[i * step:(i + 1) * step] for i in range(threads)]
+
+    with Progress(transient=True) as progress, concurrent.futures.ProcessPoolExecutor(
+            max_workers=threads, initializer=init_worker,
+            initargs=(config["range_years"], config["year_buckets"], dir_years, config["url_base"], config["local_dir"], progress_queue,
+                      config["profile"], fetcher_options(config))) as executor:
+        task1 = progress.add_task("[blue]Percentage of total files analyzed...", total=len(all_files),
+                                  completed=len(all_files) - len(files), visible=config["verbose"])
+        worker_tasks = [progress.add_task(f"[red]Processing file (Worker {worker + 1})...", total=1000, visible=config["verbose"])
+                        for worker in range(threads)]
+        listener = threading.Thread(target=listen_progress, args=(progress_queue, progress, task1, worker_tasks))
+        listener.start()
+
+        futures = [executor.submit(process_range, worker, worker_files, total_files) for worker, worker_files in enumerate(ranges)]
+        for future in concurrent.futures.as_completed(futures):
+            worker, saved, file_stats = future.result()
+            for num_file, stats in file_stats:
+                metrics.add_stage("checkpoint", stats.pop("checkpoint_seconds"), num_file=num_file)
+                worker_rss = stats.pop("worker_rss_bytes")
+                metrics.set(accumulator_entries=stats.pop("accumulator_entries"), worker_rss_bytes=worker_rss)
+                metrics.shard(num_file, stats, worker=worker, worker_rss_bytes=worker_rss)
+            verbose("Worker", worker + 1, "saved files", saved, "at", datetime.datetime.now().strftime("%H:%M:%S"))
+            processed_files.update(saved)
+
+        progress_queue.put(None)
+        listener.join()
+
+    missing = [num_file for num_file in all_files if num_file not in processed_files]
+    if missing:
+        raise SystemExit("Files " + str(missing) + " could not be processed. Run again with -r to retry them")
+
+    print("Merging the files and saving the vocabulary into a CSV file.")
+    with metrics.stage("merge", files=len(all_files)):
+        vocab_dict, vocab_buckets = merge_checkpoints(dir_years, all_files)
+    metrics.set(vocab_entries=len(vocab_dict))
+    vocab_size = int(config["vocab_size"]) if config["vocab_size"] else None
+    with metrics.stage("save"):
+        save_vocab('./'+dir_years+'/vocab_info.csv', vocab_dict, vocab_size)
+        if config["year_buckets"]:
+            save_buckets('./'+dir_years+'/vocab_buckets.csv', vocab_dict, vocab_buckets)
+    print("Vocabulary saved with", len(vocab_dict) if vocab_size is None else min(vocab_size, len(vocab_dict)), "words")
+    metrics.close()
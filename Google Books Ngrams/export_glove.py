@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Export the merged co-occurrences as the files GloVe trains on: vocab.txt and a
+# shuffled binary file of CREC records, without the CSV and binary intermediates
+# of merge_and_PMI.py, convert_cooccurrence_to_bin.py and the shuffle tool.
+#
+# The merged counts are read once, in chunks. If the records fit in the memory
+# budget they are shuffled in memory and written at once. Otherwise every record
+# is sent to a random block (a temporary file small enough for the budget), and
+# then each block is shuffled in memory and appended to the output. Random blocks
+# shuffled inside give a uniform shuffle of the whole file.
+
+import argparse
+import csv
+import math
+import os
+import shutil
+import time
+import numpy as np
+from cooccurrence import load_snapshot_arrays, merge_folder_if_changed, unpack_keys
+from glove_io import CREC
+from pmi import MEASURES, calculate_PMI, load_frequencies
+from pipeline_metrics import PipelineMetrics
+
+parser = argparse.ArgumentParser(description="Script to write the vocabulary and the shuffled co-occurrence records used to train GloVe.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-d", "--input_dir", default="./cooccurrence_info/", help="folder with the co-occurrence files to merge")
+parser.add_argument("--merged", default="merged_cooccurrence.cooc", help="""snapshot with the merged counts (written by merge_and_PMI.py or here). It is reused
+                    while the files of input_dir do not change (their names, sizes and dates are saved in <merged>.inputs)""")
+parser.add_argument("--reuse_merged", action="store_true", help="reuse the merged snapshot if it exists, without checking the files of input_dir")
+parser.add_argument("--vocab", default="./vocab_info.csv", help="vocabulary file with the frequency of every word")
+parser.add_argument("-k", "--vocab_size", default=100000, help="number of words of the vocabulary to keep")
+parser.add_argument("-m", "--measure", default="pmi", choices=["count"] + MEASURES, help="value of every record: the co-occurrence count, or a PMI variant like merge_and_PMI.py")
+parser.add_argument("--shift", default=1, help="shift used by spmi and sppmi")
+parser.add_argument("--symmetric", action="store_true", help="write every pair in both directions, (word1, word2) and (word2, word1)")
+parser.add_argument("-o", "--output", default="glove_model/new_cooccurrence.shuf.bin", help="shuffled binary file of CREC records")
+parser.add_argument("--vocab_output", default="glove_model/vocab.txt", help="vocabulary file for GloVe")
+parser.add_argument("--memory", default=4.0, help="memory budget for the merge and the shuffle, in GB (like the -memory option of the shuffle tool)")
+parser.add_argument("-c", "--chunk_size", default=1000000, help="number of pairs computed at once")
+parser.add_argument("--seed", default=None, help="seed of the shuffle")
+parser.add_argument("--metrics", default=None, help="file where the metrics of the stages are written as JSON lines (or a Prometheus textfile if it ends in .prom)")
+args = parser.parse_args()
+config = vars(args)
+metrics = PipelineMetrics("export_glove", config["metrics"])
+
+chunk_size = int(config["chunk_size"])
+vocab_size = int(config["vocab_size"])
+rng = np.random.default_rng(None if config["seed"] is None else int(config["seed"]))
+
+with metrics.stage("merge"):
+    merge_folder_if_changed(config["input_dir"], config["merged"], memory_budget=float(config["memory"]) * 1024 ** 3,
+                            reuse=config["reuse_merged"])
+
+# Write the vocabulary like convert_vocab_to_txt.py, the line of a word is its id
+with open(config["vocab"], 'r') as csv_file, open(config["vocab_output"], 'w') as txt_file:
+    for num_row, row in enumerate(csv.reader(csv_file)):
+        if num_row >= vocab_size:
+            break
+        txt_file.write(" ".join(row) + "\n")
+print("Vocabulary written to", config["vocab_output"])
+
+# The merged counts are memory-mapped and processed in chunks
+keys, counts = load_snapshot_arrays(config["merged"])
+total_pairs = float(np.sum(counts, dtype=np.float64))
+freq, total_words = load_frequencies(config["vocab"], vocab_size)
+
+
+# Function to compute the records of a chunk of pairs
+def record_chunks():
+    for start in range(0, len(keys), chunk_size):
+        id_words1, id_words2 = unpack_keys(np.asarray(keys[start:start + chunk_size]))
+        chunk_counts = np.asarray(counts[start:start + chunk_size])
+        if config["measure"] == "count":
+            keep = (id_words1 < len(freq)) & (id_words2 < len(freq))
+            val = chunk_counts[keep].astype(np.float64)
+        else:
+            keep, val = calculate_PMI(id_words1, id_words2, chunk_counts, freq, total_pairs, total_words,
+                                      config["measure"], float(config["shift"]))
+        records = np.empty(len(val), dtype=CREC)
+        records["word1"], records["word2"], records["val"] = id_words1[keep], id_words2[keep], val
+        if config["symmetric"]:
+            swapped = records.copy()
+            swapped["word1"], swapped["word2"] = records["word2"], records["word1"]
+            # The diagonal is written once
+            records = np.concatenate((records, swapped[swapped["word1"] != swapped["word2"]]))
+        yield records
+
+
+# Number of blocks so that one of them fits in the budget. The pairs of the input bound the records
+# (twice with --symmetric), and the shuffle needs about twice the size of the block
+max_records = len(keys) * (2 if config["symmetric"] else 1)
+budget_records = max(int(float(config["memory"]) * 1024 ** 3 / (2 * CREC.itemsize)), 1)
+blocks = max(math.ceil(max_records / budget_records), 1)
+
+total = 0
+start_time = time.perf_counter()
+if blocks == 1:
+    records = np.concatenate(list(record_chunks())) if len(keys) else np.empty(0, dtype=CREC)
+    rng.shuffle(records)
+    with open(config["output"], "wb") as f:
+        records.tofile(f)
+    total = len(records)
+else:
+    print("Shuffling in", blocks, "blocks")
+    tmp_dir = config["output"] + ".blocks"
+    os.makedirs(tmp_dir, exist_ok=True)
+    block_files = [open(os.path.join(tmp_dir, str(block) + ".bin"), "wb") for block in range(blocks)]
+    try:
+        # Every record goes to a random block
+        for records in record_chunks():
+            block = rng.integers(0, blocks, len(records))
+            order = np.argsort(block, kind="stable")
+            bounds = np.searchsorted(block[order], np.arange(blocks + 1))
+            records = records[order]
+            for b in range(blocks):
+                records[bounds[b]:bounds[b + 1]].tofile(block_files[b])
+        for block_file in block_files:
+            block_file.close()
+
+        # Every block is shuffled in memory and appended to the output
+        with open(config["output"], "wb") as f:
+            for b in range(blocks):
+                records = np.fromfile(os.path.join(tmp_dir, str(b) + ".bin"), dtype=CREC)
+                rng.shuffle(records)
+                records.tofile(f)
+                total += len(records)
+                os.remove(os.path.join(tmp_dir, str(b) + ".bin"))
+    finally:
+        for block_file in block_files:
+            block_file.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+metrics.add_stage("shuffle", time.perf_counter() - start_time, blocks=blocks)
+metrics.add(records=total)
+print(total, "shuffled records written to", config["output"])
+metrics.close()
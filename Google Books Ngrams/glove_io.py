@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# Files read and written by the GloVe tool.
+
+import os
+
+import numpy as np
+
+# Same layout as the CREC struct of GloVe: {int word1; int word2; double val;} (16 bytes, no padding)
+CREC = np.dtype([("word1", "<i4"), ("word2", "<i4"), ("val", "<f8")])
+
+
+# Function to write a chunk of records with a single call
+def write_records(bin_file, word1, word2, val):
+    records = np.empty(len(word1), dtype=CREC)
+    records["word1"] = word1
+    records["word2"] = word2
+    records["val"] = val
+    records.tofile(bin_file)
+    return len(records)
+
+
+# Function to memory-map a file of CREC records
+def read_records(file_path):
+    if os.path.getsize(file_path) == 0:
+        return np.empty(0, dtype=CREC)
+    return np.memmap(file_path, dtype=CREC, mode="r")
+
+
+# Columnar co-occurrences: a folder with word1.npy, word2.npy and val.npy
+def is_columnar(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "val.npy"))
+
+
+def open_columnar(path, size=None):
+    if size is None:
+        return tuple(np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in CREC.names)
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    return tuple(np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=CREC[name], shape=(size,))
+                 for name in CREC.names)
@@ -34,9 +34,14 @@ else
     PYTHON=python3
 fi
 
-echo
-echo "$ $BUILDDIR/shuffle -memory $MEMORY -verbose $VERBOSE < $COOCCURRENCE_FILE > $COOCCURRENCE_SHUF_FILE"
-$BUILDDIR/shuffle -memory $MEMORY -verbose $VERBOSE < $COOCCURRENCE_FILE > $COOCCURRENCE_SHUF_FILE
+# export_glove.py writes $VOCAB_FILE and $COOCCURRENCE_SHUF_FILE already shuffled, then there is nothing to shuffle
+if [ -f $COOCCURRENCE_SHUF_FILE ] && [ ! -f $COOCCURRENCE_FILE ]; then
+    echo "Using $COOCCURRENCE_SHUF_FILE"
+else
+    echo
+    echo "$ $BUILDDIR/shuffle -memory $MEMORY -verbose $VERBOSE < $COOCCURRENCE_FILE > $COOCCURRENCE_SHUF_FILE"
+    $BUILDDIR/shuffle -memory $MEMORY -verbose $VERBOSE < $COOCCURRENCE_FILE > $COOCCURRENCE_SHUF_FILE
+fi
 echo "$ $BUILDDIR/glove -save-file $SAVE_FILE -threads $NUM_THREADS -input-file $COOCCURRENCE_SHUF_FILE -x-max $X_MAX -iter $MAX_ITER -vector-size $VECTOR_SIZE -binary $BINARY -vocab-file $VOCAB_FILE -verbose $VERBOSE -checkpoint-every $CHECKPOINT -seed $SEED -save-init-param $SAVE_INIT_PARAM -load-init-param $LOAD_INIT_PARAM -init-param-file $INIT_PARAM_FILE"
 $BUILDDIR/glove -save-file $SAVE_FILE -threads $NUM_THREADS -input-file $COOCCURRENCE_SHUF_FILE -x-max $X_MAX -iter $MAX_ITER -vector-size $VECTOR_SIZE -binary $BINARY -vocab-file $VOCAB_FILE -verbose $VERBOSE -checkpoint-every $CHECKPOINT -seed $SEED -save-init-param $SAVE_INIT_PARAM -load-init-param $LOAD_INIT_PARAM -init-param-file $INIT_PARAM_FILE
 
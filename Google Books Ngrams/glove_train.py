@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# GloVe trained in Python over the memory-mapped CREC file written for the C tool.
+#
+# The parameters and their AdaGrad accumulators live in two memory-mapped files
+# with the layout of the vectors.bin of GloVe: 2 * vocab_size rows of
+# vector_size + 1 doubles (word vectors and bias, then context vectors and bias).
+# Every process maps them and updates them without locks (Hogwild), each one
+# over its own part of the shuffled records, in vectorized minibatches. Both
+# files are copied after every iteration (<file>.<iter>) before a small state
+# file records it. An interrupted iteration has already applied part of its
+# updates, so a resumed training restores the copy of the last iteration and
+# runs the interrupted one again from the same parameters.
+
+import argparse
+import concurrent.futures
+import glob
+import io
+import json
+import os
+import shutil
+import time
+import numpy as np
+from glove_io import read_records
+from pipeline_metrics import PipelineMetrics
+
+parser = argparse.ArgumentParser(description="Script to train GloVe vectors from the co-occurrence records, like the glove tool of demo.sh.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-i", "--input_file", default="new_cooccurrence.shuf.bin", help="binary file of shuffled CREC records")
+parser.add_argument("--vocab_file", default="vocab.txt", help="vocabulary file, the line of a word is its id")
+parser.add_argument("-s", "--save_file", default="vectors", help="prefix of the files of vectors (.txt, .bin) and of the training state")
+parser.add_argument("-d", "--vector_size", default=768, help="dimension of the vectors")
+parser.add_argument("--iter", default=5, help="number of iterations over the records")
+parser.add_argument("--x_max", default=100, help="cutoff of the weighting function")
+parser.add_argument("--alpha", default=0.75, help="exponent of the weighting function")
+parser.add_argument("--eta", default=0.05, help="initial learning rate")
+parser.add_argument("-t", "--threads", default=1, help="number of processes updating the shared parameters")
+parser.add_argument("-b", "--batch_size", default=64, help="""records of every vectorized update. The steps of a word in a minibatch are averaged, so larger
+                    minibatches process more records per second but learn less per iteration: 64 is about as good per iteration as the
+                    per-record updates of the glove tool, 1024 is around 1.3x faster per iteration but converges much slower""")
+parser.add_argument("--binary", default=2, choices=["0", "1", "2"], help="save the vectors as text (0), binary (1) or both (2)")
+parser.add_argument("--model", default=2, choices=["0", "1", "2"], help="vectors of the text file: all the parameters (0), word vectors (1) or word + context vectors (2)")
+parser.add_argument("--checkpoint_every", default=0, help="save the vectors every this number of iterations, as <save_file>.<iter>. 0 disables it")
+parser.add_argument("--seed", default=23, help="seed of the initialization")
+parser.add_argument("-r", "--resume", action="store_true", help="continue an interrupted training from the parameters of its last complete iteration")
+parser.add_argument("--metrics", default=None, help="file where the metrics of every iteration are written as JSON lines (or a Prometheus textfile if it ends in .prom)")
+
+
+# Function to read the words of vocab.txt ("word count" lines)
+def read_vocab(file_path):
+    with open(file_path, 'r') as f:
+        return [line.rstrip("\n").rsplit(" ", 1)[0] for line in f]
+
+
+# Function to open the parameters (and AdaGrad accumulators) file
+def open_params(file_path, vocab_size, vector_size, mode="r+"):
+    return np.memmap(file_path, dtype=np.float64, mode=mode, shape=(2 * vocab_size, vector_size + 1))
+
+
+# Function to update the parameters with a minibatch of records, with an AdaGrad step per
+# row. Returns the cost of the minibatch
+def update(W, gradsq, records, vocab_size, vector_size, x_max, alpha, eta):
+    # Ids start at 1, context vectors are after the word vectors
+    rows_i = records["word1"].astype(np.int64) - 1
+    rows_j = records["word2"].astype(np.int64) - 1 + vocab_size
+    x = records["val"]
+    w_i, w_j = W[rows_i], W[rows_j]
+
+    diff = np.einsum("ij,ij->i", w_i[:, :vector_size], w_j[:, :vector_size]) + w_i[:, vector_size] + w_j[:, vector_size] - np.log(x)
+    fdiff = np.where(x > x_max, diff, np.power(x / x_max, alpha) * diff)
+    cost = 0.5 * np.dot(fdiff, diff)
+    fdiff *= eta
+
+    grads = np.empty((2 * len(records), vector_size + 1))
+    grads[:len(records), :vector_size] = fdiff[:, None] * w_j[:, :vector_size]
+    grads[len(records):, :vector_size] = fdiff[:, None] * w_i[:, :vector_size]
+    grads[:len(records), vector_size] = fdiff
+    grads[len(records):, vector_size] = fdiff
+
+    # A frequent word appears many times in a minibatch. Every gradient of a row is scaled by the
+    # accumulator it would have in a sequential AdaGrad: the saved one plus the squares of the
+    # previous gradients of that row in the minibatch (a cumulative sum inside every row)
+    rows = np.concatenate((rows_i, rows_j))
+    order = np.argsort(rows, kind="stable")
+    rows, grads = rows[order], grads[order]
+    starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    squares = grads ** 2
+    previous = np.cumsum(squares, axis=0) - squares
+    previous -= np.repeat(previous[starts], np.diff(np.append(starts, len(rows))), axis=0)
+    steps = grads / np.sqrt(gradsq[rows] + previous)
+
+    # The gradients of a minibatch are all computed with the same parameters, so the steps of
+    # a row are averaged: summed, thousands of steps of a frequent word in the same direction diverge
+    rows = rows[starts]
+    W[rows] -= np.add.reduceat(steps, starts) / np.diff(np.append(starts, len(order)))[:, None]
+    gradsq[rows] += np.add.reduceat(squares, starts)
+    return cost
+
+
+# Job of a process: one pass over a part of the records. Returns its cost and number of records
+def train_part(input_file, params_file, gradsq_file, start, end, vocab_size, vector_size, batch_size, x_max, alpha, eta):
+    records = read_records(input_file)
+    W = open_params(params_file, vocab_size, vector_size)
+    gradsq = open_params(gradsq_file, vocab_size, vector_size)
+    cost, n_records = 0.0, 0
+    for batch_start in range(start, end, batch_size):
+        batch = np.asarray(records[batch_start:min(batch_start + batch_size, end)])
+        # log(x) needs positive values (PMI can be negative) and the ids must be in the vocabulary
+        batch = batch[(batch["val"] > 0) & (batch["word1"] >= 1) & (batch["word1"] <= vocab_size)
+                      & (batch["word2"] >= 1) & (batch["word2"] <= vocab_size)]
+        if len(batch):
+            cost += update(W, gradsq, batch, vocab_size, vector_size, x_max, alpha, eta)
+            n_records += len(batch)
+    W.flush()
+    gradsq.flush()
+    return cost, n_records
+
+
+# Function to save the vectors like GloVe: a binary file with every parameter and/or a text file
+# with a "word v1 v2 ..." line per word
+def save_vectors(W, words, prefix, binary, model, vector_size):
+    vocab_size = len(words)
+    if binary > 0:
+        np.asarray(W, dtype="<f8").tofile(prefix + ".bin")
+    if binary != 1:
+        with open(prefix + ".txt", "w") as f:
+            for start in range(0, vocab_size, 10000):
+                end = min(start + 10000, vocab_size)
+                if model == 0:
+                    vectors = np.hstack((W[start:end], W[vocab_size + start:vocab_size + end]))
+                elif model == 1:
+                    vectors = W[start:end, :vector_size]
+                else:
+                    vectors = W[start:end, :vector_size] + W[vocab_size + start:vocab_size + end, :vector_size]
+                text = io.StringIO()
+                np.savetxt(text, vectors, fmt="%f", delimiter=" ")
+                f.writelines(word + " " + line + "\n" for word, line in zip(words[start:end], text.getvalue().splitlines()))
+
+
+# Function to save the number of iterations done, written to a temporary file and renamed
+def save_state(file_path, state):
+    with open(file_path + ".tmp", "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(file_path + ".tmp", file_path)
+
+
+# Function to copy the parameters and accumulators at the end of an iteration, as <file>.<iter>
+def save_snapshot(files, iteration):
+    for file_path in files:
+        shutil.copyfile(file_path, file_path + ".tmp")
+        with open(file_path + ".tmp", "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(file_path + ".tmp", file_path + "." + str(iteration))
+
+
+# Function to remove the copies of the iterations other than the one kept
+def remove_snapshots(files, keep):
+    for file_path in files:
+        for snapshot in glob.glob(glob.escape(file_path) + ".*"):
+            suffix = snapshot[len(file_path) + 1:]
+            if suffix.isdigit() and int(suffix) != keep:
+                os.remove(snapshot)
+
+
+# Function to restore the parameters and accumulators copied at the end of an iteration
+def restore_snapshot(files, iteration):
+    for file_path in files:
+        shutil.copyfile(file_path + "." + str(iteration), file_path)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = vars(args)
+    metrics = PipelineMetrics("glove_train", config["metrics"])
+
+    vector_size = int(config["vector_size"])
+    threads = int(config["threads"])
+    batch_size = int(config["batch_size"])
+    x_max, alpha, eta = float(config["x_max"]), float(config["alpha"]), float(config["eta"])
+    params_file = config["save_file"] + ".params"
+    gradsq_file = config["save_file"] + ".gradsq"
+    state_file = config["save_file"] + ".state.json"
+    param_files = (params_file, gradsq_file)
+
+    words = read_vocab(config["vocab_file"])
+    vocab_size = len(words)
+    records = read_records(config["input_file"])
+    n_records = len(records)
+    del records
+    print("Vocab size:", vocab_size, "- records:", n_records, "- vector size:", vector_size)
+
+    state = {"iter": 0, "vocab_size": vocab_size, "vector_size": vector_size}
+    if config["resume"] and os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+        if state["vocab_size"] != vocab_size or state["vector_size"] != vector_size:
+            raise Exception("The saved training has a different vocabulary or vector size")
+        # The parameters may have part of the updates of an interrupted iteration
+        if os.path.exists(params_file + "." + str(state["iter"])) and os.path.exists(gradsq_file + "." + str(state["iter"])):
+            restore_snapshot(param_files, state["iter"])
+        else:
+            print("Warning: no copy of the parameters of iteration", state["iter"], "- resuming from the parameters as they are")
+        remove_snapshots(param_files, state["iter"])
+        print("Resuming after iteration", state["iter"])
+    else:
+        # Same initialization as GloVe: uniform in [-0.5, 0.5] / vector_size, and accumulators at 1
+        rng = np.random.default_rng(int(config["seed"]))
+        W = open_params(params_file, vocab_size, vector_size, mode="w+")
+        W[:] = (rng.random(W.shape) - 0.5) / vector_size
+        W.flush()
+        gradsq = open_params(gradsq_file, vocab_size, vector_size, mode="w+")
+        gradsq[:] = 1.0
+        gradsq.flush()
+        del W, gradsq
+        save_snapshot(param_files, 0)
+        save_state(state_file, state)
+        remove_snapshots(param_files, 0)
+
+    # Every process takes a contiguous part of the (already shuffled) records
+    bounds = np.linspace(0, n_records, threads + 1).astype(np.int64)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=threads) if threads > 1 else None
+    checkpoint_every = int(config["checkpoint_every"])
+
+    for iteration in range(state["iter"] + 1, int(config["iter"]) + 1):
+        start_time = time.perf_counter()
+        part_args = [(config["input_file"], params_file, gradsq_file, bounds[i], bounds[i + 1],
+                      vocab_size, vector_size, batch_size, x_max, alpha, eta) for i in range(threads)]
+        if executor is None:
+            results = [train_part(*part) for part in part_args]
+        else:
+            results = list(executor.map(train_part, *zip(*part_args)))
+        elapsed = time.perf_counter() - start_time
+        cost = sum(part_cost for part_cost, _ in results)
+        trained = sum(part_records for _, part_records in results)
+        metrics.add(records=trained)
+        metrics.add_stage("iteration", elapsed, iteration=iteration, cost=cost / max(trained, 1),
+                          records_per_second=trained / elapsed)
+
+        # The copy is saved before the state, so the state always has a copy of its iteration
+        save_snapshot(param_files, iteration)
+        state["iter"] = iteration
+        save_state(state_file, state)
+        remove_snapshots(param_files, iteration)
+        print("iter: {:03d}, cost: {:.6f}, {:,.0f} records/s, {:.1f}s".format(
+            iteration, cost / max(trained, 1), trained / elapsed, elapsed))
+
+        if checkpoint_every and iteration % checkpoint_every == 0:
+            save_vectors(open_params(params_file, vocab_size, vector_size, mode="r"), words,
+                         config["save_file"] + "." + str(iteration).zfill(3), int(config["binary"]), int(config["model"]), vector_size)
+
+    if executor is not None:
+        executor.shutdown()
+
+    save_vectors(open_params(params_file, vocab_size, vector_size, mode="r"), words,
+                 config["save_file"], int(config["binary"]), int(config["model"]), vector_size)
+    print("Vectors saved to", config["save_file"])
+    metrics.close()
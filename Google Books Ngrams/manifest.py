@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Manifest of the shards of a run, kept in a local SQLite database.
+#
+# Every shard of an n-gram and years folder has a state: pending, running, done
+# or failed. Workers claim the next pending shard in a transaction, so idle
+# workers take the next one instead of waiting for a fixed range, and failed
+# shards are claimed again until they reach the maximum number of attempts.
+# The primary key makes "is this shard done" a single lookup.
+
+import contextlib
+import datetime
+import os
+import sqlite3
+
+import pandas as pd
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Default path of the database, next to file_log.csv
+MANIFEST_FILE = "shard_manifest.sqlite"
+
+# Condition of the queries on the shards of the run
+SCOPE = "n_gram = ? AND years = ? AND num_file >= ? AND num_file < ?"
+# Condition of the shards that can be claimed
+CLAIMABLE = "(state = ? OR (state = ? AND attempts < ?))"
+
+
+class ShardManifest:
+    def __init__(self, n_gram, dir_years, start_files, end_files, db_path=MANIFEST_FILE, max_attempts=3):
+        self.n_gram = str(n_gram)
+        self.dir_years = dir_years
+        self.max_attempts = max_attempts
+        # Shards of this run, the queries do not see the rest
+        self.scope = (self.n_gram, dir_years, start_files, end_files)
+        # Autocommit mode: transactions are opened explicitly where they are needed
+        self.connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS shards (
+            n_gram TEXT NOT NULL,
+            years TEXT NOT NULL,
+            num_file INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker INTEGER,
+            updated TEXT,
+            error TEXT,
+            PRIMARY KEY (n_gram, years, num_file))""")
+
+    # Context of a write transaction. In autocommit mode "with self.connection" opens none, so every row
+    # of an executemany would be committed (and synced) on its own. BEGIN IMMEDIATE takes the write lock
+    @contextlib.contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    # Function to add the shards of the run. Shards already in the manifest keep their state
+    def add(self):
+        _, _, start_files, end_files = self.scope
+        with self.transaction():
+            self.connection.executemany("INSERT OR IGNORE INTO shards (n_gram, years, num_file, state) VALUES (?, ?, ?, ?)",
+                                        ((self.n_gram, self.dir_years, num_file, PENDING) for num_file in range(start_files, end_files)))
+
+    # Function to mark as done the shards of file_log.csv that were processed before the manifest existed
+    def import_log(self, log_file="file_log.csv"):
+        if not os.path.exists(log_file):
+            return
+        log_df = pd.read_csv(log_file, names=["date", "n-gram", "last_file_processed", "years_processed", "thread", "failed"],
+                             index_col=False, skiprows=[0])
+        done = log_df[(log_df["n-gram"].astype(str) == self.n_gram) & (log_df["years_processed"].astype(str) == self.dir_years)
+                      & log_df["failed"].isna()]
+        with self.transaction():
+            self.connection.executemany("UPDATE shards SET state = ? WHERE n_gram = ? AND years = ? AND num_file = ? AND state = ?",
+                                        ((DONE, self.n_gram, self.dir_years, int(num_file), PENDING)
+                                         for num_file in done["last_file_processed"]))
+
+    # Function to put back the shards left running by an interrupted run
+    def recover(self):
+        with self.transaction():
+            self.connection.execute("UPDATE shards SET state = ?, worker = NULL WHERE " + SCOPE + " AND state = ?",
+                                    (PENDING,) + self.scope + (RUNNING,))
+
+    # Function to claim the next shard to process, or None if there is nothing left.
+    # The write lock is taken before the select, so two workers never claim the same shard
+    def claim(self, worker):
+        with self.transaction():
+            row = self.connection.execute("SELECT num_file FROM shards WHERE " + SCOPE + " AND " + CLAIMABLE
+                                          + " ORDER BY attempts, num_file LIMIT 1",
+                                          self.scope + (PENDING, FAILED, self.max_attempts)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE shards SET state = ?, attempts = attempts + 1, worker = ?, updated = ? "
+                                        "WHERE n_gram = ? AND years = ? AND num_file = ?",
+                                        (RUNNING, worker, str(datetime.datetime.now()), self.n_gram, self.dir_years, row[0]))
+        return None if row is None else row[0]
+
+    def set_state(self, num_file, state, error=None):
+        with self.transaction():
+            self.connection.execute("UPDATE shards SET state = ?, updated = ?, error = ? WHERE n_gram = ? AND years = ? AND num_file = ?",
+                                    (state, str(datetime.datetime.now()), error, self.n_gram, self.dir_years, num_file))
+
+    def finish(self, num_file):
+        self.set_state(num_file, DONE)
+
+    def fail(self, num_file, error):
+        self.set_state(num_file, FAILED, str(error))
+
+    def is_done(self, num_file):
+        row = self.connection.execute("SELECT state FROM shards WHERE n_gram = ? AND years = ? AND num_file = ?",
+                                      (self.n_gram, self.dir_years, num_file)).fetchone()
+        return row is not None and row[0] == DONE
+
+    def done_files(self):
+        return {num_file for num_file, in self.connection.execute("SELECT num_file FROM shards WHERE " + SCOPE + " AND state = ?",
+                                                                  self.scope + (DONE,))}
+
+    # Function to know if some shard can still be claimed
+    def has_work(self):
+        row = self.connection.execute("SELECT 1 FROM shards WHERE " + SCOPE + " AND " + CLAIMABLE + " LIMIT 1",
+                                      self.scope + (PENDING, FAILED, self.max_attempts)).fetchone()
+        return row is not None
+
+    # Function to count the shards in every state
+    def counts(self):
+        counts = {state: 0 for state in (PENDING, RUNNING, DONE, FAILED)}
+        counts.update(self.connection.execute("SELECT state, COUNT(*) FROM shards WHERE " + SCOPE + " GROUP BY state",
+                                              self.scope).fetchall())
+        return counts
+
+    # Function to list the shards that failed every attempt, with their last error
+    def failed_files(self):
+        return self.connection.execute("SELECT num_file, error FROM shards WHERE " + SCOPE + " AND state = ? AND attempts >= ? ORDER BY num_file",
+                                       self.scope + (FAILED, self.max_attempts)).fetchall()
+
+    def close(self):
+        self.connection.close()
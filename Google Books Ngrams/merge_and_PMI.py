@@ -1,78 +1,89 @@
 #!/usr/bin/env python3
 
-import csv
-import math
+import argparse
 import os
+import numpy as np
 import pandas as pd
+from cooccurrence import load_snapshot_arrays, merge_folder_if_changed, unpack_keys
+from glove_io import open_columnar, write_records
+from pmi import MEASURES, calculate_PMI, load_frequencies
+from pipeline_metrics import PipelineMetrics
 
-# Function to read a CSV file containing key-value pairs and convert it to a dictionary
-def read_dict_csv_tuple(file_path):
-    result_dict = {}
-    with open(file_path, 'r') as file:
-        reader = csv.reader(file)
-        for i, row in enumerate(reader):
-            key = eval(row[0])
-            value = int(row[1])
-            result_dict[key] = value
-    return result_dict
+parser = argparse.ArgumentParser(description="Script to merge the co-occurrences of every n-gram and compute the PMI of each pair of words.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-d", "--input_dir", default="./cooccurrence_info/", help="folder with the co-occurrence files to merge (snapshots or CSV)")
+parser.add_argument("--vocab", default="./vocab_info.csv", help="vocabulary file with the frequency of every word")
+parser.add_argument("-k", "--vocab_size", default=100000, help="number of words of the vocabulary to keep")
+parser.add_argument("-m", "--measure", default="pmi", choices=MEASURES, help="pmi, positive pmi, shifted pmi (pmi - log2(shift)) or shifted positive pmi")
+parser.add_argument("--shift", default=1, help="shift used by spmi and sppmi (like the number of negative samples in word2vec)")
+parser.add_argument("-f", "--format", default="csv", choices=["csv", "bin", "columnar"], help="output format: CSV, binary file used by GloVe or a folder with one .npy per column")
+parser.add_argument("-o", "--output", default=None, help="output path. Default: final_cooccurrence.csv, new_cooccurrence.bin or final_cooccurrence/ depending on the format")
+parser.add_argument("--merged", default="merged_cooccurrence.cooc", help="""snapshot with the merged counts. It is reused while the files of input_dir do not change
+                    (their names, sizes and dates are saved in <merged>.inputs), so other PMI settings do not merge again""")
+parser.add_argument("--reuse_merged", action="store_true", help="reuse the merged snapshot if it exists, without checking the files of input_dir")
+parser.add_argument("-c", "--chunk_size", default=1000000, help="number of pairs computed at once")
+parser.add_argument("--memory_budget", default=None, help="memory budget of the merge in GB. The files are merged by streaming, reading a chunk of every file that fits in it")
+parser.add_argument("--metrics", default=None, help="file where the metrics of the stages are written as JSON lines (or a Prometheus textfile if it ends in .prom)")
+args = parser.parse_args()
+config = vars(args)
+metrics = PipelineMetrics("merge_and_PMI", config["metrics"])
 
-# Function to update dictionaries with values from another dictionary
-def update_dicts(d1, d2):
-    for key in d2.keys():
-        if key not in d1:
-            d1[key] = d2[key]
-        else:
-            d1[key] = d1[key] + d2[key]
-    return d1
+chunk_size = int(config["chunk_size"])
+default_outputs = {"csv": "final_cooccurrence.csv", "bin": "new_cooccurrence.bin", "columnar": "final_cooccurrence"}
+output = config["output"] or default_outputs[config["format"]]
 
-# Function to calculate Pointwise Mutual Information (PMI) for given values and words' frequencies
-def calculate_PMI(value, i_word1, i_word2):
-    word1 = vocab_id[i_word1]
-    word2 = vocab_id[i_word2]
-    freq_word1 = int(vocab_dict[word1])
-    freq_word2 = int(vocab_dict[word2])
-    PMI = math.log2((value/len(vocab_id))/((freq_word1/len(vocab_id))*(freq_word2/len(vocab_id))))
-    return PMI
+# Merge every file in the "cooccurrence_info" folder (snapshots or CSV), unless it was merged already
+with metrics.stage("merge"):
+    merge_folder_if_changed(config["input_dir"], config["merged"],
+                            memory_budget=float(config["memory_budget"]) * 1024 ** 3 if config["memory_budget"] else None,
+                            reuse=config["reuse_merged"])
 
-# List all files in the "cooccurrence_info" folder
-files = os.listdir("./cooccurrence_info/")
-print(files)
+# The merged counts are memory-mapped and processed in chunks
+keys, counts = load_snapshot_arrays(config["merged"])
+total_pairs = float(np.sum(counts, dtype=np.float64))
+metrics.set(merged_pairs=len(keys))
 
-# Initialize an empty dictionary to store merged co-occurrence information
-merged_dicts = {}
-
-# Loop through each file in the "cooccurrence_info" folder
-for file in files:
-    # Read co-occurrence information from the current file
-    d = read_dict_csv_tuple("./cooccurrence_info/"+file)
-
-    # Update the merged dictionary with the current co-occurrence information
-    merged_dicts = update_dicts(merged_dicts, d)
-    
-    # Clear the current dictionary for the next iteration
-    d.clear()
-    print("Dict loaded:", file)
-
-# Read vocabulary information from the "vocab_info.csv" file
-vocab = pd.read_csv("./vocab_info.csv", header=None)
-vocab_dict = vocab[:100000].set_index(0).to_dict()[1]
+# Read vocabulary frequencies, indexed by word id, and the total of the corpus
+freq, total_words = load_frequencies(config["vocab"], int(config["vocab_size"]))
 print("Vocab loaded.")
 
-# Delete the vocabulary DataFrame to free up memory
-del vocab
 
-# Create a mapping of index to vocabulary word
-vocab_id = {idx + 1: key for idx, key in enumerate(vocab_dict)}
+# Function to compute the PMI of a chunk of pairs. The pairs are only counted in the metrics by the
+# pass that writes them, the time of other passes goes to their own stage
+def pmi_chunks(stage="pmi"):
+    for start in range(0, len(keys), chunk_size):
+        id_words1, id_words2 = unpack_keys(np.asarray(keys[start:start + chunk_size]))
+        with metrics.stage(stage, pairs=len(id_words1)):
+            keep, PMI = calculate_PMI(id_words1, id_words2, np.asarray(counts[start:start + chunk_size]),
+                                      freq, total_pairs, total_words, config["measure"], float(config["shift"]))
+        if stage == "pmi":
+            metrics.add(pairs=len(id_words1), pairs_written=len(PMI))
+        yield id_words1[keep], id_words2[keep], PMI
 
-# Write the final co-occurrence information to a CSV file
-with open('final_cooccurrence.csv', 'w', newline='') as f:
-    writer = csv.writer(f)
-    for key in merged_dicts:
-        # Check if both words in the key are present in the vocabulary mapping
-        if key[0] in vocab_id and key[1] in vocab_id:
-            # Calculate PMI and write the line to the CSV file
-            line = [key[0], key[1], calculate_PMI(merged_dicts[key], key[0], key[1])]
-            writer.writerow(line)
-    
 
+# Write the final co-occurrence information
+total = 0
+if config["format"] == "csv":
+    with open(output, "w", newline="") as f:
+        for id_words1, id_words2, PMI in pmi_chunks():
+            pd.DataFrame({"word1": id_words1, "word2": id_words2, "PMI": PMI}).to_csv(f, header=False, index=False)
+            total += len(PMI)
+elif config["format"] == "bin":
+    with open(output, "wb") as f:
+        for id_words1, id_words2, PMI in pmi_chunks():
+            total += write_records(f, id_words1, id_words2, PMI)
+else:
+    # A first pass counts the pairs kept, so every column is written once at its final size
+    total = sum(len(PMI) for _, _, PMI in pmi_chunks(stage="pmi_count"))
+    word1, word2, val = open_columnar(output, total)
+    position = 0
+    for id_words1, id_words2, PMI in pmi_chunks():
+        word1[position:position + len(PMI)] = id_words1
+        word2[position:position + len(PMI)] = id_words2
+        val[position:position + len(PMI)] = PMI
+        position += len(PMI)
+    for column in (word1, word2, val):
+        column.flush()
 
+print(total, "pairs written to", output)
+metrics.close()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Metrics of the stages of the scripts, for long runs.
+#
+# A script creates a PipelineMetrics with the path given by --metrics. Events
+# (a shard processed, a stage finished, the memory of the process) are written
+# as JSON lines to that file, or, if it ends in .prom, the totals are written
+# as a Prometheus textfile (for the textfile collector of node_exporter) every
+# time they change. A thread samples the RSS of the process every few seconds.
+# Without a path nothing is written and the calls only add up the totals.
+#
+# With --profile, the functions wrapped with profiled() (process_file) run
+# under cProfile and the stats are saved to that path when the script ends.
+
+import contextlib
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+
+import psutil
+
+# Seconds between two samples of the memory of the process
+RSS_INTERVAL = 10
+
+
+class PipelineMetrics:
+    def __init__(self, script, path=None, profile_path=None, interval=RSS_INTERVAL):
+        self.script = script
+        self.path = path
+        self.prometheus = bool(path) and path.endswith(".prom")
+        self.profile_path = profile_path
+        self.profiler = cProfile.Profile() if profile_path else None
+        self.totals = {}
+        self.gauges = {}
+        self.stages = {}
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.process = psutil.Process()
+        self.file = open(path, "a") if path and not self.prometheus else None
+        self.stop = threading.Event()
+        self.sampler = None
+        if path:
+            self.sampler = threading.Thread(target=self.sample_memory, args=(interval,), daemon=True)
+            self.sampler.start()
+
+    # Function to write an event (a JSON line, or the textfile with the totals)
+    def emit(self, event, **fields):
+        if not self.path:
+            return
+        with self.lock:
+            if self.prometheus:
+                self.write_textfile()
+            else:
+                record = {"time": round(time.time(), 3), "script": self.script, "pid": os.getpid(), "event": event}
+                record.update(fields)
+                self.file.write(json.dumps(record) + "\n")
+                self.file.flush()
+
+    # Function to add to the totals of the run (bytes, lines...)
+    def add(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.totals[name] = self.totals.get(name, 0) + value
+
+    # Function to set values that change along the run (entries of the accumulator, memory...)
+    def set(self, **gauges):
+        with self.lock:
+            self.gauges.update(gauges)
+
+    # Context to time a stage of the script. The seconds are summed per stage
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            self.add_stage(name, seconds, **fields)
+
+    def add_stage(self, name, seconds, **fields):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.emit("stage", stage=name, seconds=round(seconds, 6), **fields)
+
+    # Function to record a shard processed. stats has the compressed and decompressed bytes read,
+    # the lines, the valid lines (grams or words kept), the pairs found and the seconds it took
+    def shard(self, num_file, stats, **fields):
+        seconds = max(stats["seconds"], 1e-9)
+        self.add(shards=1, **stats)
+        self.emit("shard", num_file=num_file, **stats,
+                  download_bytes_per_second=round(stats["compressed_bytes"] / seconds, 1),
+                  decompress_mb_per_second=round(stats["decompressed_bytes"] / seconds / 1e6, 3),
+                  lines_per_second=round(stats["lines"] / seconds, 1),
+                  valid_ratio=round(stats["valid_lines"] / stats["lines"], 6) if stats["lines"] else 0.0,
+                  **fields)
+
+    # Function to record the size of an accumulator (a counter with len and nbytes)
+    def accumulator(self, counter, name="accumulator"):
+        self.set(**{name + "_entries": len(counter), name + "_bytes": int(counter.nbytes)})
+        self.emit(name, entries=len(counter), bytes=int(counter.nbytes))
+
+    def sample_memory(self, interval):
+        while not self.stop.wait(interval):
+            self.record_memory()
+
+    def record_memory(self):
+        rss = self.process.memory_info().rss
+        with self.lock:
+            self.gauges["rss_bytes"] = rss
+            self.gauges["peak_rss_bytes"] = max(self.gauges.get("peak_rss_bytes", 0), rss)
+        self.emit("memory", rss_bytes=rss)
+
+    # Function to wrap a function so that it runs under the profiler when --profile is given
+    def profiled(self, function):
+        if self.profiler is None:
+            return function
+
+        def wrapper(*args, **kwargs):
+            return self.profiler.runcall(function, *args, **kwargs)
+        return wrapper
+
+    # Function to write the totals, gauges and stages as a Prometheus textfile. It is written
+    # to a temporary file and renamed, so the collector never reads half a file
+    def write_textfile(self):
+        labels = 'script="' + self.script + '"'
+        lines = []
+        for kind, values in (("counter", self.totals), ("gauge", self.gauges)):
+            for name, value in sorted(values.items()):
+                metric = "ngrams_" + re.sub(r"[^a-zA-Z0-9_]", "_", name) + ("_total" if kind == "counter" else "")
+                lines.append("# TYPE " + metric + " " + kind)
+                lines.append(metric + "{" + labels + "} " + repr(float(value)))
+        lines.append("# TYPE ngrams_stage_seconds_total counter")
+        for name, seconds in sorted(self.stages.items()):
+            lines.append('ngrams_stage_seconds_total{' + labels + ',stage="' + name + '"} ' + repr(seconds))
+        lines.append("# TYPE ngrams_elapsed_seconds gauge")
+        lines.append("ngrams_elapsed_seconds{" + labels + "} " + repr(time.perf_counter() - self.start_time))
+        with open(self.path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+
+    # Function to stop the sampler and write the summary of the run (and the profile)
+    def close(self):
+        self.stop.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        if self.path:
+            self.record_memory()
+            self.emit("summary", seconds=round(time.perf_counter() - self.start_time, 3), totals=self.totals,
+                      gauges=self.gauges, stages={name: round(seconds, 6) for name, seconds in self.stages.items()})
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.profiler is not None:
+            self.save_profile()
+            print("Profile saved to", self.profile_path, "(python -m pstats", self.profile_path + ")")
+
+    # Function to save the stats of the profiler so far (workers save them after every job)
+    def save_profile(self):
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_path)
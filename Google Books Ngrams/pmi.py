@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Pointwise Mutual Information computed in bulk over arrays of (id1, id2, count).
+#
+# Probabilities are normalized with the corpus totals: the sum of all the
+# co-occurrence counts for p(x, y) and the sum of all the word frequencies for
+# p(x) and p(y). The word frequencies are kept in an array indexed by word id.
+
+import numpy as np
+import pandas as pd
+
+MEASURES = ["pmi", "ppmi", "spmi", "sppmi"]
+
+
+# Function to read vocab_info.csv as an array of frequencies indexed by word id (ids start at 1,
+# in the same order used by the n-gram scripts) and the total of frequencies of the whole file
+def load_frequencies(file_path, vocab_size=None):
+    vocab = pd.read_csv(file_path, header=None, usecols=[1], dtype={1: np.float64})[1].to_numpy()
+    total_words = float(np.nansum(vocab))
+    if vocab_size is not None:
+        vocab = vocab[:vocab_size]
+    freq = np.zeros(len(vocab) + 1, dtype=np.float64)
+    freq[1:] = np.nan_to_num(vocab)
+    return freq, total_words
+
+
+# Function to calculate the PMI (or a variant) of every pair at once.
+# Returns the mask of the pairs that are kept and their values
+def calculate_PMI(id_words1, id_words2, counts, freq, total_pairs, total_words, measure="pmi", shift=1):
+    if measure not in MEASURES:
+        raise ValueError("Measure should be one of " + str(MEASURES))
+    # Only pairs with both words in the vocabulary (and known frequency) are kept
+    keep = (id_words1 < len(freq)) & (id_words2 < len(freq))
+    freq_word1 = freq[np.where(keep, id_words1, 0)]
+    freq_word2 = freq[np.where(keep, id_words2, 0)]
+    keep &= (freq_word1 > 0) & (freq_word2 > 0) & (counts > 0)
+
+    counts = np.asarray(counts[keep], dtype=np.float64)
+    PMI = (np.log2(counts / total_pairs)
+           - np.log2(freq_word1[keep] / total_words)
+           - np.log2(freq_word2[keep] / total_words))
+    if measure in ("spmi", "sppmi"):
+        PMI -= np.log2(shift)
+    if measure in ("ppmi", "sppmi"):
+        # Positive variants are sparse: the pairs that would be 0 are not kept
+        positive = PMI > 0
+        keep[keep] = positive
+        PMI = PMI[positive]
+    return keep, PMI
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Build the vocabulary and the co-occurrences of a years range from the counts kept per bucket
+# of years (-w/--year_buckets), with the word ids a --range_years run would have given: every word
+# is kept (with 0 if it does not appear in the range) and equal frequencies keep the order in which
+# the words first appeared, which is the order of the rows of vocab_buckets.csv. The co-occurrences
+# are the same, except the pairs without occurrences in the range, which are not written (the run
+# keeps them with 0, they do not change the PMI).
+# A vocabulary of the range that already exists and differs is never overwritten, as the
+# co-occurrences saved with it would refer to other ids.
+
+import argparse
+import csv
+import filecmp
+import os
+import numpy as np
+import pandas as pd
+from cooccurrence import pack_pairs, save_snapshot, unpack_keys
+from vocab_engine import save_vocab
+from year_buckets import query_buckets
+from pipeline_metrics import PipelineMetrics
+
+parser = argparse.ArgumentParser(description="Script to obtain the vocabulary and co-occurrence matrix of a years range from the counts kept per bucket of years.",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("range_years", help="years range to build, like 1950-1999. It must be made of whole buckets")
+parser.add_argument("-w", "--year_buckets", default=10, help="number of years of every bucket. The counts are read from the buckets_<w> folder")
+parser.add_argument("-k", "--vocab_size", default=None, help="number of most frequent words written to vocab_info.csv, like -k of download_and_process_vocab.py. If default, all the words are written")
+parser.add_argument("-n", "--n_grams", default="2,3,4,5", help="n-grams to build, the ones without buckets are skipped")
+parser.add_argument("--metrics", default=None, help="file where the metrics of the stages are written as JSON lines (or a Prometheus textfile if it ends in .prom)")
+args = parser.parse_args()
+config = vars(args)
+metrics = PipelineMetrics("query_years", config["metrics"])
+
+dir_buckets = "buckets_" + str(config["year_buckets"])
+dir_years = config["range_years"]
+years = [int(year) for year in dir_years.split("-")]
+first_year, last_year = min(years), max(years)
+
+
+# Function to read the words of a vocab_info.csv in the order used to give the ids (the header row is id 1)
+def read_words(file_path):
+    with open(file_path, 'r') as file:
+        return [row[0] for row in csv.reader(file)]
+
+
+# Sum the frequencies of the buckets in the range and sort them like download_and_process_vocab.py
+vocab = pd.read_csv(dir_buckets + "/vocab_buckets.csv", keep_default_na=False)
+width = int(config["year_buckets"])
+partial = (vocab["bucket"] < first_year) & (vocab["bucket"] + width - 1 >= first_year) | \
+          (vocab["bucket"] <= last_year) & (vocab["bucket"] + width - 1 > last_year)
+if partial.any():
+    raise Exception("The range " + dir_years + " does not match the buckets of " + str(width) + " years")
+if not os.path.isdir(dir_years):
+    os.mkdir(dir_years)
+# Every word in the order it first appeared, including the ones without occurrences in the range
+words = vocab["word"].unique()
+vocab = vocab[(vocab["bucket"] >= first_year) & (vocab["bucket"] + width - 1 <= last_year)]
+frequencies = vocab.groupby("word", sort=False)["frequency"].sum().reindex(words, fill_value=0)
+vocab_dict = dict(zip(words.tolist(), frequencies.tolist()))
+del vocab, frequencies
+vocab_file = './' + dir_years + '/vocab_info.csv'
+save_vocab(vocab_file + ".tmp", vocab_dict, int(config["vocab_size"]) if config["vocab_size"] else None)
+if os.path.exists(vocab_file) and not filecmp.cmp(vocab_file, vocab_file + ".tmp", shallow=False):
+    os.remove(vocab_file + ".tmp")
+    raise Exception(vocab_file + " already exists with another vocabulary (the ids of its co-occurrences would change). Remove it to build the range from the buckets")
+os.replace(vocab_file + ".tmp", vocab_file)
+print("Vocabulary of", dir_years, "saved with", len(vocab_dict), "words")
+
+# The ids of the buckets follow their own vocabulary, they are translated to the ids of the new one
+new_id = {word: idx + 1 for idx, word in enumerate(read_words(vocab_file))}
+old_words = read_words(dir_buckets + "/vocab_info.csv")
+id_map = np.zeros(len(old_words) + 1, dtype=np.int64)
+id_map[1:] = [new_id.get(word, 0) for word in old_words]
+
+for n_gram in config["n_grams"].split(","):
+    folder = dir_buckets + "/" + n_gram + "-gram/cooccurrence_info.buckets"
+    if not os.path.isdir(folder):
+        continue
+    with metrics.stage("query", n_gram=n_gram):
+        keys, counts = query_buckets(folder, first_year, last_year).to_arrays()
+    id_words1, id_words2 = unpack_keys(keys)
+    id_words1, id_words2 = id_map[id_words1], id_map[id_words2]
+    # Words out of the vocabulary of the range are dropped
+    known = (id_words1 > 0) & (id_words2 > 0)
+    keys = pack_pairs(id_words1[known], id_words2[known])
+    order = np.argsort(keys)
+
+    if not os.path.isdir(dir_years + "/" + n_gram + "-gram"):
+        os.mkdir(dir_years + "/" + n_gram + "-gram")
+    save_snapshot(dir_years + "/" + n_gram + "-gram/cooccurrence_info.cooc", (keys[order], counts[known][order]))
+    print(n_gram + "-gram co-occurrences of", dir_years, "saved with", len(keys), "pairs")
+    metrics.add(pairs=len(keys))
+
+metrics.close()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# Fetching of the shards: pooled connections, resumable downloads and a local cache.
+#
+# ShardFetcher opens a shard like ShardStream (decompressed while it is read)
+# through a requests.Session with a pool of connections, which retries the
+# requests that fail with connection errors or 5xx answers. If the connection is
+# lost in the middle of a shard, the download goes on from the last byte read
+# with a Range request. If-Range carries the ETag (or the Last-Modified date),
+# so a shard changed on the server is never mixed with the bytes read before.
+#
+# With a cache folder, the compressed bytes are written to the cache while they
+# are read:
+#   parts/<sha1 of the url>.part   shards partly read. The next run reads these
+#                                  bytes from disk and requests only the rest
+#   objects/ab/<sha256>.gz         complete shards, named by their checksum
+#   cache.sqlite                   url -> checksum, size, ETag and last use
+# The md5 of x-goog-hash (sent by storage.googleapis.com) is checked when a shard
+# is complete. When the cache takes more than its size limit, the least recently
+# used shards are removed. In offline mode only the cache (and local paths) is read.
+#
+# prefetch_shards downloads the next shards in threads (into the cache, or into a
+# spool folder without one) while the current one is processed, so the network
+# and the parsing overlap. At most k shards are downloaded ahead.
+
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from shard_stream import ShardStream, TIMEOUT
+
+# Errors of a read in the middle of a shard after which the download is resumed
+RESUME_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, ConnectionError, TimeoutError)
+# Statuses retried by the session
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CACHE_FILE = "cache.sqlite"
+
+
+# Function to create a session with a pool of connections that retries the failed requests
+def make_session(retries=5, backoff=1.0, pool_size=8):
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                  allowed_methods=frozenset(["GET", "HEAD"]), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Function to read the md5 of an x-goog-hash header ("crc32c=...,md5=..."), or None
+def goog_md5(headers):
+    for value in headers.get("x-goog-hash", "").split(","):
+        name, _, digest = value.strip().partition("=")
+        if name == "md5":
+            return base64.b64decode(digest).hex()
+    return None
+
+
+class ShardCache:
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, "parts"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        # Autocommit mode, several worker processes share the cache. The threads of prefetch_shards
+        # share the connection, and take the lock around every use of it
+        self.connection = sqlite3.connect(os.path.join(cache_dir, CACHE_FILE), timeout=60, isolation_level=None,
+                                          check_same_thread=False)
+        self.lock = threading.RLock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS shards (
+            url TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            etag TEXT,
+            last_used TEXT NOT NULL)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS parts (
+            url TEXT PRIMARY KEY,
+            validator TEXT NOT NULL)""")
+
+    # Context of a write transaction. In autocommit mode "with self.connection" opens none.
+    # BEGIN IMMEDIATE takes the write lock of the database, for the other processes
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def object_path(self, sha256):
+        return os.path.join(self.cache_dir, "objects", sha256[:2], sha256 + ".gz")
+
+    def part_path(self, url):
+        return os.path.join(self.cache_dir, "parts", hashlib.sha1(url.encode("utf-8")).hexdigest() + ".part")
+
+    # Function to get the path of a cached shard, or None. Its last use is updated
+    def lookup(self, url):
+        with self.lock:
+            row = self.connection.execute("SELECT sha256 FROM shards WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            path = self.object_path(row[0])
+            if not os.path.exists(path):
+                self.connection.execute("DELETE FROM shards WHERE url = ?", (url,))
+                return None
+            self.connection.execute("UPDATE shards SET last_used = ? WHERE url = ?", (str(datetime.datetime.now()), url))
+            return path
+
+    # Function to get the part of a shard and the validator (ETag or Last-Modified) of its bytes
+    def partial(self, url):
+        path = self.part_path(url)
+        with self.lock:
+            row = self.connection.execute("SELECT validator FROM parts WHERE url = ?", (url,)).fetchone()
+        if row is None or not os.path.exists(path):
+            return path, None
+        return path, row[0]
+
+    def save_partial(self, url, validator):
+        if validator:
+            with self.lock:
+                self.connection.execute("INSERT OR REPLACE INTO parts (url, validator) VALUES (?, ?)", (url, validator))
+        else:
+            self.drop_partial(url)
+
+    def drop_partial(self, url):
+        with self.lock:
+            self.connection.execute("DELETE FROM parts WHERE url = ?", (url,))
+            path = self.part_path(url)
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Function to move a complete part to the objects, named by its checksum. Returns its path
+    def commit(self, url, sha256, size, etag):
+        path = self.object_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = self.part_path(url)
+        with self.transaction():
+            self.connection.execute("DELETE FROM parts WHERE url = ?", (url,))
+            self.connection.execute("INSERT OR REPLACE INTO shards (url, sha256, size, etag, last_used) VALUES (?, ?, ?, ?, ?)",
+                                    (url, sha256, size, etag, str(datetime.datetime.now())))
+            if os.path.exists(path):
+                # The same contents are cached already (under another url)
+                os.remove(part)
+            else:
+                os.replace(part, path)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes, keep=sha256)
+        return path
+
+    # Function to remove the least recently used shards until the cache takes at most max_bytes.
+    # A file is removed with the last url that uses it. Returns the urls removed
+    def evict(self, max_bytes, keep=None):
+        removed = []
+        with self.transaction():
+            rows = self.connection.execute("SELECT url, sha256, size, last_used FROM shards ORDER BY last_used").fetchall()
+            sizes = {sha256: size for _, sha256, size, _ in rows}
+            total = sum(sizes.values())
+            users = {}
+            for url, sha256, _, _ in rows:
+                users[sha256] = users.get(sha256, 0) + 1
+            for url, sha256, size, _ in rows:
+                if total <= max_bytes:
+                    break
+                if sha256 == keep:
+                    continue
+                self.connection.execute("DELETE FROM shards WHERE url = ?", (url,))
+                removed.append(url)
+                users[sha256] -= 1
+                if users[sha256] == 0:
+                    path = self.object_path(sha256)
+                    if os.path.exists(path):
+                        os.remove(path)
+                    total -= size
+        return removed
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM shards").fetchone()
+            parts = self.connection.execute("SELECT COUNT(*) FROM parts").fetchone()[0]
+        return {"shards": entries, "bytes": size, "parts": parts}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Compressed bytes of a shard from the server: a raw file for ShardStream. The bytes of a part
+# in the cache are read first, and the rest is requested from the server (and written to the part)
+class ResumableDownload:
+    def __init__(self, session, url, cache=None, resumes=5, backoff=1.0):
+        self.session = session
+        self.url = url
+        self.cache = cache
+        self.resumes = resumes
+        self.backoff = backoff
+        self.position = 0
+        self.complete = False
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        self.local = None
+        self.part = None
+        offset, validator = 0, None
+        if cache is not None:
+            part_path, validator = cache.partial(url)
+            if validator:
+                offset = os.path.getsize(part_path)
+        self.response = self.request(offset, validator)
+        headers = self.response.headers
+        length = headers.get("content-length")
+        if offset and self.response.status_code == 416:
+            # Nothing after the part: it has every byte (a run stopped before committing it) if the
+            # shard has its size and validator, otherwise the part is started again
+            self.response.close()
+            self.response = None
+            head = self.session.head(url, timeout=TIMEOUT, allow_redirects=True)
+            head.raise_for_status()
+            headers = head.headers
+            if (headers.get("ETag") or headers.get("Last-Modified")) != validator or headers.get("content-length") != str(offset):
+                cache.drop_partial(url)
+                offset = 0
+                self.response = self.request()
+                headers = self.response.headers
+                length = headers.get("content-length")
+            else:
+                length = "0"
+        elif offset and self.response.status_code != 206:
+            # The shard changed on the server (or it ignores ranges): the part is started again
+            offset = 0
+        self.validator = headers.get("ETag") or headers.get("Last-Modified")
+        self.etag = headers.get("ETag")
+        self.expected_md5 = goog_md5(headers)
+        self.size = offset + int(length) if length is not None else offset
+        if cache is not None:
+            if offset:
+                self.local = open(part_path, "rb")
+                self.local_size = offset
+            self.part = open(part_path, "ab" if offset else "wb")
+            cache.save_partial(url, self.validator)
+
+    # Function to request the shard from a byte. If-Range makes the server send the whole shard
+    # instead of the range if it changed
+    def request(self, offset=0, validator=None):
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes=" + str(offset) + "-"
+            if validator:
+                headers["If-Range"] = validator
+        response = self.session.get(self.url, headers=headers, stream=True, timeout=TIMEOUT)
+        if offset and response.status_code == 416:
+            # The range starts at the end of the shard
+            return response
+        response.raise_for_status()
+        # Let gzip do the decompression, the raw socket gives the compressed bytes
+        response.raw.decode_content = False
+        return response
+
+    # Function to request the rest of the shard after a lost connection. If the server sends it
+    # whole (it ignores ranges), the bytes already read are skipped
+    def resume(self):
+        self.response.close()
+        response = self.request(self.position, self.validator)
+        if response.status_code != 206:
+            if self.validator and self.validator != (response.headers.get("ETag") or response.headers.get("Last-Modified")):
+                response.close()
+                raise OSError(self.url + " changed on the server while it was read")
+            skip = self.position
+            while skip:
+                data = response.raw.read(min(skip, 1 << 20))
+                if not data:
+                    raise EOFError(self.url + " is shorter than the bytes already read")
+                skip -= len(data)
+        self.response = response
+
+    def read(self, size=-1):
+        if self.local is not None:
+            data = self.local.read(size if size >= 0 else self.local_size)
+            if data:
+                self.update(data)
+                return data
+            self.local.close()
+            self.local = None
+        # Without a response the part had every byte
+        data, attempts = b"", 0
+        while self.response is not None:
+            try:
+                data = self.response.raw.read(size if size >= 0 else None)
+                break
+            except RESUME_ERRORS:
+                if attempts >= self.resumes:
+                    raise
+                attempts += 1
+                time.sleep(self.backoff * attempts)
+                self.resume()
+        if data:
+            self.update(data)
+            if self.part is not None:
+                self.part.write(data)
+        elif not self.complete:
+            self.finish()
+        return data
+
+    def update(self, data):
+        self.position += len(data)
+        self.sha256.update(data)
+        self.md5.update(data)
+
+    # Function to check the shard when the server has sent all of it, and move it to the cache
+    def finish(self):
+        if self.size and self.position != self.size:
+            raise EOFError(self.url + ": " + str(self.position) + " bytes read of " + str(self.size))
+        if self.expected_md5 and self.md5.hexdigest() != self.expected_md5:
+            if self.cache is not None:
+                self.part.close()
+                self.part = None
+                self.cache.drop_partial(self.url)
+            raise OSError(self.url + " does not match its md5")
+        self.complete = True
+        if self.cache is not None:
+            self.part.close()
+            self.part = None
+            self.cache.commit(self.url, self.sha256.hexdigest(), self.position, self.etag)
+
+    def tell(self):
+        return self.position
+
+    # A shard not read to the end keeps its part in the cache, for the next run
+    def close(self):
+        if self.local is not None:
+            self.local.close()
+            self.local = None
+        if self.part is not None:
+            self.part.close()
+            self.part = None
+        if self.response is not None:
+            self.response.close()
+
+
+class ShardFetcher:
+    def __init__(self, cache_dir=None, max_bytes=None, offline=False, retries=5, backoff=1.0, pool_size=8):
+        self.cache = ShardCache(cache_dir, max_bytes) if cache_dir else None
+        self.offline = offline
+        self.backoff = backoff
+        self.retries = retries
+        self.session = make_session(retries, backoff, pool_size)
+
+    # Function to open a shard (an url or a local path) as a ShardStream, from the cache if it is there
+    def open(self, source):
+        if os.path.exists(source):
+            return ShardStream(source)
+        if self.cache is not None:
+            path = self.cache.lookup(source)
+            if path is not None:
+                return ShardStream(path)
+        if self.offline:
+            raise FileNotFoundError(source + " is not in the cache (offline mode)")
+        return ShardStream(source, raw=ResumableDownload(self.session, source, self.cache, self.retries, self.backoff))
+
+    # Function to download a shard without decompressing it: into the cache, or into spool_dir
+    # without a cache (the file is written with a temporary name and renamed). Returns the path
+    def download(self, source, spool_dir=None):
+        if os.path.exists(source):
+            return source
+        if self.cache is None and spool_dir is None:
+            raise ValueError("Shards can only be downloaded with a cache folder or a spool folder")
+        if self.cache is not None:
+            path = self.cache.lookup(source)
+            if path is not None:
+                return path
+        if self.offline:
+            raise FileNotFoundError(source + " is not in the cache (offline mode)")
+        download = ResumableDownload(self.session, source, self.cache, self.retries, self.backoff)
+        spool_path = os.path.join(spool_dir, source.split("/")[-1]) if self.cache is None else None
+        spool = open(spool_path + ".tmp", "wb") if spool_path else None
+        try:
+            while True:
+                data = download.read(1 << 20)
+                if not data:
+                    break
+                if spool is not None:
+                    spool.write(data)
+        finally:
+            download.close()
+            if spool is not None:
+                spool.close()
+        if spool_path is None:
+            return self.cache.lookup(source)
+        os.replace(spool_path + ".tmp", spool_path)
+        return spool_path
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+# Function to download the shards of sources in k threads, ahead of the one being processed. Yields
+# the local path of every shard, in order, and the seconds waited for it. A new download starts when
+# a shard is yielded, so at most k are downloaded ahead (k + 1 on disk). A shard spooled (without a
+# cache) is removed when the next one is requested
+def prefetch_shards(fetcher, sources, k, spool_dir=None):
+    sources = iter(sources)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=k)
+    downloads = collections.deque()
+    spooled = None
+    try:
+        for source in sources:
+            downloads.append((source, executor.submit(fetcher.download, source, spool_dir)))
+            if len(downloads) == k:
+                break
+        while downloads:
+            source, future = downloads.popleft()
+            start_time = time.perf_counter()
+            path = future.result()
+            seconds = time.perf_counter() - start_time
+            spooled = path if fetcher.cache is None and path != source else None
+            for next_source in sources:
+                downloads.append((next_source, executor.submit(fetcher.download, next_source, spool_dir)))
+                break
+            yield path, seconds
+            if spooled is not None:
+                os.remove(spooled)
+                spooled = None
+    finally:
+        # Downloads not started are cancelled and the running ones finish (their parts stay in the
+        # cache). The spool folder is left to the caller
+        executor.shutdown(wait=True, cancel_futures=True)
+        if spooled is not None and os.path.exists(spooled):
+            os.remove(spooled)
+
+
+# Function to read the options of the fetcher of the scripts (--cache_dir, --cache_gb and --offline)
+def fetcher_options(config):
+    return {"cache_dir": config["cache_dir"], "offline": config["offline"],
+            "max_bytes": int(float(config["cache_gb"]) * 1024 ** 3) if config["cache_gb"] else None}
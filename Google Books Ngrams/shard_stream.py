@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Streaming access to the gzip shards of Google Books Ngrams.
+#
+# The shards are decompressed incrementally while they are read from the socket
+# (or from a local file), so the memory used per shard is bounded by the gzip
+# buffers instead of the size of the whole compressed file, and parsing starts
+# as soon as the first bytes arrive.
+
+import gzip
+import os
+import zlib
+
+import requests
+import urllib3
+
+# Errors that can happen while a shard is being streamed (network, truncated or corrupted gzip)
+STREAM_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError, EOFError, zlib.error)
+
+# Seconds to wait for the server before giving up (connect, read)
+TIMEOUT = (30, 300)
+
+
+class ShardStream:
+    # Iterate over the decompressed lines (bytes) of a shard given by an url or a local path,
+    # or read from raw, a file object with the compressed bytes (see shard_fetcher.py)
+    def __init__(self, source, session=None, raw=None):
+        self.source = source
+        self._response = None
+        if raw is not None:
+            self._raw = raw
+            self.size = getattr(raw, "size", 0)
+        elif os.path.exists(source):
+            self._raw = open(source, "rb")
+            self.size = os.path.getsize(source)
+        else:
+            http = session if session is not None else requests
+            self._response = http.get(source, stream=True, timeout=TIMEOUT)
+            self._response.raise_for_status()
+            self._raw = self._response.raw
+            # Let gzip do the decompression, the raw socket gives the compressed bytes
+            self._raw.decode_content = False
+            self.size = int(self._response.headers.get("content-length", 0))
+        self._gzip = gzip.GzipFile(fileobj=self._raw, mode="rb")
+
+    def __iter__(self):
+        return iter(self._gzip)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    # Number of compressed bytes consumed so far (useful to report the progress)
+    def tell(self):
+        return self._raw.tell()
+
+    # Number of decompressed bytes read so far
+    def decompressed_tell(self):
+        return self._gzip.tell()
+
+    def close(self):
+        self._gzip.close()
+        self._raw.close()
+        if self._response is not None:
+            self._response.close()
+
+
+# Function to build the url (or the local path) of a shard
+def shard_name(n_gram, num_file, total_files):
+    return n_gram + "-" + str(num_file).zfill(5) + "-of-" + str(total_files).zfill(5) + ".gz"
+
+
+def shard_source(url_base, local_dir, n_gram, num_file, total_files):
+    name = shard_name(n_gram, num_file, total_files)
+    if local_dir and os.path.exists(os.path.join(local_dir, name)):
+        return os.path.join(local_dir, name)
+    return url_base + name
@@ -0,0 +1,115 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from cooccurrence import CooccurrenceCounter, pack_pairs
+
+
+# Reference counts: a dict of (smaller id, larger id) tuples
+def reference_of(id_words1, id_words2, counts, reference=None):
+    reference = {} if reference is None else reference
+    for id_word1, id_word2, count in zip(id_words1.tolist(), id_words2.tolist(), counts.tolist()):
+        pair = (min(id_word1, id_word2), max(id_word1, id_word2))
+        reference[pair] = reference.get(pair, 0) + count
+    return reference
+
+
+def random_pairs(rng, n, n_words):
+    return rng.integers(1, n_words, n), rng.integers(1, n_words, n), rng.integers(1, 1000, n)
+
+
+def counts_of(counter):
+    return {(id_word1, id_word2): count for id_word1, id_word2, count in counter.items()}
+
+
+# Keys of a counter with 16 slots that all hash to the same slot
+def colliding_keys(counter, slot, n):
+    keys = pack_pairs(np.arange(1, 200000), np.arange(2, 200001))
+    return keys[counter._slots(keys) == np.uint64(slot)][:n]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_random_pairs_match_the_reference(seed):
+    rng = np.random.default_rng(seed)
+    # The smallest table grows many times, with few words every batch repeats pairs
+    counter, reference = CooccurrenceCounter(capacity=2), {}
+    for _ in range(20):
+        id_words1, id_words2, counts = random_pairs(rng, int(rng.integers(1, 3000)), int(rng.integers(5, 300)))
+        counter.add_pairs(id_words1, id_words2, counts)
+        reference_of(id_words1, id_words2, counts, reference)
+    assert counts_of(counter) == reference
+    assert len(counter) == len(reference)
+    assert counter._bits > 4
+    for id_word1, id_word2 in list(reference)[:200]:
+        assert counter.get(id_word2, id_word1) == reference[(id_word1, id_word2)]
+    assert counter.get(1, 10 ** 6) == 0
+
+
+def test_duplicate_keys_in_one_call():
+    counter = CooccurrenceCounter(capacity=2)
+    counter.add_pairs(np.array([3, 5, 3, 5, 7]), np.array([5, 3, 5, 3, 7]), np.array([1, 2, 3, 4, 5]))
+    counter.add_keys(pack_pairs([3, 7], [5, 7]), np.array([10, 1]))
+    assert counts_of(counter) == {(3, 5): 20, (7, 7): 6}
+    assert len(counter) == 2
+
+
+def test_probe_collisions_and_wrap_around():
+    counter = CooccurrenceCounter(capacity=2, buffer_size=4)
+    assert counter._bits == 4
+    # Keys of the last slot probe past the end of the table, to the first slots
+    last = colliding_keys(counter, 15, 3)
+    first = colliding_keys(counter, 0, 2)
+    assert len(last) == 3 and len(first) == 2
+    counter.add_keys(last, np.array([1, 2, 3]))
+    counter.add_keys(np.concatenate((first, last[:1])), np.array([4, 5, 6]))
+    assert counter._bits == 4
+    keys, counts = counter.to_arrays()
+    assert dict(zip(keys.tolist(), counts.tolist())) == {int(last[0]): 7, int(last[1]): 2, int(last[2]): 3,
+                                                        int(first[0]): 4, int(first[1]): 5}
+    # An absent key of the same slot is looked up through the whole chain
+    absent = colliding_keys(counter, 15, 4)[3]
+    assert counter.get(int(absent >> np.uint64(32)), int(absent & np.uint64(0xFFFFFFFF))) == 0
+
+
+def test_single_adds_are_buffered():
+    rng = np.random.default_rng(3)
+    id_words1, id_words2, counts = random_pairs(rng, 5000, 100)
+    counter = CooccurrenceCounter(capacity=2, buffer_size=700)
+    for id_word1, id_word2, count in zip(id_words1.tolist(), id_words2.tolist(), counts.tolist()):
+        counter.add(id_word1, id_word2, count)
+    assert counts_of(counter) == reference_of(id_words1, id_words2, counts)
+
+
+def test_merge_and_to_arrays():
+    rng = np.random.default_rng(4)
+    first, second = random_pairs(rng, 4000, 200), random_pairs(rng, 4000, 200)
+    counter = CooccurrenceCounter()
+    counter.add_pairs(*first)
+    # Empty counters merge and convert to empty counters
+    other = CooccurrenceCounter().merge(CooccurrenceCounter())
+    assert len(other) == 0
+    other = CooccurrenceCounter.from_arrays(*other.to_arrays())
+    other.add_pairs(*second)
+    counter.merge(other)
+    assert counts_of(counter) == reference_of(*second, reference_of(*first))
+
+    keys, counts = counter.to_arrays()
+    assert keys.dtype == np.uint64 and counts.dtype == np.int64
+    assert np.all(keys[1:] > keys[:-1])
+    assert counts_of(CooccurrenceCounter.from_arrays(keys, counts)) == counts_of(counter)
+
+
+def test_pickle_keeps_the_buffer():
+    rng = np.random.default_rng(5)
+    id_words1, id_words2, counts = random_pairs(rng, 3000, 150)
+    counter = CooccurrenceCounter(buffer_size=10 ** 6)
+    counter.add_pairs(id_words1[:2000], id_words2[:2000], counts[:2000])
+    for id_word1, id_word2, count in zip(id_words1[2000:].tolist(), id_words2[2000:].tolist(), counts[2000:].tolist()):
+        counter.add(id_word1, id_word2, count)
+    restored = pickle.loads(pickle.dumps(counter))
+    assert restored.buffer_size == 10 ** 6
+    assert counts_of(restored) == reference_of(id_words1, id_words2, counts)
+
+    restored.clear()
+    assert len(restored) == 0 and counts_of(restored) == {}
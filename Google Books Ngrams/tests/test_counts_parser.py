@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from counts_parser import CountsParser
+
+LINES = [b"1900,5,1\t1951,7,2\n", b"1960,3,1\n", b"1800,1,1\t1955,2,1\t1999,4,2\r\n"]
+
+
+# Function to count the calls to the slow path
+def spy_slow(parser, monkeypatch):
+    calls = []
+    slow = parser.entries_slow
+
+    def entries_slow(fields):
+        calls.append(fields)
+        return slow(fields)
+    monkeypatch.setattr(parser, "entries_slow", entries_slow)
+    return calls
+
+
+def test_well_formed_lines_take_the_fast_path(monkeypatch):
+    parser = CountsParser("1950-1999")
+    calls = spy_slow(parser, monkeypatch)
+    assert parser.parse(LINES).tolist() == [7, 3, 6]
+    assert calls == []
+    entries, values = parser.entries(LINES)
+    slow_entries, slow_values = parser.entries_slow(LINES)
+    assert np.array_equal(entries, slow_entries) and np.array_equal(values, slow_values)
+
+
+@pytest.mark.parametrize("malformed", [
+    b"1900,5\t1951,7,2,9\n",      # right number of values, shifted entries
+    b"1951,7,2,9\t1952,1\n",      # right number of commas, shifted entries
+    b"1951,7\n",                  # missing value
+    b"1951,,2\n",                 # empty value
+    b"1951,7,2 3\n",              # space
+    b"1951,-7,2\n",               # sign
+])
+def test_malformed_line_falls_back(monkeypatch, malformed):
+    parser = CountsParser("1950-1999")
+    calls = spy_slow(parser, monkeypatch)
+    occurrences = parser.parse([LINES[0], malformed, LINES[1]])
+    assert len(calls) == 1
+    # The lines around the malformed one keep their own counts, and it gets only its valid entries
+    slow_parser = CountsParser("1950-1999")
+    slow_parser.entries = slow_parser.entries_slow
+    assert occurrences.tolist() == slow_parser.parse([LINES[0], malformed, LINES[1]]).tolist()
+    assert occurrences[0] == 7 and occurrences[2] == 3
+
+
+def test_buckets_fall_back_on_malformed_lines(monkeypatch):
+    parser = CountsParser()
+    calls = spy_slow(parser, monkeypatch)
+    lines, buckets, counts = parser.parse_buckets([b"1900,5\t1951,7,2,9\n", LINES[1]], 10)
+    assert len(calls) == 1
+    assert lines.tolist() == [1] and buckets.tolist() == [1960] and counts.tolist() == [3]
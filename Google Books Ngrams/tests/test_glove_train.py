@@ -0,0 +1,42 @@
+import glob
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from glove_io import write_records
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "glove_train.py")
+
+
+def train(work_dir, *options):
+    subprocess.run([sys.executable, SCRIPT, "-i", "records.bin", "--vocab_file", "vocab.txt", "-d", "4", "-b", "3",
+                    "--binary", "1", *options], cwd=str(work_dir), check=True, stdout=subprocess.DEVNULL)
+    return np.fromfile(os.path.join(str(work_dir), "vectors.bin"), dtype="<f8")
+
+
+def test_resume_restores_the_last_iteration(tmp_path):
+    rng = np.random.default_rng(5)
+    word1, word2, val = rng.integers(1, 7, 40), rng.integers(1, 7, 40), rng.random(40) * 10 + 1
+    for work_dir in (tmp_path / "straight", tmp_path / "resumed"):
+        os.mkdir(work_dir)
+        with open(work_dir / "vocab.txt", "w") as f:
+            f.write("".join("word{} {}\n".format(word, 100 - word) for word in range(6)))
+        with open(work_dir / "records.bin", "wb") as f:
+            write_records(f, word1, word2, val)
+
+    expected = train(tmp_path / "straight", "--iter", "2")
+
+    resumed = tmp_path / "resumed"
+    train(resumed, "--iter", "1")
+    assert sorted(os.path.basename(path) for path in glob.glob(str(resumed / "vectors.*"))) == \
+        ["vectors.bin", "vectors.gradsq", "vectors.gradsq.1", "vectors.params", "vectors.params.1", "vectors.state.json"]
+    # An interrupted second iteration leaves part of its updates in the parameters
+    params = np.memmap(resumed / "vectors.params", dtype=np.float64, mode="r+")
+    params[:10] += 0.5
+    params.flush()
+    del params
+
+    assert np.array_equal(train(resumed, "--iter", "2", "-r"), expected)
+    assert not os.path.exists(resumed / "vectors.params.1")
@@ -0,0 +1,56 @@
+import gzip
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+import vocab_engine
+from counts_parser import CountsParser
+from year_buckets import read_counter
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# The second line has no tab: it is counted as 0, like the counts of a line without years
+SHARD = b"house cat\t1950,3,1\t1960,2,1\nhouse dog\ncat dog\t1970,4,1\n"
+
+
+class Lines(io.BytesIO):
+    size = None
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.lines = data.splitlines(keepends=True)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+
+@pytest.mark.parametrize("script", ["download_and_process_n-grams.py", "download_and_process_n-grams_parallelized.py"])
+def test_lines_without_tab_count_zero(tmp_path, script):
+    os.makedirs(os.path.join(tmp_path, "shards"))
+    os.makedirs(os.path.join(tmp_path, "1950-1999"))
+    with open(os.path.join(tmp_path, "1950-1999", "vocab_info.csv"), "w") as f:
+        f.write(",0\nhouse,10\ncat,5\ndog,3\n")
+    with gzip.open(os.path.join(tmp_path, "shards", "2-00085-of-00589.gz"), "wb") as f:
+        f.write(SHARD)
+
+    command = [sys.executable, os.path.join(SCRIPTS, script), "2"]
+    if script.endswith("parallelized.py"):
+        command += ["1"]
+    command += ["-y", "1950-1999", "-s", "85", "-e", "86", "-v", "-l", "shards", "-u", "http://localhost:9/"]
+    subprocess.run(command, cwd=tmp_path, check=True, capture_output=True, timeout=60)
+
+    counter = read_counter(os.path.join(tmp_path, "1950-1999", "2-gram", "cooccurrence_info.cooc"))
+    counts = {(id_word1, id_word2): count for id_word1, id_word2, count in counter.items() if count}
+    assert counts == {(2, 3): 5, (3, 4): 4}
+
+
+def test_vocab_lines_without_tab_count_zero(monkeypatch):
+    monkeypatch.setattr(vocab_engine, "worker_config", {"progress_queue": None, "counts_parser": CountsParser("1950-1999"),
+                                                        "year_buckets": None})
+    vocab = {}
+    stats = vocab_engine.process_file(Lines(b"house\t1950,3,1\t1960,2,1\ncat\ndog\t1970,4,1\n"), vocab, {}, 0)
+    assert stats == {"lines": 3, "valid_lines": 3}
+    assert vocab == {"house": 5, "cat": 0, "dog": 4}
@@ -0,0 +1,56 @@
+import csv
+
+import pytest
+
+from manifest import DONE, FAILED, PENDING, RUNNING, ShardManifest
+
+
+def write_log(file_path, rows):
+    with open(file_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["date", "n-gram", "last_file_processed", "years_processed"])
+        writer.writerows(rows)
+
+
+def states(manifest):
+    return dict(manifest.connection.execute("SELECT num_file, state FROM shards ORDER BY num_file").fetchall())
+
+
+def test_claim_fail_and_recover(tmp_path):
+    manifest = ShardManifest(2, "1950-1999", 0, 3, db_path=str(tmp_path / "manifest.sqlite"), max_attempts=2)
+    manifest.add()
+    assert [manifest.claim(0), manifest.claim(1)] == [0, 1]
+    manifest.finish(0)
+    manifest.fail(1, "connection lost")
+    # The failed shard is claimed again after the ones not tried
+    assert manifest.claim(0) == 2
+    assert manifest.claim(0) == 1
+    manifest.fail(1, "connection lost")
+    assert manifest.claim(0) is None
+    assert manifest.failed_files() == [(1, "connection lost")]
+
+    # Shards left running by an interrupted run are pending again, the others keep their state
+    manifest.recover()
+    manifest.add()
+    assert states(manifest) == {0: DONE, 1: FAILED, 2: PENDING}
+    manifest.close()
+
+
+def test_import_log_is_one_transaction(tmp_path):
+    write_log(str(tmp_path / "file_log.csv"), [["2024-01-01", 2, 0, "1950-1999"], ["2024-01-01", 2, 1, "1950-1999", 0, "failed"],
+                                               ["2024-01-01", 2, 2, "all_years"]])
+    manifest = ShardManifest(2, "1950-1999", 0, 3, db_path=str(tmp_path / "manifest.sqlite"))
+    manifest.add()
+    manifest.import_log(str(tmp_path / "file_log.csv"))
+    assert states(manifest) == {0: DONE, 1: PENDING, 2: PENDING}
+
+    # A log that cannot be read to the end changes nothing, not the rows before the error
+    manifest = ShardManifest(2, "1950-1999", 3, 6, db_path=str(tmp_path / "manifest.sqlite"))
+    manifest.add()
+    write_log(str(tmp_path / "file_log.csv"), [["2024-01-01", 2, 3, "1950-1999"], ["2024-01-01", 2, "x", "1950-1999"]])
+    with pytest.raises(ValueError):
+        manifest.import_log(str(tmp_path / "file_log.csv"))
+    assert states(manifest) == {0: DONE, 1: PENDING, 2: PENDING, 3: PENDING, 4: PENDING, 5: PENDING}
+    assert manifest.claim(0) == 3
+    assert states(manifest)[3] == RUNNING
+    manifest.close()
@@ -0,0 +1,37 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from test_merge_folder import save_pairs
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "merge_and_PMI.py")
+
+
+def summary_of(metrics_file):
+    with open(metrics_file) as f:
+        return [json.loads(line) for line in f if '"summary"' in line][-1]
+
+
+@pytest.mark.parametrize("output_format", ["csv", "columnar"])
+def test_pairs_are_counted_once(tmp_path, output_format):
+    input_dir = str(tmp_path / "cooccurrence_info")
+    os.mkdir(input_dir)
+    save_pairs(os.path.join(input_dir, "2-gram.cooc"), {(2, 3): 3, (2, 4): 1, (3, 4): 2, (3, 9): 5})
+    with open(tmp_path / "vocab_info.csv", "w") as f:
+        f.write(",0\nfirst,40\nsecond,30\nthird,20\n")
+    output, metrics_file = str(tmp_path / "pmi"), str(tmp_path / "metrics.jsonl")
+
+    subprocess.run([sys.executable, SCRIPT, "-d", input_dir, "--vocab", str(tmp_path / "vocab_info.csv"), "-f", output_format,
+                    "-o", output, "--merged", str(tmp_path / "merged.cooc"), "-c", "2", "--metrics", metrics_file],
+                   cwd=str(tmp_path), check=True, stdout=subprocess.DEVNULL)
+
+    summary = summary_of(metrics_file)
+    # The pair with a word out of the vocabulary is not written
+    assert summary["totals"] == {"pairs": 4, "pairs_written": 3}
+    if output_format == "columnar":
+        assert len(np.load(os.path.join(output, "val.npy"))) == 3
+        assert "pmi_count" in summary["stages"]
@@ -0,0 +1,45 @@
+import os
+
+from cooccurrence import CooccurrenceCounter, merge_folder_if_changed, read_cooccurrence, save_snapshot
+
+
+def save_pairs(file_path, pairs):
+    counter = CooccurrenceCounter()
+    for (id_word1, id_word2), count in pairs.items():
+        counter.add(id_word1, id_word2, count)
+    save_snapshot(file_path, counter)
+
+
+def counts_of(file_path):
+    return {(id_word1, id_word2): count for id_word1, id_word2, count in read_cooccurrence(file_path).items()}
+
+
+def test_merged_counts_are_reused_only_for_the_same_files(tmp_path):
+    input_dir, merged = str(tmp_path / "cooccurrence_info"), str(tmp_path / "merged.cooc")
+    os.mkdir(input_dir)
+    save_pairs(os.path.join(input_dir, "2-gram.cooc"), {(1, 2): 3})
+    save_pairs(os.path.join(input_dir, "3-gram.cooc"), {(1, 2): 1, (2, 5): 4})
+    quiet = lambda *args: None
+
+    assert merge_folder_if_changed(input_dir, merged, quiet)
+    assert counts_of(merged) == {(1, 2): 4, (2, 5): 4}
+    assert not merge_folder_if_changed(input_dir, merged, quiet)
+
+    # Another file in the folder (or a file changed) merges again
+    save_pairs(os.path.join(input_dir, "4-gram.cooc"), {(2, 5): 1})
+    assert merge_folder_if_changed(input_dir, merged, quiet)
+    assert counts_of(merged) == {(1, 2): 4, (2, 5): 5}
+
+    # Another folder does not reuse the counts of this one
+    other_dir = str(tmp_path / "other")
+    os.mkdir(other_dir)
+    save_pairs(os.path.join(other_dir, "2-gram.cooc"), {(7, 8): 1})
+    assert merge_folder_if_changed(other_dir, merged, quiet)
+    assert counts_of(merged) == {(7, 8): 1}
+
+    # A merged snapshot without fingerprint is only reused when asked
+    os.remove(merged + ".inputs")
+    assert not merge_folder_if_changed(input_dir, merged, quiet, reuse=True)
+    assert counts_of(merged) == {(7, 8): 1}
+    assert merge_folder_if_changed(input_dir, merged, quiet)
+    assert counts_of(merged) == {(1, 2): 4, (2, 5): 5}
@@ -0,0 +1,58 @@
+import gzip
+import os
+import sqlite3
+import subprocess
+import sys
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Runs the parallelized script with stream_file of the workers (forked, so they keep the
+# patch) raising the given exception on file 85
+RUNNER = """
+import runpy, sys
+sys.path.insert(0, {scripts!r})
+import cooccurrence_engine
+
+stream_file = cooccurrence_engine.stream_file
+
+def failing_stream_file(num_file, total_files, worker):
+    if num_file == 85:
+        raise {error}("file 85 cannot be parsed")
+    return stream_file(num_file, total_files, worker)
+
+cooccurrence_engine.stream_file = failing_stream_file
+sys.argv = [{script!r}, "2", "2", "-y", "1950-1999", "-s", "85", "-e", "87", "-v", "-l", "shards", "-a", "1", "-u", "http://localhost:9/"]
+runpy.run_path({script!r}, run_name="__main__")
+"""
+
+
+def run_with_error(folder, error):
+    os.makedirs(os.path.join(folder, "shards"))
+    os.makedirs(os.path.join(folder, "1950-1999"))
+    with open(os.path.join(folder, "1950-1999", "vocab_info.csv"), "w") as f:
+        f.write(",0\nhouse,10\ncat,5\ndog,3\n")
+    for num_file in (85, 86):
+        with gzip.open(os.path.join(folder, "shards", "2-{:05d}-of-00589.gz".format(num_file)), "wb") as f:
+            f.write(b"house cat\t1950,3,1\t1960,2,1\ncat dog\t1970,4,1\n")
+    script = os.path.join(SCRIPTS, "download_and_process_n-grams_parallelized.py")
+    runner = RUNNER.format(scripts=os.path.abspath(SCRIPTS), script=script, error=error)
+    # A hang (the progress listener left running) ends with TimeoutExpired
+    return subprocess.run([sys.executable, "-c", runner], cwd=folder, capture_output=True, timeout=60)
+
+
+def states(folder):
+    with sqlite3.connect(os.path.join(folder, "shard_manifest.sqlite")) as connection:
+        return dict(connection.execute("SELECT num_file, state FROM shards ORDER BY num_file").fetchall())
+
+
+def test_a_failing_file_does_not_stop_the_others(tmp_path):
+    result = run_with_error(str(tmp_path), "ValueError")
+    assert result.returncode == 0, result.stderr.decode()
+    assert states(str(tmp_path)) == {85: "failed", 86: "done"}
+
+
+# An error that is not caught by the job reaches the parent, which must exit instead of hanging
+def test_a_failing_job_stops_the_script(tmp_path):
+    result = run_with_error(str(tmp_path), "KeyboardInterrupt")
+    assert result.returncode != 0
+    assert b"file 85 cannot be parsed" in result.stderr
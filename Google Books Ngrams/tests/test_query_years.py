@@ -0,0 +1,52 @@
+import gzip
+import os
+import subprocess
+import sys
+
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# 1-gram shards 6 to 23. "zeta" and "alpha" tie in 1950-1999 but "zeta" appears first, "gamma"
+# only appears before the range and "delta" has no years at all
+SHARDS = {
+    6: b"zeta\t1951,4,1\t1890,9,1\nalpha\t1960,4,1\t2005,50,1\n",
+    7: b"gamma\t1900,7,1\nbeta\t1972,9,1\ndelta\n",
+    8: b"alpha\t1801,1,1\nomega\t1999,1,1\n",
+}
+
+
+def run(folder, script, *options):
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, script), *options], cwd=folder, check=True, capture_output=True, timeout=120)
+
+
+def vocab_run(folder, *options):
+    os.makedirs(os.path.join(folder, "shards"))
+    for num_file in range(6, 24):
+        with gzip.open(os.path.join(folder, "shards", "1-{:05d}-of-00024.gz".format(num_file)), "wb") as f:
+            f.write(SHARDS.get(num_file, b""))
+    run(folder, "download_and_process_vocab.py", "-t", "1", "-v", "-l", "shards", "-u", "http://localhost:9/", *options)
+
+
+def read(file_path):
+    with open(file_path) as f:
+        return f.read()
+
+
+def test_query_gives_the_vocabulary_of_the_range(tmp_path):
+    direct, buckets = str(tmp_path / "direct"), str(tmp_path / "buckets")
+    vocab_run(direct, "-y", "1950-1999")
+    vocab_run(buckets, "-w", "10")
+    run(buckets, "query_years.py", "1950-1999")
+
+    expected = read(os.path.join(direct, "1950-1999", "vocab_info.csv"))
+    assert expected == ",0\nbeta,9\nzeta,4\nalpha,4\nomega,1\ngamma,0\ndelta,0\n"
+    assert read(os.path.join(buckets, "1950-1999", "vocab_info.csv")) == expected
+
+    # Run again it gives the same file, but another vocabulary of the range is never overwritten
+    run(buckets, "query_years.py", "1950-1999")
+    with open(os.path.join(buckets, "1950-1999", "vocab_info.csv"), "w") as f:
+        f.write(",0\nbeta,9\n")
+    with pytest.raises(subprocess.CalledProcessError):
+        run(buckets, "query_years.py", "1950-1999")
+    assert read(os.path.join(buckets, "1950-1999", "vocab_info.csv")) == ",0\nbeta,9\n"
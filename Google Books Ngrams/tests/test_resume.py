@@ -0,0 +1,59 @@
+import csv
+import os
+import subprocess
+import sys
+
+import pytest
+
+from cooccurrence import CooccurrenceCounter, read_cooccurrence, write_cooccurrence_csv
+from checkpoint import DeltaCheckpoint
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def counter_of(pairs):
+    counter = CooccurrenceCounter()
+    for (id_word1, id_word2), count in pairs.items():
+        counter.add(id_word1, id_word2, count)
+    return counter
+
+
+def counts_of(counter):
+    return {(id_word1, id_word2): count for id_word1, id_word2, count in counter.items()}
+
+
+# An older run left its counts as cooccurrence_info.csv, and this version saved segments of the
+# files in the log (and of one not logged) before it was interrupted
+def legacy_run(folder, gram_dir, logged, not_logged):
+    os.makedirs(gram_dir)
+    with open(os.path.join(os.path.dirname(gram_dir), "vocab_info.csv"), "w") as f:
+        f.write(",0\nhouse,10\ncat,5\ndog,3\n")
+    write_cooccurrence_csv(os.path.join(gram_dir, "cooccurrence_info.csv"), counter_of({(1, 2): 7, (2, 3): 1}))
+    checkpoint = DeltaCheckpoint(os.path.join(gram_dir, "cooccurrence_info.cooc"))
+    for num_file, pairs in logged.items():
+        checkpoint.append(num_file, counter_of(pairs))
+    for num_file, pairs in not_logged.items():
+        checkpoint.append(num_file, counter_of(pairs))
+    with open(os.path.join(folder, "file_log.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["date", "n-gram", "last_file_processed", "years_processed"])
+        for num_file in logged:
+            writer.writerow(["2024-01-01 00:00:00", 2, num_file, "1950-1999"])
+
+
+@pytest.mark.parametrize("script", ["download_and_process_n-grams.py", "download_and_process_n-grams_parallelized.py"])
+def test_resume_folds_legacy_csv_and_segments(tmp_path, script):
+    gram_dir = os.path.join(tmp_path, "1950-1999", "2-gram")
+    legacy_run(tmp_path, gram_dir, {85: {(1, 2): 2, (1, 3): 4}}, {86: {(1, 2): 100}})
+
+    # The range has no file left, so the run only folds what the earlier runs saved
+    command = [sys.executable, os.path.join(SCRIPTS, script), "2"]
+    if script.endswith("parallelized.py"):
+        command += ["1"]
+    command += ["-y", "1950-1999", "-s", "85", "-e", "86", "-v", "-u", "http://localhost:9/"]
+    if script == "download_and_process_n-grams.py":
+        command += ["-r"]
+    subprocess.run(command, cwd=tmp_path, check=True, capture_output=True)
+
+    counts = counts_of(read_cooccurrence(os.path.join(gram_dir, "cooccurrence_info.cooc")))
+    assert counts == {(1, 2): 9, (2, 3): 1, (1, 3): 4}
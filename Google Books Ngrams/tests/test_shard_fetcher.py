@@ -0,0 +1,195 @@
+import base64
+import concurrent.futures
+import gzip
+import hashlib
+import http.server
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from shard_fetcher import ShardCache, ShardFetcher
+
+NAME = "2-00085-of-00589.gz"
+LINES = [b"house cat\t1950,%d,1\t1960,2,1\n" % i for i in range(20000)]
+
+
+# Local server of the shards of a folder, with ranges (If-Range with the ETag), 416 for a range
+# after the end, HEAD and x-goog-hash. drop_after cuts the next answer after that many bytes
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def shard(self):
+        path = os.path.join(self.server.folder, self.path.lstrip("/"))
+        if not os.path.exists(path):
+            self.send_error(404)
+            return None, None
+        with open(path, "rb") as f:
+            data = f.read()
+        return data, '"' + hashlib.md5(data).hexdigest() + self.server.etag_suffix + '"'
+
+    def send_headers(self, data, etag, length):
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", etag)
+        self.send_header("x-goog-hash", "md5=" + base64.b64encode(hashlib.md5(data).digest()).decode())
+        self.end_headers()
+
+    def do_HEAD(self):
+        data, etag = self.shard()
+        if data is not None:
+            self.send_response(200)
+            self.send_headers(data, etag, len(data))
+
+    def do_GET(self):
+        data, etag = self.shard()
+        if data is None:
+            return
+        range_header, if_range = self.headers.get("Range"), self.headers.get("If-Range")
+        self.server.requests.append(range_header)
+        start = 0
+        if range_header and (if_range is None or if_range == etag):
+            start = int(range_header.split("=")[1].rstrip("-"))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(data))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_headers(data, etag, len(body))
+        if self.server.drop_after is not None and len(body) > self.server.drop_after:
+            self.wfile.write(body[:self.server.drop_after])
+            self.server.drop_after = None
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(tmp_path):
+    folder = tmp_path / "shards"
+    folder.mkdir()
+    with gzip.open(folder / NAME, "wb") as f:
+        f.write(b"".join(LINES))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.folder, server.etag_suffix, server.drop_after, server.requests = str(folder), "", None, []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = "http://127.0.0.1:%d/%s" % (server.server_address[1], NAME)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_lines(fetcher, source):
+    with fetcher.open(source) as stream:
+        return list(stream)
+
+
+# A part with every byte, left by a run that stopped before committing it
+def leave_complete_part(fetcher, url):
+    with fetcher.open(url) as stream:
+        raw = stream._raw
+        while raw.read(1 << 16) and raw.position < raw.size:
+            pass
+    assert fetcher.cache.lookup(url) is None and fetcher.cache.stats()["parts"] == 1
+
+
+def test_resume_in_the_middle(server):
+    server.drop_after = 50000
+    assert read_lines(ShardFetcher(backoff=0.01), server.url) == LINES
+    assert server.requests[-1] == "bytes=50000-"
+
+
+def test_cache_hit(server, tmp_path):
+    fetcher = ShardFetcher(str(tmp_path / "cache"), backoff=0.01)
+    assert read_lines(fetcher, server.url) == LINES
+    assert read_lines(fetcher, server.url) == LINES
+    assert len(server.requests) == 1
+
+
+def test_complete_part_is_committed(server, tmp_path):
+    fetcher = ShardFetcher(str(tmp_path / "cache"), backoff=0.01)
+    leave_complete_part(fetcher, server.url)
+    size = os.path.getsize(os.path.join(server.folder, NAME))
+
+    # The next run gets a 416 for the range after the part, and commits the part
+    fetcher = ShardFetcher(str(tmp_path / "cache"), backoff=0.01)
+    assert read_lines(fetcher, server.url) == LINES
+    assert server.requests[-1] == "bytes=%d-" % size
+    assert fetcher.cache.stats() == {"shards": 1, "bytes": size, "parts": 0}
+
+
+def test_complete_part_of_a_changed_shard_is_restarted(server, tmp_path):
+    fetcher = ShardFetcher(str(tmp_path / "cache"), backoff=0.01)
+    leave_complete_part(fetcher, server.url)
+
+    # The ETag changed: If-Range makes the server send the whole shard
+    server.etag_suffix = "v2"
+    assert read_lines(ShardFetcher(str(tmp_path / "cache"), backoff=0.01), server.url) == LINES
+    assert ShardFetcher(str(tmp_path / "cache")).cache.stats()["parts"] == 0
+
+
+def test_complete_part_of_a_different_size_is_restarted(server, tmp_path):
+    fetcher = ShardFetcher(str(tmp_path / "cache"), backoff=0.01)
+    leave_complete_part(fetcher, server.url)
+    # A part longer than the shard (with the same validator) gets a 416 too
+    part_path = fetcher.cache.part_path(server.url)
+    with open(part_path, "ab") as f:
+        f.write(b"\0" * 10)
+
+    fetcher = ShardFetcher(str(tmp_path / "cache"), backoff=0.01)
+    assert read_lines(fetcher, server.url) == LINES
+    assert server.requests[-1] is None
+    assert fetcher.cache.stats()["parts"] == 0
+
+
+def test_offline_miss(server, tmp_path):
+    fetcher = ShardFetcher(str(tmp_path / "cache"), offline=True)
+    with pytest.raises(FileNotFoundError):
+        fetcher.open(server.url)
+
+
+# Function to write a part of the cache and commit it like a finished download
+def commit_part(cache, url, data, size):
+    with open(cache.part_path(url), "wb") as f:
+        f.write(data)
+    cache.save_partial(url, '"etag"')
+    return cache.commit(url, hashlib.sha256(data).hexdigest(), size, '"etag"')
+
+
+def test_failed_commit_keeps_the_part(tmp_path):
+    cache = ShardCache(str(tmp_path / "cache"))
+    with pytest.raises(sqlite3.IntegrityError):
+        # A size of None breaks the NOT NULL constraint of the insert
+        commit_part(cache, "http://host/a.gz", b"abc", None)
+    # The part is still in the cache, and nothing was moved to the objects
+    assert cache.partial("http://host/a.gz") == (cache.part_path("http://host/a.gz"), '"etag"')
+    assert cache.stats() == {"shards": 0, "bytes": 0, "parts": 1}
+
+
+def test_cache_shared_by_threads(tmp_path):
+    cache = ShardCache(str(tmp_path / "cache"), max_bytes=40)
+
+    def use_cache(thread):
+        for i in range(50):
+            url = "http://host/%d-%d.gz" % (thread, i)
+            data = b"%d-%d" % (thread, i) * 2
+            commit_part(cache, url, data, len(data))
+            cache.lookup(url)
+            cache.stats()
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(use_cache, range(8)))
+    # Every shard left in the database has its file, and the eviction kept the cache under its size
+    stats = cache.stats()
+    assert stats["bytes"] <= 40 and stats["parts"] == 0
+    assert all(cache.lookup(url) is not None for url, in cache.connection.execute("SELECT url FROM shards").fetchall())
@@ -0,0 +1,17 @@
+import pytest
+
+from token_resolver import INVALID, OUT_OF_VOCAB, TokenResolver, normalize
+
+
+@pytest.mark.parametrize("token, word", [(b"Cat", "cat"), (b"cat_NOUN", "cat_noun"), (b"_NOUN_", "_noun_"), (b"House.", "house"),
+                                         (b"dog)", "dog"), (b"a,b", None), (b"x!!", None), (b"na\xc3\xafve", None), (b"", None)])
+def test_normalize(token, word):
+    assert normalize(token) == word
+
+
+def test_resolver_uses_the_words_of_the_vocabulary():
+    resolver = TokenResolver({"house": 2, "cat": 3})
+    assert resolver.resolve_gram(b"House cat.") == [2, 3]
+    assert resolver.resolve_gram(b"house dog") == [2, OUT_OF_VOCAB]
+    assert resolver.resolve_gram(b"house 42") is None
+    assert resolver.resolve(b"a,b") == INVALID
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Resolution of the raw tokens of the n-gram lines into vocabulary ids.
+#
+# Checking the pattern, removing the punctuation and looking up the vocabulary
+# is done once per surface form and memoized in a bounded LRU cache, because the
+# same tokens repeat in billions of lines. Tokens are resolved as raw bytes, so
+# rejected lines are never decoded.
+
+from functools import lru_cache
+import re
+
+# Valid tokens, on the raw bytes (the pattern is ASCII only)
+pattern = re.compile(rb'^_[A-Z]+_$|^[A-Za-z]+(?:_[A-Z]+)?(?:[.,!?:;)])?$')
+
+# Some punctuation in the ending of a word becomes a space
+PUNCTUATION = bytes.maketrans(b".,!?:;)", b"       ")
+
+# Values of resolve for tokens without id
+INVALID = -1
+OUT_OF_VOCAB = 0
+
+# Number of surface forms kept in the cache
+CACHE_SIZE = 1 << 20
+
+
+# Function to get the word of a raw token (punctuation removed and lowercased), or None if it does
+# not match the pattern. The vocabulary (vocab_engine.py) and the n-grams normalize the tokens with it
+def normalize(token):
+    if not pattern.match(token):
+        return None
+    return token.translate(PUNCTUATION).strip().lower().decode('ascii')
+
+
+class TokenResolver:
+    def __init__(self, vocab_id, cache_size=CACHE_SIZE):
+        self.vocab_id = vocab_id
+        self.resolve = lru_cache(maxsize=cache_size)(self.resolve_uncached)
+
+    # Function to get the id of a raw token: INVALID if it does not match the pattern,
+    # OUT_OF_VOCAB if its normalized form is not in the vocabulary
+    def resolve_uncached(self, token):
+        word = normalize(token)
+        if word is None:
+            return INVALID
+        return self.vocab_id.get(word, OUT_OF_VOCAB)
+
+    # Function to get the ids of the tokens of a gram, or None if some token is not valid
+    def resolve_gram(self, gram):
+        resolve = self.resolve
+        ids = []
+        for token in gram.split(b" "):
+            token_id = resolve(token)
+            if token_id == INVALID:
+                return None
+            ids.append(token_id)
+        return ids
+
+    # Function to get the hits, misses and hit rate of the cache
+    def stats(self):
+        info = self.resolve.cache_info()
+        lookups = info.hits + info.misses
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize,
+                "hit_rate": info.hits / lookups if lookups else 0.0}
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Worker side of download_and_process_vocab.py.
+#
+# Each worker counts the words of a range of 1-gram shards. Every shard is saved
+# as its own checkpoint in <dir_years>/vocab_shards, so a checkpoint only writes
+# the words of that shard and an interrupted run resumes from the shards already
+# saved. The parent merges the checkpoints in shard order and keeps the most
+# frequent words with a partial sort.
+
+import csv
+import datetime
+import os
+import pickle
+import time
+
+import numpy as np
+
+from counts_parser import CountsParser
+from pipeline_metrics import PipelineMetrics
+from shard_fetcher import ShardFetcher
+from shard_stream import STREAM_ERRORS, shard_source
+from token_resolver import normalize
+
+# State of each worker process, filled by init_worker
+worker_config = {}
+
+# Number of valid lines whose counts are parsed together
+BATCH_SIZE = 10000
+
+
+# Function to load everything a worker needs once per process. With profile_path, process_file
+# runs under cProfile and its stats are saved to profile_path plus the id of the process
+def init_worker(range_years, year_buckets, dir_years, url_base, local_dir, progress_queue, profile_path=None, fetcher_options=None):
+    metrics = PipelineMetrics("worker", profile_path=profile_path + "." + str(os.getpid()) if profile_path else None)
+    worker_config.update({
+        "metrics": metrics,
+        "process_file": metrics.profiled(process_file),
+        "dir_years": dir_years,
+        "url_base": url_base,
+        "local_dir": local_dir,
+        "fetcher": ShardFetcher(**(fetcher_options or {})),
+        "progress_queue": progress_queue,
+        "counts_parser": CountsParser(range_years),
+        "year_buckets": int(year_buckets) if year_buckets else None,
+    })
+
+
+# Function to send progress events to the parent process
+def report(worker, event, value=None):
+    queue = worker_config["progress_queue"]
+    if queue is not None:
+        queue.put((worker, event, value))
+
+
+# Path of the checkpoint of a shard
+def checkpoint_path(dir_years, num_file):
+    return dir_years + "/vocab_shards/1-" + str(num_file).zfill(5) + ".pkl"
+
+
+# Function to save the counts of a shard. It is written to a temporary file and renamed,
+# so a checkpoint is either complete or missing
+def save_checkpoint(file_path, vocab, vocab_buckets):
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((vocab, vocab_buckets), f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+# Function to read the (vocab, vocab_buckets) counts of a shard
+def load_checkpoint(file_path):
+    with open(file_path, "rb") as f:
+        return pickle.load(f)
+
+
+# Function to sum the occurrences of a batch of lines and update the dictionaries of the shard
+def update_batch(vocab, vocab_buckets, words, fields):
+    counts_parser = worker_config["counts_parser"]
+    if worker_config["year_buckets"]:
+        lines, years, counts = counts_parser.parse_buckets(fields, worker_config["year_buckets"])
+        for line, year, occurrences in zip(lines.tolist(), years.tolist(), counts.tolist()):
+            bucket = vocab_buckets.setdefault(year, {})
+            bucket[words[line]] = bucket.get(words[line], 0) + occurrences
+    for word, occurrences in zip(words, counts_parser.parse(fields).tolist()):
+        vocab[word] = vocab.get(word, 0) + occurrences
+
+
+# Returns the lines and valid lines of the file
+def process_file(decompressed_file, vocab, vocab_buckets, worker):
+    report(worker, "total", decompressed_file.size or None)
+    words, fields = [], []
+    num_line, valid_lines = -1, 0
+    for num_line, line in enumerate(decompressed_file):
+        # Split line into word (first position) and years (following positions)
+        word, _, years = line.partition(b'\t')
+
+        # Get the word, or None if it is not valid
+        word = normalize(word)
+        if word is not None:
+            valid_lines += 1
+            # The occurrences among years are summed later, for the whole batch at once
+            words.append(word)
+            fields.append(years)
+            if len(fields) >= BATCH_SIZE:
+                update_batch(vocab, vocab_buckets, words, fields)
+                words, fields = [], []
+
+        # Progress is measured in compressed bytes read from the stream
+        if num_line % 10000 == 0:
+            report(worker, "completed", decompressed_file.tell())
+    if fields:
+        update_batch(vocab, vocab_buckets, words, fields)
+    return {"lines": num_line + 1, "valid_lines": valid_lines}
+
+
+def log_file(num_file, worker, failed=False):
+    row = [datetime.datetime.now(), 1, num_file, worker_config["dir_years"], worker]
+    if failed:
+        row.append("failed")
+    with open('file_log.csv', 'a', newline='') as f:
+        csv.writer(f).writerow(row)
+
+
+# Job of a worker: count the words of a range of files and save a checkpoint for each one.
+# Returns the files saved and their stats, the counts stay on disk until the parent merges them
+def process_range(worker, files, total_files):
+    saved, file_stats = [], []
+    for num_file in files:
+        start_time = time.perf_counter()
+        source = shard_source(worker_config["url_base"], worker_config["local_dir"], "1", num_file, total_files)
+        vocab, vocab_buckets = {}, {}
+        try:
+            with worker_config["fetcher"].open(source) as decompressed_file:
+                stats = worker_config["process_file"](decompressed_file, vocab, vocab_buckets, worker)
+                stats["compressed_bytes"] = decompressed_file.tell()
+                stats["decompressed_bytes"] = decompressed_file.decompressed_tell()
+        except STREAM_ERRORS as e:
+            print(SystemExit(e))
+            log_file(num_file, worker, failed=True)
+        else:
+            stats["seconds"] = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            save_checkpoint(checkpoint_path(worker_config["dir_years"], num_file), vocab, vocab_buckets)
+            stats["checkpoint_seconds"] = time.perf_counter() - start_time
+            stats["accumulator_entries"] = len(vocab)
+            stats["worker_rss_bytes"] = worker_config["metrics"].process.memory_info().rss
+            log_file(num_file, worker)
+            saved.append(num_file)
+            file_stats.append((num_file, stats))
+        report(worker, "file")
+    worker_config["metrics"].save_profile()
+    return worker, saved, file_stats
+
+
+# Function to merge the checkpoints of the shards, in shard order. Words keep the order
+# of their first appearance, so equal frequencies are sorted like in a sequential run
+def merge_checkpoints(dir_years, files):
+    vocab, vocab_buckets = {}, {}
+    for num_file in files:
+        shard_vocab, shard_buckets = load_checkpoint(checkpoint_path(dir_years, num_file))
+        for word, occurrences in shard_vocab.items():
+            vocab[word] = vocab.get(word, 0) + occurrences
+        for year, shard_bucket in shard_buckets.items():
+            bucket = vocab_buckets.setdefault(year, {})
+            for word, occurrences in shard_bucket.items():
+                bucket[word] = bucket.get(word, 0) + occurrences
+    return vocab, vocab_buckets
+
+
+# Function to get the positions of the k largest counts, from the most frequent to the least.
+# Equal counts keep their order, like a stable sort of the whole array, but only the
+# k selected with np.partition are sorted
+def top_k(counts, k=None):
+    if k is None or k >= len(counts):
+        return np.argsort(-counts, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    threshold = np.partition(counts, len(counts) - k)[len(counts) - k]
+    above = np.flatnonzero(counts > threshold)
+    ties = np.flatnonzero(counts == threshold)[:k - len(above)]
+    selected = np.sort(np.concatenate((above, ties)))
+    return selected[np.argsort(-counts[selected], kind="stable")]
+
+
+# Function to save the vocabulary sorted by frequency, in the format of pd.DataFrame.to_csv
+def save_vocab(file_path, vocab, vocab_size):
+    words = list(vocab)
+    counts = np.fromiter(vocab.values(), dtype=np.int64, count=len(words))
+    with open(file_path, 'w', newline='') as f:
+        csvwriter = csv.writer(f, lineterminator="\n")
+        csvwriter.writerow(["", 0])
+        csvwriter.writerows((words[i], counts[i]) for i in top_k(counts, vocab_size).tolist())
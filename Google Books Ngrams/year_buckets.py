@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Co-occurrences kept per bucket of years.
+#
+# Instead of collapsing the counts of every year when the shards are parsed, each
+# bucket of years (one year, a decade...) gets its own CooccurrenceCounter. They
+# are saved as a folder with one snapshot per bucket, named like range_years
+# ("1990-1999.cooc"), so any range made of whole buckets is obtained later by
+# summing the snapshots of its buckets, without downloading the shards again.
+
+import os
+import shutil
+
+import numpy as np
+
+from cooccurrence import CooccurrenceCounter, load_snapshot_arrays, read_cooccurrence, save_snapshot
+
+
+class YearBucketedCounter:
+    def __init__(self, width):
+        self.width = width
+        self.buckets = {}
+
+    # Counter of the bucket that starts at year
+    def bucket(self, year):
+        if year not in self.buckets:
+            self.buckets[year] = CooccurrenceCounter()
+        return self.buckets[year]
+
+    # Add the pairs of a batch of lines, with their occurrences split by bucket.
+    # pairs is an array("q") of (id_word1, id_word2, line) triplets
+    def add_lines(self, pairs, fields, counts_parser):
+        lines, years, counts = counts_parser.parse_buckets(fields, self.width)
+        pairs = np.frombuffer(pairs, dtype=np.int64).reshape(-1, 3)
+        pairs = pairs[np.argsort(pairs[:, 2], kind="stable")]
+
+        # Every (line, bucket) row is repeated once per pair of its line
+        pairs_per_line = np.bincount(pairs[:, 2], minlength=len(fields))
+        first_pair = np.cumsum(pairs_per_line) - pairs_per_line
+        repeat = pairs_per_line[lines]
+        row = np.repeat(np.arange(len(lines)), repeat)
+        pair_index = first_pair[lines][row] + np.arange(len(row)) - np.repeat(np.cumsum(repeat) - repeat, repeat)
+
+        row_years = years[row]
+        for year in np.unique(row_years).tolist():
+            selected = row_years == year
+            self.bucket(year).add_pairs(pairs[pair_index[selected], 0], pairs[pair_index[selected], 1], counts[row[selected]])
+
+    def merge(self, other):
+        for year, counter in other.buckets.items():
+            self.bucket(year).merge(counter)
+        return self
+
+    def clear(self):
+        self.buckets = {}
+
+    def __len__(self):
+        return sum(len(counter) for counter in self.buckets.values())
+
+    @property
+    def nbytes(self):
+        return sum(counter.nbytes for counter in self.buckets.values())
+
+
+# Function to name the snapshot of a bucket like range_years
+def bucket_name(year, width):
+    return str(year) + "-" + str(year + width - 1) + ".cooc"
+
+
+def save_buckets(folder, counter):
+    if not os.path.isdir(folder):
+        os.mkdir(folder)
+    for year, bucket in counter.buckets.items():
+        save_snapshot(os.path.join(folder, bucket_name(year, counter.width)), bucket)
+
+
+# Function to list the (first year, last year, file) of every bucket in a folder
+def list_buckets(folder):
+    buckets = []
+    for name in os.listdir(folder):
+        if name.endswith(".cooc"):
+            first, last = (int(year) for year in name[:-len(".cooc")].split("-"))
+            buckets.append((first, last, os.path.join(folder, name)))
+    return sorted(buckets)
+
+
+def load_buckets(folder):
+    buckets = list_buckets(folder)
+    counter = YearBucketedCounter(buckets[0][1] - buckets[0][0] + 1 if buckets else 1)
+    for first, _, file_path in buckets:
+        counter.buckets[first] = read_cooccurrence(file_path)
+    return counter
+
+
+# Function to sum the buckets of a years range. The range must be made of whole buckets
+def query_buckets(folder, first_year, last_year):
+    counter = CooccurrenceCounter()
+    for first, last, file_path in list_buckets(folder):
+        if first_year <= first and last <= last_year:
+            keys, counts = load_snapshot_arrays(file_path)
+            counter.add_keys(np.asarray(keys), np.asarray(counts))
+        elif first <= last_year and first_year <= last:
+            raise ValueError("The range " + str(first_year) + "-" + str(last_year) + " does not match the buckets ("
+                             + str(first) + "-" + str(last) + " is only partially included)")
+    return counter
+
+
+# Functions to use the same code with plain counters (a snapshot file) and bucketed counters (a folder)
+def new_counter(year_buckets=None):
+    if year_buckets:
+        return YearBucketedCounter(int(year_buckets))
+    return CooccurrenceCounter()
+
+
+def save_counter(path, counter):
+    if isinstance(counter, YearBucketedCounter):
+        save_buckets(path, counter)
+    else:
+        save_snapshot(path, counter)
+
+
+def read_counter(path):
+    if os.path.isdir(path):
+        return load_buckets(path)
+    return read_cooccurrence(path)
+
+
+def remove_counter(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)